@@ -0,0 +1,256 @@
+'''
+A batched Go engine, which plays K games of the same board size at once.
+
+The games are stored together as K flat padded boards (see go.BoardGeometry),
+so that a single call to go.label_points finds the groups of every game, and
+each step is a handful of array operations no matter how many games are being
+played. The rules are the same as go.Position.play_move: suicide is illegal,
+simple ko and positional superko are enforced, and scoring is area scoring.
+
+A move is a flat index (row * N + column) into the board, or PASS.
+
+game = BatchedGame(64, board_size=9)
+while not game.finished.all():
+    moves = pick_moves(game.boards, game.legal_moves())
+    result = game.step(moves)
+'''
+from collections import namedtuple
+
+import numpy as np
+
+import go
+
+PASS = -1
+
+class StepResult(namedtuple('StepResult', ['legal', 'captures', 'passed', 'finished'])):
+    '''
+    legal: (K,) bool. Illegal moves are not played, and the game keeps its turn.
+        Moves for finished games are ignored, and reported as legal.
+    captures: (K, N, N) bool, the stones captured by this step's moves.
+    passed: (K,) bool, which games passed this step.
+    finished: (K,) bool, which games have ended with two consecutive passes.
+    '''
+    pass
+
+class BatchedGame():
+    def __init__(self, num_games, board_size=None, komi=7.5):
+        geometry = go.get_geometry(board_size or go.N)
+        self.geometry = geometry
+        self.num_games = num_games
+        self.komi = komi
+        size = geometry.padded_n ** 2
+        self.flat_boards = np.tile(geometry.empty_flat_board, [num_games, 1])
+        self.to_play = np.full([num_games], go.BLACK, dtype=np.int8)
+        self.ko = np.full([num_games], PASS, dtype=np.int64) # a move, or PASS if there's no ko
+        self.caps = np.zeros([num_games, 2], dtype=np.int64)
+        self.n = np.zeros([num_games], dtype=np.int64)
+        self.consecutive_passes = np.zeros([num_games], dtype=np.int64)
+        self.board_hashes = np.zeros([num_games], dtype=np.uint64)
+        # The hashes seen in every game, in one array sorted by hash, with the
+        # game each came from alongside. See _seen.
+        self._seen_hashes = np.zeros([num_games], dtype=np.uint64)
+        self._seen_games = np.arange(num_games)
+
+        # move -> flat index, and the flat indices of each point's neighbors.
+        self._move_index = geometry.flat_index.ravel()
+        self._neighbor_index = self._move_index[None, :] + np.array(geometry.flat_neighbor_offsets)[:, None]
+        # Zobrist keys laid out on the flat board; border points get 0.
+        self._flat_keys = {}
+        for color in (go.BLACK, go.WHITE):
+            self._flat_keys[color] = np.zeros([size], dtype=np.uint64)
+            self._flat_keys[color][self._move_index] = geometry.zobrist_keys[color].ravel()
+
+    @property
+    def boards(self):
+        'A (K, N, N) view of the boards, for feature extraction.'
+        padded_n = self.geometry.padded_n
+        return self.flat_boards.reshape(self.num_games, padded_n, padded_n)[:, 1:-1, 1:-1]
+
+    @property
+    def finished(self):
+        return self.consecutive_passes >= 2
+
+    def _find_groups(self, flat_boards):
+        '''
+        Labels the groups of every game at once. Returns (labels, liberty_counts)
+        where labels has the shape of flat_boards, and liberty_counts[label] is
+        the number of liberties of the group with that label.
+        '''
+        total_size = flat_boards.size
+        flat = flat_boards.ravel()
+        # Each board's border ring keeps its points from touching the next board's.
+        labels = go.label_points(flat, self.geometry)
+        stones = np.flatnonzero((flat == go.BLACK) | (flat == go.WHITE))
+        liberty_keys = []
+        for offset in self.geometry.flat_neighbor_offsets:
+            neighbors = stones + offset
+            is_liberty = flat[neighbors] == go.EMPTY
+            liberty_keys.append(labels[stones[is_liberty]] * total_size + neighbors[is_liberty])
+        liberty_labels = np.unique(np.concatenate(liberty_keys)) // total_size
+        liberty_counts = np.bincount(liberty_labels, minlength=total_size)
+        return labels.reshape(flat_boards.shape), liberty_counts
+
+    def legal_moves(self):
+        '''
+        Returns a (K, N, N) bool array of the legal moves for each game's player
+        to play. Passing is always legal, and is not part of the mask.
+        '''
+        flat_boards = self.flat_boards
+        labels, liberty_counts = self._find_groups(flat_boards)
+        color = self.to_play[:, None]
+        neighbor_colors = flat_boards[:, self._neighbor_index]
+        neighbor_labels = np.take(labels, self._neighbor_index, axis=1)
+        neighbor_libs = liberty_counts[neighbor_labels]
+        # A move has a liberty if it touches an empty point or one of our
+        # groups with a liberty to spare, or if it captures something.
+        captured = (neighbor_colors == -color[:, None]) & (neighbor_libs == 1)
+        captures = captured.any(axis=1)
+        legal = ((neighbor_colors == go.EMPTY) |
+                 ((neighbor_colors == color[:, None]) & (neighbor_libs > 1))).any(axis=1)
+        legal |= captures
+        legal &= flat_boards[:, self._move_index] == go.EMPTY
+        has_ko = self.ko != PASS
+        legal[has_ko, self.ko[has_ko]] = False
+
+        # The hash after each move: the board's hash, the move's own key, and
+        # the keys of the opponent groups it captures, each group once.
+        move_keys = np.where(color == go.BLACK, self._flat_keys[go.BLACK][self._move_index],
+                             self._flat_keys[go.WHITE][self._move_index])
+        new_hashes = self.board_hashes[:, None] ^ move_keys
+        group_hashes = self._group_hashes(flat_boards, labels)
+        for i in range(captured.shape[1]):
+            # the same group can be next to the move more than once.
+            first_time = captured[:, i].copy()
+            for j in range(i):
+                first_time &= ~(captured[:, j] & (neighbor_labels[:, j] == neighbor_labels[:, i]))
+            new_hashes ^= np.where(first_time, group_hashes[neighbor_labels[:, i]], np.uint64(0))
+
+        games, moves = np.nonzero(legal)
+        repeats = self._seen(games, new_hashes[games, moves])
+        legal[games[repeats], moves[repeats]] = False
+        return legal.reshape(self.boards.shape)
+
+    def _group_hashes(self, flat_boards, labels):
+        'The XOR of the zobrist keys of each group\'s stones, indexed by label.'
+        flat, flat_labels = flat_boards.ravel(), labels.ravel()
+        stones = np.flatnonzero((flat == go.BLACK) | (flat == go.WHITE))
+        points = stones % flat_boards.shape[1]
+        stone_keys = np.where(flat[stones] == go.BLACK, self._flat_keys[go.BLACK][points],
+                              self._flat_keys[go.WHITE][points])
+        order = np.argsort(flat_labels[stones], kind='stable')
+        sorted_labels = flat_labels[stones][order]
+        group_hashes = np.zeros([flat.size], dtype=np.uint64)
+        if len(stones):
+            starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+            group_hashes[sorted_labels[starts]] = np.bitwise_xor.reduceat(stone_keys[order], starts)
+        return group_hashes
+
+    def _seen(self, games, hashes):
+        '''
+        Whether each of hashes has already come up in the matching game of
+        games, for every game at once: one searchsorted over the sorted seen
+        hashes, then a check of the games of whatever hashes matched.
+        '''
+        seen_hashes, seen_games = self._seen_hashes, self._seen_games
+        last = len(seen_hashes) - 1
+        lo = np.searchsorted(seen_hashes, hashes)
+        seen = np.zeros([len(hashes)], dtype=bool)
+        matched = np.flatnonzero(seen_hashes[np.minimum(lo, last)] == hashes)
+        if len(matched):
+            # Early boards come up in many games at once, so a hash can match
+            # a run of entries; look through the whole run.
+            hi = np.searchsorted(seen_hashes, hashes[matched], side='right')
+            run = lo[matched, None] + np.arange((hi - lo[matched]).max())
+            seen[matched] = ((run < hi[:, None]) &
+                             (seen_games[np.minimum(run, last)] == games[matched, None])).any(axis=1)
+        return seen
+
+    def step(self, moves):
+        '''
+        Plays one move in every game. moves is a (K,) int array of moves, or
+        PASS. Returns a StepResult.
+        '''
+        moves = np.asarray(moves, dtype=np.int64)
+        games = np.arange(self.num_games)
+        active = ~self.finished
+        passed = active & (moves == PASS)
+        playing = active & ~passed
+        color = self.to_play
+        flat_moves = self._move_index[np.where(playing, moves, 0)]
+
+        legal = np.ones([self.num_games], dtype=bool)
+        legal[playing] = (self.flat_boards[games, flat_moves] == go.EMPTY)[playing]
+        legal[playing & (moves == self.ko)] = False
+        playing &= legal
+
+        # Play the moves on scratch boards, then remove any opponent groups
+        # left without liberties.
+        new_boards = self.flat_boards.copy()
+        new_boards[games[playing], flat_moves[playing]] = color[playing]
+        labels, liberty_counts = self._find_groups(new_boards)
+        flat_captures = (new_boards == -color[:, None]) & (liberty_counts[labels] == 0) & playing[:, None]
+        num_captured = flat_captures.sum(axis=1)
+        new_boards[flat_captures] = go.EMPTY
+        # It's suicide if the move's own group still has no liberties.
+        suicide = playing & (liberty_counts[labels[games, flat_moves]] == 0) & (num_captured == 0)
+        legal &= ~suicide
+        playing &= ~suicide
+
+        new_hashes = self.board_hashes.copy()
+        for color_to_play in (go.BLACK, go.WHITE):
+            is_color = playing & (color == color_to_play)
+            new_hashes[is_color] ^= self._flat_keys[color_to_play][flat_moves[is_color]]
+            captured_keys = np.where(flat_captures & is_color[:, None], self._flat_keys[-color_to_play], 0)
+            new_hashes ^= np.bitwise_xor.reduce(captured_keys, axis=1)
+        repeats = games[playing][self._seen(games[playing], new_hashes[playing])]
+        legal[repeats] = False
+        playing[repeats] = False
+
+        # A single stone captured by a move into the opponent's eye is a ko.
+        neighbor_colors = self.flat_boards[games[:, None], flat_moves[:, None] + np.array(self.geometry.flat_neighbor_offsets)]
+        koish = ((neighbor_colors == -color[:, None]) | (neighbor_colors == go.BORDER)).all(axis=1)
+        new_ko = np.full([self.num_games], PASS, dtype=np.int64)
+        is_ko = playing & koish & (num_captured == 1)
+        ko_points = np.argmax(flat_captures[:, self._move_index], axis=1)
+        new_ko[is_ko] = ko_points[is_ko]
+
+        self.flat_boards[playing] = new_boards[playing]
+        self.board_hashes[playing] = new_hashes[playing]
+        # np.insert keeps values bound for the same spot in the order given,
+        # so sort them first.
+        order = np.argsort(new_hashes[playing])
+        added_hashes, added_games = new_hashes[playing][order], games[playing][order]
+        at = np.searchsorted(self._seen_hashes, added_hashes)
+        self._seen_hashes = np.insert(self._seen_hashes, at, added_hashes)
+        self._seen_games = np.insert(self._seen_games, at, added_games)
+        self.caps[playing, np.where(color == go.BLACK, 0, 1)[playing]] += num_captured[playing]
+        moved = playing | passed
+        self.ko[moved] = new_ko[moved]
+        self.consecutive_passes[playing] = 0
+        self.consecutive_passes[passed] += 1
+        self.n[moved] += 1
+        self.to_play[moved] *= -1
+
+        captures = flat_captures & playing[:, None]
+        return StepResult(legal, captures[:, self._move_index].reshape(self.boards.shape), passed, self.finished)
+
+    def score(self):
+        'Area scores of every game, from black\'s point of view. See Position.score.'
+        boards = self.boards
+        empty = (boards == go.EMPTY)[:, None]
+        reach = np.stack([boards == go.BLACK, boards == go.WHITE], axis=1)
+        while True:
+            grown = reach.copy()
+            grown[..., 1:, :] |= reach[..., :-1, :]
+            grown[..., :-1, :] |= reach[..., 1:, :]
+            grown[..., :, 1:] |= reach[..., :, :-1]
+            grown[..., :, :-1] |= reach[..., :, 1:]
+            grown &= empty
+            grown |= reach
+            if np.array_equal(grown, reach):
+                break
+            reach = grown
+        black_reach, white_reach = reach[:, 0], reach[:, 1]
+        return ((black_reach & ~white_reach).sum(axis=(1, 2))
+                - (white_reach & ~black_reach).sum(axis=(1, 2))
+                - self.komi)
@@ -0,0 +1,283 @@
+'''
+Microbenchmarks for the board engine.
+
+python benchmarks.py play-move --board-size=19 --num-games=20
+python benchmarks.py playouts --board-size=19 --engines=array,bitboard
+python benchmarks.py from-board --board-size=19 --move-number=200
+python benchmarks.py score --board-size=19
+python benchmarks.py batched --board-size=9 --num-games=64
+python benchmarks.py feature-costs --board-size=19
+python benchmarks.py chunk-load --num-positions=4096
+'''
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import argh
+import numpy as np
+
+import batched_go
+import features
+import go
+import load_data_sets
+
+def random_game(max_moves=None, seed=0):
+    '''
+    Returns a list of PlayerMoves for a legal random game, played with the
+    current engine. Random games end with lots of captures and small groups,
+    which is a reasonable stress test for the liberty bookkeeping.
+    '''
+    rng = random.Random(seed)
+    max_moves = max_moves or go.N * go.N * 2
+    position = go.Position()
+    moves = []
+    while len(moves) < max_moves:
+        candidates = [tuple(c) for c in np.argwhere(position.board == go.EMPTY).tolist()]
+        rng.shuffle(candidates)
+        for c in candidates:
+            if position.is_move_legal(c) and position.is_eyeish(c) != position.to_play:
+                break
+        else:
+            c = None
+        moves.append(go.PlayerMove(position.to_play, c))
+        position.play_move(c, mutate=True)
+        if len(moves) > 2 and moves[-1].move is None and moves[-2].move is None:
+            break
+    return moves
+
+def time_replay(games, mode='mutate'):
+    '''
+    Returns (total moves, seconds) to replay each game with
+    play_move(mutate=True), play_move(mutate=False), or push_move then pop_move.
+    '''
+    num_moves = 0
+    elapsed = 0
+    for game in games:
+        position = go.Position()
+        tick = time.time()
+        if mode == 'push':
+            for color, move in game:
+                position.push_move(move, color=color)
+            for _ in game:
+                position.pop_move()
+        else:
+            for color, move in game:
+                position = position.play_move(move, color=color, mutate=(mode == 'mutate'))
+        elapsed += time.time() - tick
+        num_moves += len(game)
+    return num_moves, elapsed
+
+def play_move(board_size=19, num_games=10, engines='tuple,flat,array,bitboard'):
+    'Compares play_move throughput of the board engines on random games.'
+    go.set_board_size(board_size)
+    games = [random_game(seed=i) for i in range(num_games)]
+    for engine in engines.split(','):
+        go.set_engine(engine)
+        for mode in ('mutate', 'copy', 'push'):
+            num_moves, elapsed = time_replay(games, mode=mode)
+            print("%-8s %-6s %6d moves in %.3fs: %8.0f moves/sec" % (
+                engine, mode, num_moves, elapsed, num_moves / elapsed))
+    go.set_engine('tuple')
+
+def playouts(board_size=19, num_games=10, engines='tuple,flat,array,bitboard'):
+    'Compares the engines on random playouts, including the legality and eye checks that choose each move.'
+    go.set_board_size(board_size)
+    expected_games = None
+    for engine in engines.split(','):
+        go.set_engine(engine)
+        tick = time.time()
+        games = [random_game(seed=i) for i in range(num_games)]
+        elapsed = time.time() - tick
+        num_moves = sum(map(len, games))
+        print("%-8s %6d moves in %.3fs: %8.0f moves/sec" % (engine, num_moves, elapsed, num_moves / elapsed))
+        # every engine should play exactly the same games
+        expected_games = expected_games or games
+        assert games == expected_games
+    go.set_engine('tuple')
+
+def flood_fill_tracker(board):
+    'The original one-group-at-a-time LibertyTracker.from_board, kept as a baseline.'
+    board = np.copy(board)
+    curr_group_id = 0
+    lib_tracker = go.LibertyTracker()
+    for color in (go.WHITE, go.BLACK):
+        while color in board:
+            curr_group_id += 1
+            found_color = np.where(board == color)
+            coord = found_color[0][0], found_color[1][0]
+            chain, reached = go.find_reached(board, coord)
+            liberties = set(r for r in reached if board[r] == go.EMPTY)
+            lib_tracker.groups[curr_group_id] = go.Group(curr_group_id, chain, liberties, color)
+            for s in chain:
+                lib_tracker.group_index[s] = curr_group_id
+            go.place_stones(board, go.FILL, chain)
+    lib_tracker.max_group_id = curr_group_id
+    for group in lib_tracker.groups.values():
+        for s in group.stones:
+            lib_tracker.liberty_cache[s] = len(group.liberties)
+    return lib_tracker
+
+def mid_game_boards(num_boards, move_number):
+    'Dense boards taken from random games after move_number moves.'
+    boards = []
+    for i in range(num_boards):
+        position = go.Position()
+        for color, move in random_game(max_moves=move_number, seed=i):
+            position.play_move(move, color=color, mutate=True)
+        boards.append(position.board)
+    return boards
+
+def from_board(board_size=19, num_boards=50, move_number=200, engines='tuple,flat,array,bitboard'):
+    'Compares tracker construction from a raw board against the old flood fill.'
+    go.set_board_size(board_size)
+    boards = mid_game_boards(num_boards, move_number)
+    constructors = [('floodfill', flood_fill_tracker)]
+    constructors.extend((engine, go.ENGINES[engine].from_board) for engine in engines.split(','))
+    baseline = None
+    for name, constructor in constructors:
+        tick = time.time()
+        for board in boards:
+            constructor(board)
+        elapsed = time.time() - tick
+        baseline = baseline or elapsed
+        print("%-10s %4d boards in %.3fs: %8.0f boards/sec (%.1fx)" % (
+            name, num_boards, elapsed, num_boards / elapsed, baseline / elapsed))
+
+def flood_fill_score(position):
+    'The original Position.score, kept as a baseline.'
+    working_board = np.copy(position.board)
+    while go.EMPTY in working_board:
+        unassigned_spaces = np.where(working_board == go.EMPTY)
+        c = unassigned_spaces[0][0], unassigned_spaces[1][0]
+        territory, borders = go.find_reached(working_board, c)
+        border_colors = set(working_board[b] for b in borders)
+        X_border = go.BLACK in border_colors
+        O_border = go.WHITE in border_colors
+        if X_border and not O_border:
+            territory_color = go.BLACK
+        elif O_border and not X_border:
+            territory_color = go.WHITE
+        else:
+            territory_color = go.UNKNOWN
+        go.place_stones(working_board, territory_color, territory)
+    return np.count_nonzero(working_board == go.BLACK) - np.count_nonzero(working_board == go.WHITE) - position.komi
+
+def score(board_size=19, num_games=20, max_moves=0):
+    'Compares Position.score against the old flood fill on random games (max_moves=0 plays them out).'
+    go.set_board_size(board_size)
+    positions = []
+    for i in range(num_games):
+        position = go.Position()
+        for color, move in random_game(max_moves=max_moves, seed=i):
+            position.play_move(move, color=color, mutate=True)
+        positions.append(position)
+    timings = []
+    for name, scorer in (('floodfill', flood_fill_score), ('bitboard', go.Position.score)):
+        tick = time.time()
+        scores = [scorer(position) for position in positions]
+        elapsed = time.time() - tick
+        timings.append(elapsed)
+        print("%-10s %4d positions in %.3fs: %8.0f scores/sec (%.1fx)" % (
+            name, num_games, elapsed, num_games / elapsed, timings[0] / elapsed))
+        if name == 'floodfill':
+            expected_scores = scores
+        else:
+            assert scores == expected_scores
+
+def batched(board_size=9, num_games=64, num_steps=100):
+    'Compares stepping a BatchedGame against playing the same random games one Position at a time.'
+    go.set_board_size(board_size)
+    rng = np.random.RandomState(0)
+    game = batched_go.BatchedGame(num_games, board_size=board_size)
+    all_moves = []
+    tick = time.time()
+    for _ in range(num_steps):
+        legal_moves = game.legal_moves().reshape(num_games, -1)
+        # a random legal move in each game, or a pass if there are none.
+        random_keys = np.where(legal_moves, rng.rand(*legal_moves.shape), -1)
+        moves = np.where(legal_moves.any(axis=1), random_keys.argmax(axis=1), batched_go.PASS)
+        all_moves.append(moves)
+        game.step(moves)
+    batched_elapsed = time.time() - tick
+
+    positions = [go.Position() for _ in range(num_games)]
+    tick = time.time()
+    for moves in all_moves:
+        for k, position in enumerate(positions):
+            position.legal_move_mask()
+            move = None if moves[k] == batched_go.PASS else divmod(int(moves[k]), board_size)
+            position.play_move(move, mutate=True)
+    scalar_elapsed = time.time() - tick
+    num_moves = num_games * num_steps
+    for name, elapsed in (('batched', batched_elapsed), ('position', scalar_elapsed)):
+        print("%-8s %6d moves in %.3fs: %8.0f moves/sec" % (name, num_moves, elapsed, num_moves / elapsed))
+
+def feature_costs(board_size=19, num_games=5, max_moves=200):
+    'Breaks down extract_features time by feature and intermediate, for EXTENDED_FEATURES on the positions of random games.'
+    go.set_board_size(board_size)
+    positions = []
+    for i in range(num_games):
+        position = go.Position()
+        for color, move in random_game(max_moves=max_moves, seed=i):
+            position = position.play_move(move, color=color)
+            positions.append(position)
+    timings = {}
+    for position in positions:
+        features.extract_features(position, features.EXTENDED_FEATURES, timings=timings)
+    total = sum(timings.values())
+    for name, elapsed in sorted(timings.items(), key=lambda item: -item[1]):
+        print("%-28s %7.3fms/position %5.1f%%" % (name, 1000 * elapsed / len(positions), 100 * elapsed / total))
+    print("%-28s %7.3fms/position" % ('total', 1000 * total / len(positions)))
+
+def incremental_features(board_size=19, num_games=5, max_moves=250):
+    'Compares extract_features from scratch against IncrementalFeatures, on random games walked with push_move.'
+    go.set_board_size(board_size)
+    games = [random_game(max_moves=max_moves, seed=i) for i in range(num_games)]
+    expected = None
+    for name in ('scratch', 'incremental'):
+        extracted = []
+        elapsed = 0
+        for game in games:
+            position = go.Position()
+            if name == 'incremental':
+                features.start_incremental_features(position)
+            for color, move in game:
+                position.push_move(move, color=color)
+                tick = time.time()
+                extracted.append(features.extract_features(position))
+                elapsed += time.time() - tick
+        print("%-12s %6d positions in %.3fs: %8.0f positions/sec" % (name, len(extracted), elapsed, len(extracted) / elapsed))
+        expected = expected or extracted
+        assert all(np.array_equal(a, b) for a, b in zip(extracted, expected))
+
+def chunk_load(board_size=19, num_positions=4096, num_planes=48, batch_size=32):
+    'Compares loading a .chunk.gz against a memory-mapped uncompressed chunk, and going through it in minibatches.'
+    rng = np.random.RandomState(0)
+    # sparse, like real feature planes, so that gzip has something to do
+    pos_features = (rng.rand(num_positions, board_size, board_size, num_planes) < 0.1).astype(np.uint8)
+    next_moves = np.eye(board_size ** 2, dtype=np.uint8)[rng.randint(board_size ** 2, size=num_positions)]
+    dataset = load_data_sets.DataSet(pos_features, next_moves, [])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        gz_filename = os.path.join(tmp_dir, "train0.chunk.gz")
+        dataset.write(gz_filename)
+        filename = load_data_sets.convert_chunk(gz_filename)
+        for name, path in (('gzip', gz_filename), ('memmap', filename)):
+            tick = time.time()
+            loaded = load_data_sets.DataSet.load(path)
+            load_elapsed = time.time() - tick
+            tick = time.time()
+            for _ in range(num_positions // batch_size):
+                loaded.get_batch(batch_size)
+            epoch_elapsed = time.time() - tick
+            print("%-7s %8.1fKB on disk; load %.3fs; one epoch of minibatches %.3fs" % (
+                name, os.path.getsize(path) / 1024, load_elapsed, epoch_elapsed))
+            del loaded
+
+
+parser = argparse.ArgumentParser()
+argh.add_commands(parser, [play_move, playouts, from_board, score, batched, feature_costs, incremental_features, chunk_load])
+
+if __name__ == '__main__':
+    argh.dispatch(parser)
@@ -18,8 +18,12 @@ All features with 8 planes are 1-hot encoded, with plane i marked with 1
 only if the feature was equal to i. Any features >= 8 would be marked as 8.
 '''
 
+import functools
+import time
+
 import numpy as np
 import go
+import ladders
 from utils import product
 
 # Resolution/truncation limit for one-hot features
@@ -37,16 +41,89 @@ def make_onehot(feature, planes):
     onehot_features.ravel()[nonzero_index_offsets] = 1
     return onehot_features
 
+# ONEHOT_ROWS[k] is make_onehot's encoding of k, for k <= P.
+ONEHOT_ROWS = np.eye(P + 1, dtype=np.uint8)[:, 1:]
+
 def planes(num_planes):
     def deco(f):
         f.planes = num_planes
         return f
     return deco
 
+# Intermediates are per-position analyses that several features share, like
+# the legal moves or the groups on the board. A feature declares the ones it
+# takes with @needs, and extract_features computes each of them once per
+# position. Intermediates can need other intermediates.
+INTERMEDIATES = {}
+
+def intermediate(f):
+    'Registers f as an intermediate, under its name.'
+    INTERMEDIATES[f.__name__] = f
+    return f
+
+def needs(*names):
+    '''
+    Declares that f(position, **intermediates) takes the named intermediates
+    as keyword arguments. Called as f(position), it computes them itself.
+    '''
+    def deco(f):
+        @functools.wraps(f)
+        def with_intermediates(position, **intermediates):
+            for name in names:
+                compute_intermediate(name, position, intermediates)
+            return f(position, **{name: intermediates[name] for name in names})
+        with_intermediates.needs = names
+        return with_intermediates
+    return deco
+
+def compute_intermediate(name, position, intermediates, timings=None):
+    'Fills in intermediates[name] for position, unless it is there already.'
+    if name not in intermediates:
+        intermediates[name] = call_with_intermediates(INTERMEDIATES[name], position, intermediates, timings)
+    return intermediates[name]
+
+def needed_intermediates(features):
+    'The names of all the intermediates that features need, directly or through other intermediates.'
+    names = set()
+    pending = [name for f in features for name in getattr(f, 'needs', ())]
+    while pending:
+        name = pending.pop()
+        if name not in names:
+            names.add(name)
+            pending.extend(getattr(INTERMEDIATES[name], 'needs', ()))
+    return names
+
+def call_with_intermediates(f, position, intermediates, timings=None):
+    '''
+    Calls a feature or intermediate f on position, computing what it needs
+    into the intermediates dict first. If timings is a dict, the time spent
+    in f itself is added to timings[f.__name__].
+    '''
+    needed = getattr(f, 'needs', ())
+    for name in needed:
+        compute_intermediate(name, position, intermediates, timings)
+    tick = time.time()
+    result = f(position, **{name: intermediates[name] for name in needed})
+    if timings is not None:
+        timings[f.__name__] = timings.get(f.__name__, 0) + time.time() - tick
+    return result
+
+@intermediate
+def group_table(position):
+    return list(position.lib_tracker.groups.values())
+
+@intermediate
+def legal_moves(position):
+    return position.legal_move_mask()
+
+@intermediate
+def opponent_groups_in_atari(position):
+    return position.lib_tracker.groups_in_atari(-position.to_play)
+
 @planes(3)
 def stone_color_feature(position):
     board = position.board
-    features = np.zeros([go.N, go.N, 3], dtype=np.uint8)
+    features = np.zeros(board.shape + (3,), dtype=np.uint8)
     if position.to_play == go.BLACK:
         features[board == go.BLACK, 0] = 1
         features[board == go.WHITE, 1] = 1
@@ -59,11 +136,11 @@ def stone_color_feature(position):
 
 @planes(1)
 def ones_feature(position):
-    return np.ones([go.N, go.N, 1], dtype=np.uint8)
+    return np.ones(position.board.shape + (1,), dtype=np.uint8)
 
 @planes(P)
 def recent_move_feature(position):
-    onehot_features = np.zeros([go.N, go.N, P], dtype=np.uint8)
+    onehot_features = np.zeros(position.board.shape + (P,), dtype=np.uint8)
     for i, player_move in enumerate(reversed(position.recent[-P:])):
         _, move = player_move # unpack the info from position.recent
         if move is not None:
@@ -75,17 +152,116 @@ def liberty_feature(position):
     return make_onehot(position.get_liberties(), P)
 
 @planes(P)
-def would_capture_feature(position):
-    features = np.zeros([go.N, go.N], dtype=np.uint8)
-    for g in position.lib_tracker.groups.values():
-        if g.color == position.to_play:
-            continue
-        if len(g.liberties) == 1:
-            last_lib = list(g.liberties)[0]
-            # += because the same spot may capture more than 1 group.
-            features[last_lib] += len(g.stones)
+@needs('opponent_groups_in_atari')
+def would_capture_feature(position, opponent_groups_in_atari):
+    features = np.zeros(position.board.shape, dtype=np.uint8)
+    for g in opponent_groups_in_atari:
+        last_lib = list(g.liberties)[0]
+        # += because the same spot may capture more than 1 group.
+        features[last_lib] += len(g.stones)
     return make_onehot(features, P)
 
+def dilate(points):
+    'Marks points and their neighbors, for a stack of boolean boards of shape (..., N, N).'
+    dilated = np.copy(points)
+    dilated[..., 1:, :] |= points[..., :-1, :]
+    dilated[..., :-1, :] |= points[..., 1:, :]
+    dilated[..., :, 1:] |= points[..., :, :-1]
+    dilated[..., :, :-1] |= points[..., :, 1:]
+    return dilated
+
+@intermediate
+@needs('group_table')
+def move_consequences(position, group_table):
+    '''
+    What would happen if the player to play played at each empty point,
+    worked out from the groups on the board without playing anything.
+
+    Returns NxN arrays of the liberties of the group the move would be part
+    of, and the number of stones in that group. Both are 0 at occupied
+    points.
+    '''
+    board = position.board
+    n = board.shape[0]
+    color = position.to_play
+    groups = group_table
+    # One row per group, plus a trailing row of zeros that label -1 (no
+    # group) picks up.
+    num_groups = len(groups)
+    labels = np.full([n + 2, n + 2], -1, dtype=np.int32)
+    group_stones = np.zeros([num_groups + 1, n, n], dtype=bool)
+    group_colors = np.zeros([num_groups + 1], dtype=np.int8)
+    group_liberty_counts = np.zeros([num_groups + 1], dtype=np.int32)
+    for k, group in enumerate(groups):
+        stones = tuple(np.array(list(group.stones)).T)
+        group_stones[k][stones] = True
+        labels[1:-1, 1:-1][stones] = k
+        group_colors[k] = group.color
+        group_liberty_counts[k] = len(group.liberties)
+
+    empty = board == go.EMPTY
+    points = np.nonzero(empty)
+    # the groups above, below, right and left of each empty point
+    neighbor_labels = np.stack([
+        labels[2:, 1:-1], labels[:-2, 1:-1], labels[1:-1, 2:], labels[1:-1, :-2]], axis=-1)[points]
+    neighbor_colors = group_colors[neighbor_labels]
+    friendly = np.where(neighbor_colors == color, neighbor_labels, -1)
+    captured = np.where((neighbor_colors == -color) & (group_liberty_counts[neighbor_labels] == 1), neighbor_labels, -1)
+
+    # The new group: the stone itself and the friendly groups it connects.
+    new_stones = np.zeros((len(points[0]), n, n), dtype=bool)
+    new_stones[(np.arange(len(points[0])),) + points] = True
+    captured_stones = np.zeros_like(new_stones)
+    for i in range(4):
+        new_stones |= group_stones[friendly[:, i]]
+        captured_stones |= group_stones[captured[:, i]]
+    # Its liberties are the empty or captured points next to it.
+    liberties = dilate(new_stones) & ~new_stones & (empty | captured_stones)
+
+    liberties_after = np.zeros([n, n], dtype=np.int32)
+    group_sizes = np.zeros([n, n], dtype=np.int32)
+    liberties_after[points] = liberties.sum(axis=(1, 2))
+    group_sizes[points] = new_stones.sum(axis=(1, 2))
+    return liberties_after, group_sizes
+
+@planes(P)
+@needs('move_consequences', 'legal_moves')
+def self_atari_feature(position, move_consequences, legal_moves):
+    '''
+    How many of our stones would be left in atari by playing each legal
+    move.
+    '''
+    liberties_after, group_sizes = move_consequences
+    self_atari = (liberties_after == 1) & legal_moves
+    return make_onehot(np.where(self_atari, group_sizes, 0), P)
+
+@planes(P)
+@needs('move_consequences', 'legal_moves')
+def liberties_after_feature(position, move_consequences, legal_moves):
+    'How many liberties the group played into would have, for each legal move.'
+    liberties_after, _ = move_consequences
+    return make_onehot(np.where(legal_moves, liberties_after, 0), P)
+
+@planes(1)
+@needs('legal_moves')
+def sensibleness_feature(position, legal_moves):
+    'Legal moves that don\'t fill one of our own eyes.'
+    return (legal_moves & ~position.own_eye_mask())[:, :, None].astype(np.uint8)
+
+@planes(1)
+def ladder_capture_feature(position):
+    features = np.zeros(position.board.shape + (1,), dtype=np.uint8)
+    for move in ladders.default_reader.ladder_captures(position):
+        features[move] = 1
+    return features
+
+@planes(1)
+def ladder_escape_feature(position):
+    features = np.zeros(position.board.shape + (1,), dtype=np.uint8)
+    for move in ladders.default_reader.ladder_escapes(position):
+        features[move] = 1
+    return features
+
 DEFAULT_FEATURES = [
     stone_color_feature,
     ones_feature,
@@ -94,13 +270,310 @@ DEFAULT_FEATURES = [
     would_capture_feature,
 ]
 
-def extract_features(position, features=DEFAULT_FEATURES):
-    return np.concatenate([feature(position) for feature in features], axis=2)
+# Extra planes from the AlphaGo paper, opt-in by passing
+# features=EXTENDED_FEATURES. They make preprocessing much slower, and
+# chunks and checkpoints made with one list don't fit the other.
+EXTENDED_FEATURES = DEFAULT_FEATURES + [
+    self_atari_feature,
+    liberties_after_feature,
+    sensibleness_feature,
+    ladder_capture_feature,
+    ladder_escape_feature,
+]
+
+def cache_key(position, features=DEFAULT_FEATURES):
+    '''
+    A key that is equal for positions that get the same features: the same
+    board, player to play, ko and recent moves. (In principle superko makes
+    legality depend on the whole game, but that is rare enough to ignore.)
+    '''
+    return (position.zobrist_hash, position.ko, tuple(position.recent[-P:]), tuple(features))
+
+def extract_features(position, features=DEFAULT_FEATURES, cache=None, timings=None):
+    '''
+    cache: optionally, a utils.LRUCache to look the features up in, and store
+    them in. Cached features are read-only.
+    timings: optionally, a dict to add the seconds spent in each feature and
+    intermediate to, by name.
+    '''
+    if cache is not None:
+        key = cache_key(position, features)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+    if has_incremental_features(position, features):
+        extracted = np.copy(position.incremental_features.update(position, timings))
+    else:
+        intermediates = {}
+        extracted = np.concatenate([
+            call_with_intermediates(feature, position, intermediates, timings)
+            for feature in features], axis=2)
+    if cache is not None:
+        cache.put(key, extracted)
+    return extracted
+
+class IncrementalFeatures():
+    '''
+    The planes of extract_features(position, features), kept up to date as
+    moves are played on a position instead of rebuilt for every position.
+    Attach one with start_incremental_features, and extract_features uses it.
+
+    Position tells it which points each move (or pop_move) changed, and
+    update brings the planes up to date by rewriting just:
+    - the stone colors at the changed points. The player and opponent
+      planes swap when the turn has changed.
+    - the liberty counts of the groups at or next to the changed points; no
+      other group can have gained or lost stones or liberties.
+    - the last P moves, and the capture sizes at the last liberties of the
+      opponent groups in atari, clearing the ones from the last update.
+    Features without an update here are recomputed in full.
+    '''
+    def __init__(self, geometry, features=DEFAULT_FEATURES):
+        self.geometry = geometry
+        self.features = list(features)
+        n = geometry.n
+        self.planes = np.zeros([n, n, sum(f.planes for f in features)], dtype=np.uint8)
+        # points changed since the last update, or None if everything is stale.
+        self.changed_points = None
+        # what the planes show, beyond the stones
+        self._to_play = None
+        self._recent_points = []
+        self._capture_points = []
+
+    def __deepcopy__(self, memodict={}):
+        new_features = IncrementalFeatures.__new__(IncrementalFeatures)
+        new_features.__dict__.update(self.__dict__)
+        new_features.planes = np.copy(self.planes)
+        new_features.changed_points = set(self.changed_points) if self.changed_points is not None else None
+        return new_features
+
+    def mark_changed(self, points):
+        if self.changed_points is not None:
+            self.changed_points.update(points)
+
+    def update(self, position, timings=None):
+        '''
+        Brings the planes up to date with position, and returns them. They
+        are overwritten by the next update, so copy them to keep them.
+        '''
+        changed_points = self.changed_points
+        if changed_points is None:
+            self.planes[...] = 0
+            self._recent_points = []
+            self._capture_points = []
+        intermediates = {}
+        offset = 0
+        for feature in self.features:
+            out = self.planes[:, :, offset:offset + feature.planes]
+            offset += feature.planes
+            update = self._UPDATES.get(feature)
+            if update is None:
+                out[...] = call_with_intermediates(feature, position, intermediates, timings)
+                continue
+            if timings is None:
+                update(self, position, out, changed_points, intermediates)
+                continue
+            tick = time.time()
+            update(self, position, out, changed_points, intermediates)
+            timings[feature.__name__] = timings.get(feature.__name__, 0) + time.time() - tick
+        self.changed_points = set()
+        self._to_play = position.to_play
+        return self.planes
+
+    def _update_stone_color(self, position, out, changed_points, intermediates):
+        if changed_points is None:
+            out[...] = stone_color_feature(position)
+            return
+        if position.to_play != self._to_play:
+            # the player and opponent planes swap every turn
+            out[:, :, 0], out[:, :, 1] = out[:, :, 1].copy(), out[:, :, 0].copy()
+        board = position.board
+        for c in changed_points:
+            color = board[c]
+            out[c] = (color == position.to_play, color == -position.to_play, color == go.EMPTY)
+
+    def _update_ones(self, position, out, changed_points, intermediates):
+        if changed_points is None:
+            out[...] = 1
+
+    def _update_liberties(self, position, out, changed_points, intermediates):
+        if changed_points is None:
+            out[...] = liberty_feature(position)
+            return
+        board = position.board
+        neighbors = self.geometry.neighbors
+        lib_tracker = position.lib_tracker
+        updated = set()
+        for c in changed_points:
+            if board[c] == go.EMPTY:
+                out[c] = 0
+            for s in (c,) + tuple(neighbors[c]):
+                if board[s] != go.EMPTY and s not in updated:
+                    stones = lib_tracker.stones_at(s)
+                    updated |= stones
+                    # Row by row beats fancy indexing for all but huge groups.
+                    onehot = ONEHOT_ROWS[min(len(lib_tracker.liberties_at(s)), P)]
+                    for stone in stones:
+                        out[stone] = onehot
+
+    def _update_recent_moves(self, position, out, changed_points, intermediates):
+        for point in self._recent_points:
+            out[point] = 0
+        self._recent_points = [
+            (move[0], move[1], i)
+            for i, (_, move) in enumerate(reversed(position.recent[-P:]))
+            if move is not None]
+        for point in self._recent_points:
+            out[point] = 1
+
+    def _update_would_capture(self, position, out, changed_points, intermediates):
+        for c in self._capture_points:
+            out[c] = 0
+        capture_sizes = {}
+        for g in compute_intermediate('opponent_groups_in_atari', position, intermediates):
+            last_lib = list(g.liberties)[0]
+            capture_sizes[last_lib] = capture_sizes.get(last_lib, 0) + len(g.stones)
+        for c, size in capture_sizes.items():
+            out[c][min(size, P) - 1] = 1
+        self._capture_points = list(capture_sizes)
+
+    _UPDATES = {
+        stone_color_feature: _update_stone_color,
+        ones_feature: _update_ones,
+        liberty_feature: _update_liberties,
+        recent_move_feature: _update_recent_moves,
+        would_capture_feature: _update_would_capture,
+    }
+
+def start_incremental_features(position, features=DEFAULT_FEATURES):
+    '''
+    Attaches an IncrementalFeatures for features to position, unless it has
+    one already. extract_features(position, features), for it and for the
+    positions played from it with play_move or push_move, then only updates
+    the planes where each move changed something.
+    '''
+    if not has_incremental_features(position, features):
+        position.incremental_features = IncrementalFeatures(position.geometry, features)
+    return position
+
+def has_incremental_features(position, features):
+    incremental_features = position.incremental_features
+    return incremental_features is not None and incremental_features.features == list(features)
+
+def onehot_into(out, feature, planes):
+    '''
+    Like make_onehot, but writes into out, which has one more dimension than
+    feature and must be all zeros.
+    '''
+    capped = np.minimum(feature, planes)
+    nonzero = np.nonzero(capped)
+    out[nonzero + (capped[nonzero] - 1,)] = 1
+
+# Batched versions of the features above, which write the planes for a
+# stack of positions into out[:, :, :, feature planes] at once. out starts
+# out as zeros. boards is the (B, N, N) stack of the positions' boards, and
+# to_play is (B,).
+
+def bulk_stone_color_feature(positions, boards, to_play, out):
+    # the colors of planes 0, 1 and 2 for each position
+    plane_colors = np.stack([to_play, -to_play, np.full_like(to_play, go.EMPTY)], axis=1)
+    out[...] = boards[..., None] == plane_colors[:, None, None, :]
+
+def bulk_ones_feature(positions, boards, to_play, out):
+    out[...] = 1
+
+def bulk_liberty_feature(positions, boards, to_play, out):
+    liberties = np.stack([position.get_liberties() for position in positions])
+    onehot_into(out, liberties, P)
+
+def bulk_recent_move_feature(positions, boards, to_play, out):
+    indices = []
+    for b, position in enumerate(positions):
+        for i, (_, move) in enumerate(reversed(position.recent[-P:])):
+            if move is not None:
+                indices.append((b, move[0], move[1], i))
+    if indices:
+        out[tuple(np.array(indices).T)] = 1
+
+def bulk_would_capture_feature(positions, boards, to_play, out):
+    # the per-group work: find the last liberty of each group in atari.
+    indices = []
+    sizes = []
+    for b, position in enumerate(positions):
+        for g in position.lib_tracker.groups_in_atari(-position.to_play):
+            last_lib = list(g.liberties)[0]
+            indices.append((b, last_lib[0], last_lib[1]))
+            sizes.append(len(g.stones))
+    capture_sizes = np.zeros(boards.shape, dtype=np.uint8)
+    if indices:
+        # add.at, because the same spot may capture more than 1 group.
+        np.add.at(capture_sizes, tuple(np.array(indices).T), np.array(sizes, dtype=np.uint8))
+    onehot_into(out, capture_sizes, P)
+
+BULK_FEATURES = {
+    stone_color_feature: bulk_stone_color_feature,
+    ones_feature: bulk_ones_feature,
+    liberty_feature: bulk_liberty_feature,
+    recent_move_feature: bulk_recent_move_feature,
+    would_capture_feature: bulk_would_capture_feature,
+}
 
 def bulk_extract_features(positions, features=DEFAULT_FEATURES):
+    '''
+    extract_features for a list of positions, as a (B, N, N, planes) array.
+    All positions must have the same board size.
+    '''
     num_positions = len(positions)
     num_planes = sum(f.planes for f in features)
-    output = np.zeros([num_positions, go.N, go.N, num_planes], dtype=np.uint8)
-    for i, pos in enumerate(positions):
-        output[i] = extract_features(pos, features=features)
+    n = positions[0].geometry.n if positions else go.N
+    output = np.zeros([num_positions, n, n, num_planes], dtype=np.uint8)
+    if not positions:
+        return output
+    if all(has_incremental_features(position, features) for position in positions):
+        # e.g. the positions of a game replayed with replay_sgf(features=...)
+        for i, position in enumerate(positions):
+            output[i] = position.incremental_features.update(position)
+        return output
+    boards = np.stack([position.board for position in positions])
+    to_play = np.array([position.to_play for position in positions], dtype=np.int8)
+    intermediates = [{} for _ in positions]
+    offset = 0
+    for feature in features:
+        out = output[..., offset:offset + feature.planes]
+        bulk_feature = BULK_FEATURES.get(feature)
+        if bulk_feature is not None:
+            bulk_feature(positions, boards, to_play, out)
+        else:
+            for i, position in enumerate(positions):
+                out[i] = call_with_intermediates(feature, position, intermediates[i])
+        offset += feature.planes
+    return output
+
+# The packed feature format stores each position's (N, N, planes) features
+# as one row of bits, in the same order as the unpacked array, padded to a
+# whole number of bytes.
+PACKED_BATCH_SIZE = 256
+
+def pack_features(extracted):
+    'Packs (B, N, N, planes) features of 0s and 1s into (B, row bytes) packed rows.'
+    return np.packbits(extracted.reshape(extracted.shape[0], -1), axis=1)
+
+def unpack_features(packed, feature_shape):
+    'Unpacks packed rows back into (B,) + feature_shape features.'
+    num_bits = product(feature_shape)
+    return np.unpackbits(packed, axis=1)[:, :num_bits].reshape((packed.shape[0],) + tuple(feature_shape))
+
+def bulk_extract_packed_features(positions, features=DEFAULT_FEATURES, batch_size=PACKED_BATCH_SIZE):
+    '''
+    pack_features(bulk_extract_features(positions, features)), without the
+    unpacked features for all positions ever existing at once: positions are
+    extracted batch_size at a time, and packed into the output as they go.
+    '''
+    n = positions[0].geometry.n if positions else go.N
+    num_planes = sum(f.planes for f in features)
+    row_bytes = (n * n * num_planes + 7) // 8
+    output = np.zeros([len(positions), row_bytes], dtype=np.uint8)
+    for start in range(0, len(positions), batch_size):
+        batch = positions[start:start + batch_size]
+        output[start:start + len(batch)] = pack_features(bulk_extract_features(batch, features))
     return output
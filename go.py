@@ -9,21 +9,352 @@ A PlayerMove is a (Color, Move) tuple
 from collections import namedtuple
 import copy
 import itertools
+import struct
+import threading
 
 import numpy as np
 
 # Represent a board as a numpy array, with 0 empty, 1 is black, -1 is white.
 # This means that swapping colors is as simple as multiplying array by -1.
-WHITE, EMPTY, BLACK, FILL, KO, UNKNOWN = range(-1, 5)
+# BORDER marks the sentinel points surrounding a flat padded board.
+WHITE, EMPTY, BLACK, FILL, KO, UNKNOWN, BORDER = range(-1, 6)
 
 class PlayerMove(namedtuple('PlayerMove', ['color', 'move'])): pass
 
+class MoveHistory():
+    '''
+    An immutable sequence of PlayerMoves, stored as a linked list from the
+    last move back to the first. Appending a move is O(1) and shares the
+    rest of the history, so positions copied from one another share memory.
+
+    Behaves like a tuple for len(), iteration and indexing; slices are
+    returned as tuples. Negative indices and slices of the last few moves
+    only walk that many links, so recent[-8:] stays cheap.
+    '''
+    __slots__ = ['parent', 'last', 'length']
+
+    def __init__(self, parent=None, last=None):
+        self.parent = parent
+        self.last = last
+        self.length = parent.length + 1 if parent is not None else 0
+
+    @classmethod
+    def from_moves(cls, player_moves):
+        history = EMPTY_HISTORY
+        for player_move in player_moves:
+            history = history.append(player_move)
+        return history
+
+    def append(self, player_move):
+        return MoveHistory(self, player_move)
+
+    def __add__(self, player_moves):
+        # so that `recent += (PlayerMove(...),)` keeps working.
+        history = self
+        for player_move in player_moves:
+            history = history.append(player_move)
+        return history
+
+    def __len__(self):
+        return self.length
+
+    def __reversed__(self):
+        history = self
+        while history.length:
+            yield history.last
+            history = history.parent
+
+    def __iter__(self):
+        return iter(list(reversed(self))[::-1])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            if step < 0:
+                return tuple(self)[index]
+            newest_first = itertools.islice(reversed(self), self.length - stop, self.length - start)
+            return tuple(newest_first)[::-1][::step]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('move history index out of range')
+        return next(itertools.islice(reversed(self), self.length - 1 - index, None))
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, (MoveHistory, tuple)) or len(self) != len(other):
+            return False
+        return tuple(self) == tuple(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'MoveHistory(%r)' % (tuple(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memodict={}):
+        return self
+
+    def __reduce__(self):
+        # pickling the links one by one would recurse once per move.
+        return (MoveHistory.from_moves, (tuple(self),))
+
+EMPTY_HISTORY = MoveHistory()
+
+class HashHistory():
+    '''
+    An immutable set of board hashes, for superko. Adding a hash returns a
+    new HashHistory that shares nearly everything with the old one, so
+    positions copied from one another don't copy the whole game's hashes.
+
+    The hashes are kept in frozensets of distinct power of two sizes, like
+    the digits of a binary counter: adding a hash merges the smallest sets
+    while they're the same size. Adding is amortized O(log n), and so is a
+    lookup, which checks each of the O(log n) sets.
+    '''
+    __slots__ = ['levels', 'length']
+
+    def __init__(self, levels=(), length=0):
+        # largest first
+        self.levels = levels
+        self.length = length
+
+    @classmethod
+    def from_hashes(cls, hashes):
+        history = EMPTY_HASHES
+        for h in hashes:
+            history = history.add(h)
+        return history
+
+    def add(self, h):
+        if h in self:
+            return self
+        levels = list(self.levels)
+        merged = frozenset([h])
+        while levels and len(levels[-1]) <= len(merged):
+            merged = levels.pop() | merged
+        levels.append(merged)
+        return HashHistory(tuple(levels), self.length + 1)
+
+    def intersection(self, hashes):
+        'The set of hashes that are in this history.'
+        hashes = set(hashes)
+        found = set()
+        for level in self.levels:
+            # iterates over the smaller of the two
+            found |= level & hashes
+        return found
+
+    def __contains__(self, h):
+        for level in self.levels:
+            if h in level:
+                return True
+        return False
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.levels)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, (HashHistory, set, frozenset)) or len(self) != len(other):
+            return False
+        return all(h in other for h in self)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'HashHistory(%r)' % (set(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memodict={}):
+        return self
+
+EMPTY_HASHES = HashHistory()
+
 # Represents "group not found" in the LibertyTracker object
 MISSING_GROUP_ID = -1
 
 class IllegalMove(Exception): pass
 
-# these are initialized by set_board_size
+class BoardGeometry(namedtuple('BoardGeometry', [
+        'n', 'all_coords', 'empty_board', 'neighbors', 'diagonals',
+        'padded_n', 'flat_neighbor_offsets', 'flat_index', 'flat_coords',
+        'flat_neighbors', 'flat_diagonals', 'empty_flat_board',
+        'zobrist_keys', 'zobrist_white_to_play', 'zobrist_points', 'bit_masks'])):
+    '''
+    Everything about the board that depends only on its size. Get one from
+    get_geometry(n), which hands out a single shared instance per size; every
+    Position and LibertyTracker carries the geometry of its board, so games of
+    different sizes can live side by side in one process. Geometries are
+    shared between positions and threads, so their arrays are read-only, and
+    their dicts must be treated as read-only too.
+
+    n: the board size
+    all_coords: a tuple of every Coordinate
+    empty_board: an empty NxN board
+    neighbors, diagonals: dicts of Coordinate -> tuple of on-board Coordinates
+
+    The flat engines store a board as a 1D array of (N+2) x (N+2) points,
+    where the outermost ring holds BORDER sentinels. Neighbors of a flat index
+    f are then f + offset for each of flat_neighbor_offsets, with no bounds
+    checks.
+    padded_n: N + 2
+    flat_index: NxN array; flat_index[c] is the flat index of Coordinate c
+    flat_coords: dict of flat index -> Coordinate, for every point on the board
+    flat_neighbors, flat_diagonals: (N+2)**2 x 4 arrays of neighbor / diagonal
+        flat indices. Border points get clipped entries; they are never looked up.
+    empty_flat_board: an empty flat board
+
+    Zobrist hashing: a board hashes to the XOR of zobrist_keys[color][c] over
+    its stones, and a position additionally XORs in zobrist_white_to_play when
+    it is white's turn. zobrist_keys[EMPTY] is all zeros, so that swapping the
+    color of a point is always hash ^ key(old color) ^ key(new color).
+    zobrist_points[color] maps each of zobrist_keys[color] back to its Coordinate.
+
+    bit_masks: the BitMasks used by the bitboard engine.
+    '''
+    @staticmethod
+    def build(n):
+        all_coords = tuple((i, j) for i in range(n) for j in range(n))
+        def check_bounds(c):
+            return c[0] % n == c[0] and c[1] % n == c[1]
+        neighbors = {(x, y): tuple(filter(check_bounds, [(x+1, y), (x-1, y), (x, y+1), (x, y-1)])) for x, y in all_coords}
+        diagonals = {(x, y): tuple(filter(check_bounds, [(x+1, y+1), (x+1, y-1), (x-1, y+1), (x-1, y-1)])) for x, y in all_coords}
+
+        padded_n = n + 2
+        flat_neighbor_offsets = (padded_n, -padded_n, 1, -1)
+        flat_diagonal_offsets = np.array([padded_n + 1, padded_n - 1, -padded_n + 1, -padded_n - 1])
+        flat_index = np.arange(padded_n ** 2).reshape(padded_n, padded_n)[1:-1, 1:-1].copy()
+        flat_coords = {int(flat_index[c]): c for c in all_coords}
+        all_flat = np.arange(padded_n ** 2)[:, None]
+        flat_neighbors = np.clip(all_flat + np.array(flat_neighbor_offsets), 0, padded_n ** 2 - 1)
+        flat_diagonals = np.clip(all_flat + flat_diagonal_offsets, 0, padded_n ** 2 - 1)
+        empty_flat_board = np.full([padded_n ** 2], BORDER, dtype=np.int8)
+        empty_flat_board[flat_index.ravel()] = EMPTY
+
+        # Seeded, so that hashes are reproducible across processes.
+        rng = np.random.RandomState(n)
+        random_keys = rng.randint(np.iinfo(np.uint64).max, size=[2 * n * n + 1], dtype=np.uint64)
+        zobrist_keys = {
+            BLACK: random_keys[:n * n].reshape(n, n),
+            WHITE: random_keys[n * n:2 * n * n].reshape(n, n),
+            EMPTY: np.zeros([n, n], dtype=np.uint64),
+        }
+
+        zobrist_points = {
+            color: {int(zobrist_keys[color][c]): c for c in all_coords}
+            for color in (BLACK, WHITE)
+        }
+
+        empty_board = np.zeros([n, n], dtype=np.int8)
+        for array in [empty_board, flat_index, flat_neighbors, flat_diagonals, empty_flat_board] + list(zobrist_keys.values()):
+            array.flags.writeable = False
+        return BoardGeometry(n, all_coords, empty_board, neighbors, diagonals,
+                             padded_n, flat_neighbor_offsets, flat_index, flat_coords,
+                             flat_neighbors, flat_diagonals, empty_flat_board,
+                             zobrist_keys, int(random_keys[-1]), zobrist_points,
+                             BitMasks.build(n))
+
+    def to_flat_board(self, board):
+        'Converts a NxN board into a flat board with a sentinel border.'
+        flat_board = np.copy(self.empty_flat_board)
+        flat_board[self.flat_index.ravel()] = board.ravel()
+        return flat_board
+
+    def unpad(self, flat_array):
+        'Returns a NxN view of the playing area of a flat padded array.'
+        return flat_array.reshape(self.padded_n, self.padded_n)[1:-1, 1:-1]
+
+class BitMasks(namedtuple('BitMasks', [
+        'n', 'full', 'not_first_column', 'not_last_column', 'edge', 'neighbors'])):
+    '''
+    Shift masks for bitboards: a set of points stored as a Python int, with
+    bit r * N + c set for point (r, c). Shifting by N moves every point a row,
+    and shifting by 1 moves it a column; the column masks clear the points
+    that wrapped around to the other side of the board.
+
+    full: every point on the board
+    edge: the points on the edge of the board
+    neighbors: for each point's bit index, the bits of its neighbors
+    '''
+    @staticmethod
+    def build(n):
+        full = (1 << (n * n)) - 1
+        first_column = sum(1 << (r * n) for r in range(n))
+        last_column = first_column << (n - 1)
+        first_row = (1 << n) - 1
+        last_row = first_row << (n * (n - 1))
+        masks = BitMasks(n, full, full & ~first_column, full & ~last_column,
+                         first_column | last_column | first_row | last_row, None)
+        return masks._replace(neighbors=tuple(masks.spread(1 << i) for i in range(n * n)))
+
+    def spread(self, bits):
+        'The points next to any of bits.'
+        n = self.n
+        return ((bits >> n) | ((bits << n) & self.full) |
+                ((bits >> 1) & self.not_last_column) | ((bits << 1) & self.not_first_column))
+
+    def diagonal_shifts(self, bits):
+        'bits moved one point along each of the four diagonals.'
+        n = self.n
+        return ((bits >> (n + 1)) & self.not_last_column,
+                (bits >> (n - 1)) & self.not_first_column,
+                (bits << (n + 1)) & self.full & self.not_first_column,
+                (bits << (n - 1)) & self.full & self.not_last_column)
+
+    @staticmethod
+    def from_mask(mask):
+        'The bitboard of the points set in an NxN boolean array.'
+        return int.from_bytes(np.packbits(mask, axis=None, bitorder='little').tobytes(), 'little')
+
+    def to_mask(self, bits):
+        'The NxN boolean array of the points in a bitboard; see from_mask.'
+        n = self.n
+        data = np.frombuffer(bits.to_bytes((n * n + 7) // 8, 'little'), dtype=np.uint8)
+        return np.unpackbits(data, bitorder='little')[:n * n].reshape(n, n).astype(bool)
+
+    def flood_fill(self, seed, within):
+        'The points of within connected to seed.'
+        n, full, not_first_column, not_last_column = self.n, self.full, self.not_first_column, self.not_last_column
+        reached = seed
+        frontier = seed
+        while frontier:
+            # spread(frontier), inlined
+            frontier = ((frontier >> n) | ((frontier << n) & full) |
+                        ((frontier >> 1) & not_last_column) | ((frontier << 1) & not_first_column))
+            frontier &= within & ~reached
+            reached |= frontier
+        return reached
+
+_GEOMETRIES = {}
+_GEOMETRIES_LOCK = threading.Lock()
+
+def get_geometry(n):
+    'Returns the shared BoardGeometry for NxN boards.'
+    geometry = _GEOMETRIES.get(n)
+    if geometry is None:
+        with _GEOMETRIES_LOCK:
+            geometry = _GEOMETRIES.get(n)
+            if geometry is None:
+                geometry = _GEOMETRIES[n] = BoardGeometry.build(n)
+    return geometry
+
+def board_geometry(board):
+    'Returns the BoardGeometry matching a NxN board.'
+    return get_geometry(board.shape[0])
+
+# The default board size, used for new Positions that aren't given a board or
+# a geometry. These are initialized by set_board_size, and mirror the fields
+# of the default BoardGeometry.
 N = None
 ALL_COORDS = []
 EMPTY_BOARD = None
@@ -32,19 +363,28 @@ DIAGONALS = {}
 
 def set_board_size(n):
     '''
-    Hopefully nobody tries to run both 9x9 and 19x19 game instances at once.
-    Also, never do "from go import N, W, ALL_COORDS, EMPTY_BOARD".
+    Sets the default board size. Positions of other sizes are unaffected;
+    code that handles a Position should use position.geometry rather than
+    these globals. Never do "from go import N, W, ALL_COORDS, EMPTY_BOARD".
     '''
     global N, ALL_COORDS, EMPTY_BOARD, NEIGHBORS, DIAGONALS
-    if N == n: return
-    N = n
-    ALL_COORDS = [(i, j) for i in range(n) for j in range(n)]
-    EMPTY_BOARD = np.zeros([n, n], dtype=np.int8)
-    def check_bounds(c):
-        return c[0] % n == c[0] and c[1] % n == c[1]
+    geometry = get_geometry(n)
+    N = geometry.n
+    ALL_COORDS = list(geometry.all_coords)
+    EMPTY_BOARD = geometry.empty_board
+    NEIGHBORS = geometry.neighbors
+    DIAGONALS = geometry.diagonals
+
+def default_geometry():
+    return get_geometry(N)
 
-    NEIGHBORS = {(x, y): list(filter(check_bounds, [(x+1, y), (x-1, y), (x, y+1), (x, y-1)])) for x, y in ALL_COORDS}
-    DIAGONALS = {(x, y): list(filter(check_bounds, [(x+1, y+1), (x+1, y-1), (x-1, y+1), (x-1, y-1)])) for x, y in ALL_COORDS}
+def compute_zobrist_hash(board, to_play=BLACK):
+    'Computes the Zobrist hash of a board from scratch.'
+    geometry = board_geometry(board)
+    board_hash = 0
+    for color in (BLACK, WHITE):
+        board_hash ^= int(np.bitwise_xor.reduce(geometry.zobrist_keys[color][board == color]))
+    return board_hash ^ (geometry.zobrist_white_to_play if to_play == WHITE else 0)
 
 def place_stones(board, color, stones):
     for s in stones:
@@ -52,23 +392,97 @@ def place_stones(board, color, stones):
 
 def find_reached(board, c):
     color = board[c]
+    neighbors = board_geometry(board).neighbors
     chain = set([c])
     reached = set()
     frontier = [c]
     while frontier:
         current = frontier.pop()
         chain.add(current)
-        for n in NEIGHBORS[current]:
+        for n in neighbors[current]:
             if board[n] == color and not n in chain:
                 frontier.append(n)
             elif board[n] != color:
                 reached.add(n)
     return chain, reached
 
+def label_points(flat_board, geometry):
+    '''
+    Labels the connected regions of same-colored points on a flat board,
+    without any per-point Python loop. Every on-board point ends up labeled
+    with the smallest flat index in its region; border points are labeled -1.
+
+    This is the vectorized form of union-find: each round hooks every point
+    onto the smallest label among its same-colored neighbors, then compresses
+    paths by pointer jumping until every label points at a fixed point.
+    '''
+    size = flat_board.shape[0]
+    on_board = flat_board != BORDER
+    # Each same-colored adjacent pair once, as (lower index, higher index).
+    edges = []
+    for offset in (1, geometry.padded_n):
+        lower = np.arange(size - offset)
+        higher = lower + offset
+        same_color = on_board[lower] & (flat_board[lower] == flat_board[higher])
+        edges.append((lower[same_color], higher[same_color]))
+
+    labels = np.arange(size)
+    while True:
+        hooked = labels.copy()
+        for lower, higher in edges:
+            # Within one edge list, every point appears at most once on each
+            # side, so these fancy-indexed assignments don't collide.
+            hooked[lower] = np.minimum(hooked[lower], labels[higher])
+            hooked[higher] = np.minimum(hooked[higher], labels[lower])
+        while True:
+            jumped = hooked[hooked]
+            if np.array_equal(jumped, hooked):
+                break
+            hooked = jumped
+        if np.array_equal(hooked, labels):
+            break
+        labels = hooked
+    labels[~on_board] = -1
+    return labels
+
+def split_list(items, starts):
+    'Splits items into consecutive pieces beginning at each of starts.'
+    ends = starts[1:] + [len(items)]
+    return [items[start:end] for start, end in zip(starts, ends)]
+
+def find_groups(flat_board, geometry):
+    '''
+    Finds every group of stones on a flat board in one vectorized pass.
+    Returns (labels, roots, group_stones, group_liberties), where labels is
+    from label_points, roots is the sorted array of group labels, and
+    group_stones[i] and group_liberties[i] are sorted lists of the flat
+    indices of the stones and liberties of the group labeled roots[i].
+    '''
+    size = flat_board.shape[0]
+    labels = label_points(flat_board, geometry)
+    stones = np.flatnonzero((flat_board == BLACK) | (flat_board == WHITE))
+    stone_labels = labels[stones]
+    order = np.argsort(stone_labels, kind='mergesort')
+    roots, group_starts = np.unique(stone_labels[order], return_index=True)
+    # Slicing plain lists is much cheaper than np.split for many tiny groups.
+    group_stones = split_list(stones[order].tolist(), group_starts.tolist())
+
+    # Each (group label, adjacent empty point) pair, deduplicated via a
+    # combined sort key.
+    liberty_keys = []
+    for offset in geometry.flat_neighbor_offsets:
+        neighbors = stones + offset
+        is_liberty = flat_board[neighbors] == EMPTY
+        liberty_keys.append(stone_labels[is_liberty] * size + neighbors[is_liberty])
+    liberty_keys = np.unique(np.concatenate(liberty_keys))
+    liberty_labels, liberties = np.divmod(liberty_keys, size)
+    group_liberties = split_list(liberties.tolist(), np.searchsorted(liberty_labels, roots).tolist())
+    return labels, roots, group_stones, group_liberties
+
 def is_koish(board, c):
     'Check if c is surrounded on all sides by 1 color, and return that color'
     if board[c] != EMPTY: return None
-    neighbors = {board[n] for n in NEIGHBORS[c]}
+    neighbors = {board[n] for n in board_geometry(board).neighbors[c]}
     if len(neighbors) == 1 and not EMPTY in neighbors:
         return list(neighbors)[0]
     else:
@@ -80,7 +494,7 @@ def is_eyeish(board, c):
     if color is None:
         return None
     diagonal_faults = 0
-    diagonals = DIAGONALS[c]
+    diagonals = board_geometry(board).diagonals[c]
     if len(diagonals) < 4:
         diagonal_faults += 1
     for d in diagonals:
@@ -100,85 +514,63 @@ class Group(namedtuple('Group', ['id', 'stones', 'liberties', 'color'])):
     def __eq__(self, other):
         return self.stones == other.stones and self.liberties == other.liberties and self.color == other.color
 
+def liberty_bucket(group):
+    'Which of groups_by_liberties a group belongs in: its liberty count, up to 3.'
+    return min(len(group.liberties), 3)
 
-class LibertyTracker():
-    @staticmethod
-    def from_board(board):
-        board = np.copy(board)
-        curr_group_id = 0
-        lib_tracker = LibertyTracker()
-        for color in (WHITE, BLACK):
-            while color in board:
-                curr_group_id += 1
-                found_color = np.where(board == color)
-                coord = found_color[0][0], found_color[1][0]
-                chain, reached = find_reached(board, coord)
-                liberties = set(r for r in reached if board[r] == EMPTY)
-                new_group = Group(curr_group_id, chain, liberties, color)
-                lib_tracker.groups[curr_group_id] = new_group
-                for s in chain:
-                    lib_tracker.group_index[s] = curr_group_id
-                place_stones(board, FILL, chain)
-
-        lib_tracker.max_group_id = curr_group_id
-
-        liberty_counts = np.zeros([N, N], dtype=np.uint8)
-        for group in lib_tracker.groups.values():
-            num_libs = len(group.liberties)
-            for s in group.stones:
-                liberty_counts[s] = num_libs
-        lib_tracker.liberty_cache = liberty_counts
-
-        return lib_tracker
 
-    def __init__(self, group_index=None, groups=None, liberty_cache=None, max_group_id=1):
-        # group_index: a NxN numpy array of group_ids. -1 means no group
-        # groups: a dict of group_id to groups
-        # liberty_cache: a NxN numpy array of liberty counts
-        self.group_index = group_index if group_index is not None else -np.ones([N, N], dtype=np.int16)
-        self.groups = groups or {}
-        self.liberty_cache = liberty_cache if liberty_cache is not None else np.zeros([N, N], dtype=np.uint8)
-        self.max_group_id = max_group_id
+class GroupBookkeeping():
+    '''
+    The group bookkeeping shared by LibertyTracker and FlatLibertyTracker:
+    playing a stone, merging and capturing groups, the liberty buckets, and
+    the journal that push_stone and pop_stone use to undo a move.
 
-    def __deepcopy__(self, memodict={}):
-        new_group_index = np.copy(self.group_index)
-        new_lib_cache = np.copy(self.liberty_cache)
-        new_groups = {
-            group.id: Group(group.id, set(group.stones), set(group.liberties), group.color)
-            for group in self.groups.values()
-        }
-        return LibertyTracker(new_group_index, new_groups, liberty_cache=new_lib_cache, max_group_id=self.max_group_id)
+    It works on "points", whatever a subclass indexes its per-point state
+    with: Coordinates for LibertyTracker, flat indices for
+    FlatLibertyTracker. A subclass keeps
+        _groups: a dict of group_id to Group, whose stones and liberties are points
+        _group_index: the group_id at each point, MISSING_GROUP_ID for none
+        _liberty_cache: the liberty count of the group at each point
+    and provides its neighbor iteration and coordinate conversion:
+        _to_point(c) and _to_coords(points), at the API boundary
+        _neighbors(p), the points next to p
+        _classify_neighbors(color, p), the (friendly group_ids,
+            opponent group_ids, empty points) next to p
+        _paint(stones, color), to update any board of its own
+    '''
+    def _bucket_groups(self):
+        # For each color, groups_by_liberties[color][k] is the set of group_ids
+        # with k liberties, where k = 3 means 3 or more. Kept up to date as
+        # liberties change, so that groups in atari can be found without
+        # looking at every group.
+        groups_by_liberties = {BLACK: [set() for _ in range(4)], WHITE: [set() for _ in range(4)]}
+        for group in self._groups.values():
+            groups_by_liberties[group.color][liberty_bucket(group)].add(group.id)
+        return groups_by_liberties
 
     def add_stone(self, color, c):
-        assert self.group_index[c] == MISSING_GROUP_ID
-        captured_stones = set()
-        opponent_neighboring_group_ids = set()
-        friendly_neighboring_group_ids = set()
-        empty_neighbors = set()
+        return self._to_coords(self._add_stone_at(color, self._to_point(c)))
 
-        for n in NEIGHBORS[c]:
-            neighbor_group_id = self.group_index[n]
-            if neighbor_group_id != MISSING_GROUP_ID:
-                neighbor_group = self.groups[neighbor_group_id]
-                if neighbor_group.color == color:
-                    friendly_neighboring_group_ids.add(neighbor_group_id)
-                else:
-                    opponent_neighboring_group_ids.add(neighbor_group_id)
-            else:
-                empty_neighbors.add(n)
+    def stones_at(self, c):
+        'Returns the stones of the group with a stone at c. Do not modify it.'
+        return self._to_coords(self._groups[self._group_index[self._to_point(c)]].stones)
+
+    def _add_stone_at(self, color, p):
+        assert self._group_index[p] == MISSING_GROUP_ID
+        captured_stones = set()
+        friendly_neighboring_group_ids, opponent_neighboring_group_ids, empty_neighbors = self._classify_neighbors(color, p)
 
-        new_group = self._create_group(color, c, empty_neighbors)
+        new_group = self._create_group(color, {p}, empty_neighbors)
 
         for group_id in friendly_neighboring_group_ids:
             new_group = self._merge_groups(group_id, new_group.id)
 
         for group_id in opponent_neighboring_group_ids:
-            neighbor_group = self.groups[group_id]
+            neighbor_group = self._groups[group_id]
             if len(neighbor_group.liberties) == 1:
-                captured = self._capture_group(group_id)
-                captured_stones.update(captured)
+                captured_stones.update(self._capture_group(group_id))
             else:
-                self._update_liberties(group_id, remove={c})
+                self._update_liberties(group_id, remove={p})
 
         self._handle_captures(captured_stones)
 
@@ -188,77 +580,1070 @@ class LibertyTracker():
 
         return captured_stones
 
-    def _create_group(self, color, c, liberties):
+    def push_stone(self, color, c):
+        '''
+        Like add_stone, but also returns an undo record that pop_stone can use
+        to revert the move. Only the groups touched by the move are saved.
+        '''
+        # While push_stone is running, _journal maps each touched group_id to
+        # a copy of the group as it was before the move, or None for new groups.
+        self._journal = {}
+        max_group_id = self.max_group_id
+        p = self._to_point(c)
+        try:
+            captured_stones = self._add_stone_at(color, p)
+        finally:
+            journal, self._journal = self._journal, None
+        return self._to_coords(captured_stones), (p, max_group_id, journal)
+
+    def pop_stone(self, undo):
+        p, max_group_id, journal = undo
+        for group_id in journal:
+            group = self._groups.pop(group_id, None)
+            if group is not None:
+                self.groups_by_liberties[group.color][liberty_bucket(group)].discard(group_id)
+        group_index = self._group_index
+        liberty_cache = self._liberty_cache
+        for group in journal.values():
+            if group is None:
+                continue
+            self._groups[group.id] = group
+            self.groups_by_liberties[group.color][liberty_bucket(group)].add(group.id)
+            self._paint(group.stones, group.color)
+            num_libs = len(group.liberties)
+            for s in group.stones:
+                group_index[s] = group.id
+                liberty_cache[s] = num_libs
+        self._paint((p,), EMPTY)
+        group_index[p] = MISSING_GROUP_ID
+        liberty_cache[p] = 0
+        self.max_group_id = max_group_id
+
+    def _save_group(self, group_id):
+        if self._journal is not None and group_id not in self._journal:
+            group = self._groups[group_id]
+            self._journal[group_id] = Group(group.id, set(group.stones), set(group.liberties), group.color)
+
+    def _create_group(self, color, stones, liberties):
         self.max_group_id += 1
-        new_group = Group(self.max_group_id, set([c]), liberties, color)
-        self.groups[new_group.id] = new_group
-        self.group_index[c] = new_group.id
-        self.liberty_cache[c] = len(liberties)
+        if self._journal is not None:
+            self._journal[self.max_group_id] = None
+        new_group = Group(self.max_group_id, stones, liberties, color)
+        self._groups[new_group.id] = new_group
+        self.groups_by_liberties[color][liberty_bucket(new_group)].add(new_group.id)
+        self._paint(stones, color)
+        num_libs = len(liberties)
+        for s in stones:
+            self._group_index[s] = new_group.id
+            self._liberty_cache[s] = num_libs
         return new_group
 
     def _merge_groups(self, group1_id, group2_id):
-        group1 = self.groups[group1_id]
-        group2 = self.groups[group2_id]
+        self._save_group(group1_id)
+        self._save_group(group2_id)
+        group1 = self._groups[group1_id]
+        group2 = self._groups.pop(group2_id)
+        self.groups_by_liberties[group2.color][liberty_bucket(group2)].discard(group2_id)
         group1.stones.update(group2.stones)
-        del self.groups[group2_id]
         for s in group2.stones:
-            self.group_index[s] = group1_id
+            self._group_index[s] = group1_id
 
         self._update_liberties(group1_id, add=group2.liberties, remove=(group2.stones | group1.stones))
-
         return group1
 
     def _capture_group(self, group_id):
-        dead_group = self.groups[group_id]
-        del self.groups[group_id]
+        self._save_group(group_id)
+        dead_group = self._groups.pop(group_id)
+        self.groups_by_liberties[dead_group.color][liberty_bucket(dead_group)].discard(group_id)
+        self._paint(dead_group.stones, EMPTY)
         for s in dead_group.stones:
-            self.group_index[s] = MISSING_GROUP_ID
-            self.liberty_cache[s] = 0
+            self._group_index[s] = MISSING_GROUP_ID
+            self._liberty_cache[s] = 0
         return dead_group.stones
 
     def _update_liberties(self, group_id, add=None, remove=None):
-        group = self.groups[group_id]
+        self._save_group(group_id)
+        group = self._groups[group_id]
+        old_bucket = liberty_bucket(group)
         if add:
             group.liberties.update(add)
         if remove:
             group.liberties.difference_update(remove)
+        self._rebucket(group, old_bucket)
 
         new_lib_count = len(group.liberties)
+        liberty_cache = self._liberty_cache
         for s in group.stones:
-            self.liberty_cache[s] = new_lib_count
+            liberty_cache[s] = new_lib_count
+
+    def _rebucket(self, group, old_bucket):
+        new_bucket = liberty_bucket(group)
+        if new_bucket != old_bucket:
+            buckets = self.groups_by_liberties[group.color]
+            buckets[old_bucket].discard(group.id)
+            buckets[new_bucket].add(group.id)
 
     def _handle_captures(self, captured_stones):
+        group_index = self._group_index
         for s in captured_stones:
-            for n in NEIGHBORS[s]:
-                group_id = self.group_index[n]
+            for n in self._neighbors(s):
+                group_id = group_index[n]
                 if group_id != MISSING_GROUP_ID:
                     self._update_liberties(group_id, add={s})
 
+class LibertyTracker(GroupBookkeeping):
+    @staticmethod
+    def from_board(board):
+        geometry = board_geometry(board)
+        flat_board = geometry.to_flat_board(board)
+        labels, roots, group_stones, group_liberties = find_groups(flat_board, geometry)
+
+        # group ids are 1, 2, ... in order of roots
+        flat_group_index = np.full(flat_board.shape, MISSING_GROUP_ID, dtype=np.int16)
+        flat_liberty_cache = np.zeros(flat_board.shape, dtype=np.uint8)
+        is_stone = (flat_board == BLACK) | (flat_board == WHITE)
+        group_ids = np.searchsorted(roots, labels[is_stone])
+        liberty_counts = np.array([len(libs) for libs in group_liberties], dtype=np.uint8)
+        flat_group_index[is_stone] = group_ids + 1
+        flat_liberty_cache[is_stone] = liberty_counts[group_ids]
+
+        groups = {}
+        for group_id, (stones, liberties) in enumerate(zip(group_stones, group_liberties), 1):
+            groups[group_id] = Group(
+                group_id,
+                {geometry.flat_coords[s] for s in stones},
+                {geometry.flat_coords[l] for l in liberties},
+                int(flat_board[stones[0]]))
+        return LibertyTracker(geometry.unpad(flat_group_index).copy(), groups,
+                              liberty_cache=geometry.unpad(flat_liberty_cache).copy(),
+                              max_group_id=len(roots), geometry=geometry)
+
+    def __init__(self, group_index=None, groups=None, liberty_cache=None, max_group_id=1, geometry=None):
+        # group_index: a NxN numpy array of group_ids. -1 means no group
+        # groups: a dict of group_id to groups
+        # liberty_cache: a NxN numpy array of liberty counts
+        # geometry: the BoardGeometry of the board; defaults to the default board size
+        self.geometry = geometry or default_geometry()
+        n = self.geometry.n
+        self._group_index = group_index if group_index is not None else -np.ones([n, n], dtype=np.int16)
+        self._groups = groups or {}
+        self._liberty_cache = liberty_cache if liberty_cache is not None else np.zeros([n, n], dtype=np.uint8)
+        self.max_group_id = max_group_id
+        self.groups_by_liberties = self._bucket_groups()
+        self._journal = None
+
+    # Points are Coordinates, so the bookkeeping's own state is the API.
+    @property
+    def group_index(self):
+        return self._group_index
+
+    @property
+    def liberty_cache(self):
+        return self._liberty_cache
+
+    @property
+    def groups(self):
+        return self._groups
+
+    def groups_in_atari(self, color):
+        'The groups of color with exactly one liberty.'
+        return [self._groups[group_id] for group_id in self.groups_by_liberties[color][1]]
+
+    def __deepcopy__(self, memodict={}):
+        new_group_index = np.copy(self._group_index)
+        new_lib_cache = np.copy(self._liberty_cache)
+        new_groups = {
+            group.id: Group(group.id, set(group.stones), set(group.liberties), group.color)
+            for group in self._groups.values()
+        }
+        return LibertyTracker(new_group_index, new_groups, liberty_cache=new_lib_cache, max_group_id=self.max_group_id,
+                              geometry=self.geometry)
+
+    def is_move_suicidal(self, color, c):
+        potential_libs = set()
+        for n in self.geometry.neighbors[c]:
+            neighbor_group_id = self._group_index[n]
+            if neighbor_group_id == MISSING_GROUP_ID:
+                # at least one liberty after playing here, so not a suicide
+                return False
+            neighbor_group = self._groups[neighbor_group_id]
+            if neighbor_group.color == color:
+                potential_libs |= neighbor_group.liberties
+            elif len(neighbor_group.liberties) == 1:
+                # would capture an opponent group if they only had one lib.
+                return False
+        # it's possible to suicide by connecting several friendly groups
+        # each of which had one liberty.
+        potential_libs -= set([c])
+        return not potential_libs
+
+    def liberties_at(self, c):
+        'Returns the liberties of the group with a stone at c. Do not modify it.'
+        return self._groups[self._group_index[c]].liberties
+
+    def would_capture(self, color, c):
+        'Returns the set of opponent stones that would be captured by color playing at c.'
+        captured_stones = set()
+        for n in self.geometry.neighbors[c]:
+            neighbor_group_id = self._group_index[n]
+            if neighbor_group_id != MISSING_GROUP_ID:
+                neighbor_group = self._groups[neighbor_group_id]
+                if neighbor_group.color != color and len(neighbor_group.liberties) == 1:
+                    captured_stones |= neighbor_group.stones
+        return captured_stones
+
+    def _to_point(self, c):
+        return c
+
+    def _to_coords(self, points):
+        return points
+
+    def _neighbors(self, c):
+        return self.geometry.neighbors[c]
+
+    def _classify_neighbors(self, color, c):
+        friendly_group_ids = set()
+        opponent_group_ids = set()
+        empty_neighbors = set()
+        for n in self.geometry.neighbors[c]:
+            neighbor_group_id = self._group_index[n]
+            if neighbor_group_id != MISSING_GROUP_ID:
+                if self._groups[neighbor_group_id].color == color:
+                    friendly_group_ids.add(neighbor_group_id)
+                else:
+                    opponent_group_ids.add(neighbor_group_id)
+            else:
+                empty_neighbors.add(n)
+        return friendly_group_ids, opponent_group_ids, empty_neighbors
+
+    def _paint(self, stones, color):
+        # the Position's board is the only board
+        pass
+
+class FlatLibertyTracker(GroupBookkeeping):
+    '''
+    A LibertyTracker that works on a flat board with a sentinel border.
+
+    Internally, points are flat indices (see BoardGeometry), so finding
+    neighbors is integer addition and off-board points are recognized by their
+    BORDER color. The per-point state is kept in plain lists, since indexing a
+    list with an int is much cheaper than indexing a numpy array with a tuple.
+    Coordinates are only used at the API boundary: add_stone and
+    is_move_suicidal accept them, and group_index, liberty_cache and groups
+    expose the same NxN arrays / Coordinate sets as LibertyTracker.
+    '''
+    @staticmethod
+    def from_board(board):
+        geometry = board_geometry(board)
+        flat_board = geometry.to_flat_board(board)
+        labels, roots, group_stones, group_liberties = find_groups(flat_board, geometry)
+        lib_tracker = FlatLibertyTracker(flat_board.tolist(), geometry=geometry)
+        for stones, liberties in zip(group_stones, group_liberties):
+            lib_tracker._create_group(int(flat_board[stones[0]]), set(stones), set(liberties))
+        return lib_tracker
+
+    def __init__(self, board=None, group_index=None, groups=None, liberty_cache=None, max_group_id=1, geometry=None):
+        # board: a flat list of colors, with a BORDER around the edge
+        # group_index: a flat list of group_ids. -1 means no group
+        # groups: a dict of group_id to groups, whose stones and liberties are flat indices
+        # liberty_cache: a flat list of liberty counts
+        # geometry: the BoardGeometry of the board; defaults to the default board size
+        self.geometry = geometry or default_geometry()
+        size = self.geometry.padded_n ** 2
+        self.board = board if board is not None else self.geometry.empty_flat_board.tolist()
+        self._group_index = group_index if group_index is not None else [MISSING_GROUP_ID] * size
+        self._groups = groups or {}
+        self._liberty_cache = liberty_cache if liberty_cache is not None else [0] * size
+        self.max_group_id = max_group_id
+        self.groups_by_liberties = self._bucket_groups()
+        self._journal = None
+
+    def __deepcopy__(self, memodict={}):
+        new_groups = {
+            group.id: Group(group.id, set(group.stones), set(group.liberties), group.color)
+            for group in self._groups.values()
+        }
+        return FlatLibertyTracker(list(self.board), list(self._group_index), new_groups,
+            liberty_cache=list(self._liberty_cache), max_group_id=self.max_group_id, geometry=self.geometry)
+
+    @property
+    def group_index(self):
+        return np.array(self._group_index, dtype=np.int16)[self.geometry.flat_index]
+
+    @property
+    def liberty_cache(self):
+        return np.array(self._liberty_cache, dtype=np.uint8)[self.geometry.flat_index]
+
+    @property
+    def groups(self):
+        flat_coords = self.geometry.flat_coords
+        return {
+            group.id: Group(group.id,
+                            {flat_coords[s] for s in group.stones},
+                            {flat_coords[l] for l in group.liberties},
+                            group.color)
+            for group in self._groups.values()
+        }
+
+    def groups_in_atari(self, color):
+        'The groups of color with exactly one liberty.'
+        flat_coords = self.geometry.flat_coords
+        atari_groups = (self._groups[group_id] for group_id in self.groups_by_liberties[color][1])
+        return [Group(group.id,
+                      {flat_coords[s] for s in group.stones},
+                      {flat_coords[l] for l in group.liberties},
+                      group.color)
+                for group in atari_groups]
+
+    def is_move_suicidal(self, color, c):
+        f = self.geometry.flat_index.item(c)
+        board = self.board
+        potential_libs = set()
+        for offset in self.geometry.flat_neighbor_offsets:
+            n = f + offset
+            neighbor_color = board[n]
+            if neighbor_color == EMPTY:
+                return False
+            if neighbor_color == BORDER:
+                continue
+            neighbor_group = self._groups[self._group_index[n]]
+            if neighbor_color == color:
+                potential_libs |= neighbor_group.liberties
+            elif len(neighbor_group.liberties) == 1:
+                return False
+        potential_libs.discard(f)
+        return not potential_libs
+
+    def liberties_at(self, c):
+        group = self._groups[self._group_index[self.geometry.flat_index.item(c)]]
+        return {self.geometry.flat_coords[l] for l in group.liberties}
+
+    def would_capture(self, color, c):
+        f = self.geometry.flat_index.item(c)
+        captured_stones = set()
+        for offset in self.geometry.flat_neighbor_offsets:
+            n = f + offset
+            if self.board[n] == -color:
+                neighbor_group = self._groups[self._group_index[n]]
+                if len(neighbor_group.liberties) == 1:
+                    captured_stones |= neighbor_group.stones
+        return {self.geometry.flat_coords[s] for s in captured_stones}
+
+    def _to_point(self, c):
+        return self.geometry.flat_index.item(c)
+
+    def _to_coords(self, points):
+        flat_coords = self.geometry.flat_coords
+        return {flat_coords[s] for s in points}
+
+    def _neighbors(self, f):
+        # off-board points have no group, like empty ones
+        return [f + offset for offset in self.geometry.flat_neighbor_offsets]
+
+    def _classify_neighbors(self, color, f):
+        board = self.board
+        group_index = self._group_index
+        friendly_group_ids = set()
+        opponent_group_ids = set()
+        empty_neighbors = set()
+        for offset in self.geometry.flat_neighbor_offsets:
+            n = f + offset
+            neighbor_color = board[n]
+            if neighbor_color == EMPTY:
+                empty_neighbors.add(n)
+            elif neighbor_color == color:
+                friendly_group_ids.add(group_index[n])
+            elif neighbor_color != BORDER:
+                opponent_group_ids.add(group_index[n])
+        return friendly_group_ids, opponent_group_ids, empty_neighbors
+
+    def _paint(self, stones, color):
+        board = self.board
+        for s in stones:
+            board[s] = color
+
+def popcount(bits):
+    return bin(bits).count('1')
+
+def iter_bits(bits):
+    'Yields the indices of the set bits of a Python int, lowest first.'
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+class ArrayLibertyTracker():
+    '''
+    A LibertyTracker built from flat arrays instead of sets, on the same
+    padded board as FlatLibertyTracker.
+
+    A group is identified by its root, one of its stones' flat index. root[s]
+    is the root of the group containing s (-1 for empty or border points), and
+    next_stone links each group's stones into a circular list. A group's
+    liberties are a bitset (a Python int, with bit f set for flat index f), so
+    merging groups is a bitwise or, and counting liberties is a popcount.
+    Liberty counts are never written out per stone; liberty_cache computes
+    them on demand.
+
+    All state lives in a handful of flat lists, so copying a tracker is a few
+    list copies.
+    '''
+    @staticmethod
+    def from_board(board):
+        geometry = board_geometry(board)
+        flat_board = geometry.to_flat_board(board)
+        labels, roots, group_stones, group_liberties = find_groups(flat_board, geometry)
+        # Link each group's stones (sorted by flat index) into a circle.
+        next_stone = [0] * flat_board.shape[0]
+        for stones in group_stones:
+            for s, next_s in zip(stones, stones[1:] + stones[:1]):
+                next_stone[s] = next_s
+        liberties = [0] * flat_board.shape[0]
+        num_stones = [0] * flat_board.shape[0]
+        for group_root, stones, group_liberties in zip(roots.tolist(), group_stones, group_liberties):
+            liberties[group_root] = sum(1 << l for l in group_liberties)
+            num_stones[group_root] = len(stones)
+        is_stone = (flat_board == BLACK) | (flat_board == WHITE)
+        root = np.where(is_stone, labels, MISSING_GROUP_ID)
+        return ArrayLibertyTracker(flat_board.tolist(), root.tolist(), next_stone, liberties, num_stones, geometry=geometry)
+
+    def __init__(self, board=None, root=None, next_stone=None, liberties=None, num_stones=None, geometry=None):
+        # board: a flat list of colors, with a BORDER around the edge
+        # root: a flat list of group roots. -1 means no group
+        # next_stone: a flat list linking each group's stones in a circle
+        # liberties: a flat list of liberty bitsets, valid at group roots
+        # num_stones: a flat list of group sizes, valid at group roots
+        # geometry: the BoardGeometry of the board; defaults to the default board size
+        self.geometry = geometry or default_geometry()
+        size = self.geometry.padded_n ** 2
+        self.board = board if board is not None else self.geometry.empty_flat_board.tolist()
+        self.root = root if root is not None else [MISSING_GROUP_ID] * size
+        self.next_stone = next_stone if next_stone is not None else [0] * size
+        self.liberties = liberties if liberties is not None else [0] * size
+        self.num_stones = num_stones if num_stones is not None else [0] * size
+        # While push_stone is running, maps each touched group root to its
+        # (stones, liberties, color) before the move; see LibertyTracker._journal.
+        self._journal = None
+
+    def _state(self):
+        return self.board, self.root, self.next_stone, self.liberties, self.num_stones
+
+    def __deepcopy__(self, memodict={}):
+        return ArrayLibertyTracker(*[list(l) for l in self._state()], geometry=self.geometry)
+
+    def group_stones(self, group_root):
+        'Yields the flat indices of the stones in a group.'
+        s = group_root
+        while True:
+            yield s
+            s = self.next_stone[s]
+            if s == group_root:
+                break
+
+    def group_roots(self):
+        return [f for f, r in enumerate(self.root) if r == f]
+
+    @property
+    def group_index(self):
+        return np.array(self.root, dtype=np.int16)[self.geometry.flat_index]
+
+    @property
+    def liberty_cache(self):
+        lib_counts = np.zeros([self.geometry.padded_n ** 2 + 1], dtype=np.uint8)
+        for r in self.group_roots():
+            lib_counts[r] = popcount(self.liberties[r])
+        # empty points have root -1, which picks up the trailing 0.
+        return lib_counts[np.array(self.root)][self.geometry.flat_index]
+
+    @property
+    def groups(self):
+        flat_coords = self.geometry.flat_coords
+        return {
+            r: Group(r,
+                     {flat_coords[s] for s in self.group_stones(r)},
+                     {flat_coords[l] for l in iter_bits(self.liberties[r])},
+                     self.board[r])
+            for r in self.group_roots()
+        }
+
+    def is_move_suicidal(self, color, c):
+        f = self.geometry.flat_index.item(c)
+        bit = 1 << f
+        board = self.board
+        for offset in self.geometry.flat_neighbor_offsets:
+            n = f + offset
+            neighbor_color = board[n]
+            if neighbor_color == EMPTY:
+                return False
+            if neighbor_color == BORDER:
+                continue
+            neighbor_libs = self.liberties[self.root[n]]
+            if neighbor_color == color:
+                # connecting to a group with some other liberty
+                if neighbor_libs & ~bit:
+                    return False
+            elif neighbor_libs == bit:
+                # capturing an opponent group in atari
+                return False
+        return True
+
+    def groups_in_atari(self, color):
+        'The groups of color with exactly one liberty.'
+        flat_coords = self.geometry.flat_coords
+        liberties = self.liberties
+        return [Group(r,
+                      {flat_coords[s] for s in self.group_stones(r)},
+                      {flat_coords[liberties[r].bit_length() - 1]},
+                      color)
+                for r in self.group_roots()
+                if self.board[r] == color and liberties[r] and liberties[r] & (liberties[r] - 1) == 0]
+
+    def liberties_at(self, c):
+        group_root = self.root[self.geometry.flat_index.item(c)]
+        return {self.geometry.flat_coords[l] for l in iter_bits(self.liberties[group_root])}
+
+    def stones_at(self, c):
+        group_root = self.root[self.geometry.flat_index.item(c)]
+        return {self.geometry.flat_coords[s] for s in self.group_stones(group_root)}
+
+    def would_capture(self, color, c):
+        f = self.geometry.flat_index.item(c)
+        bit = 1 << f
+        captured_stones = set()
+        for offset in self.geometry.flat_neighbor_offsets:
+            n = f + offset
+            if self.board[n] == -color and self.liberties[self.root[n]] == bit:
+                captured_stones.update(self.geometry.flat_coords[s] for s in self.group_stones(self.root[n]))
+        return captured_stones
+
+    def add_stone(self, color, c):
+        captured_stones = self.add_flat_stone(color, self.geometry.flat_index.item(c))
+        return {self.geometry.flat_coords[s] for s in captured_stones}
+
+    def push_stone(self, color, c):
+        'See LibertyTracker.push_stone.'
+        f = self.geometry.flat_index.item(c)
+        # the new stone's group is created by the move, so it is never saved.
+        self._journal = {f: None}
+        try:
+            captured_stones = self.add_flat_stone(color, f)
+        finally:
+            journal, self._journal = self._journal, None
+        return {self.geometry.flat_coords[s] for s in captured_stones}, (f, journal)
+
+    def pop_stone(self, undo):
+        f, journal = undo
+        for group_root, saved_group in journal.items():
+            if saved_group is None:
+                continue
+            stones, liberties, color = saved_group
+            for s in stones:
+                self.board[s] = color
+            self._create_group(group_root, stones, liberties)
+        self.board[f] = EMPTY
+        self.root[f] = MISSING_GROUP_ID
+
+    def _save_group(self, group_root):
+        if self._journal is not None and group_root not in self._journal:
+            self._journal[group_root] = (list(self.group_stones(group_root)), self.liberties[group_root], self.board[group_root])
+
+    def add_flat_stone(self, color, f):
+        board = self.board
+        root = self.root
+        liberties = self.liberties
+        assert board[f] == EMPTY
+        bit = 1 << f
+        new_liberties = 0
+        friendly_roots = set()
+        opponent_roots = set()
+        for offset in self.geometry.flat_neighbor_offsets:
+            n = f + offset
+            neighbor_color = board[n]
+            if neighbor_color == EMPTY:
+                new_liberties |= 1 << n
+            elif neighbor_color == color:
+                friendly_roots.add(root[n])
+            elif neighbor_color != BORDER:
+                opponent_roots.add(root[n])
+
+        for group_root in friendly_roots | opponent_roots:
+            self._save_group(group_root)
+
+        board[f] = color
+        self._create_group(f, [f], new_liberties)
+        group_root = f
+        for friendly_root in friendly_roots:
+            group_root = self._merge_groups(group_root, friendly_root)
+        liberties[group_root] &= ~bit
+
+        captured_stones = []
+        for opponent_root in opponent_roots:
+            liberties[opponent_root] &= ~bit
+            if not liberties[opponent_root]:
+                captured_stones.extend(self._capture_group(opponent_root))
+
+        # suicide is illegal
+        if not liberties[group_root]:
+            raise IllegalMove
+
+        return captured_stones
+
+    def _create_group(self, group_root, stones, liberties):
+        stones = list(stones)
+        for s, next_s in zip(stones, stones[1:] + stones[:1]):
+            self.root[s] = group_root
+            self.next_stone[s] = next_s
+        self.liberties[group_root] = liberties
+        self.num_stones[group_root] = len(stones)
+
+    def _merge_groups(self, root1, root2):
+        'Merges the smaller group into the larger one, and returns the surviving root.'
+        if self.num_stones[root1] < self.num_stones[root2]:
+            root1, root2 = root2, root1
+        for s in self.group_stones(root2):
+            self.root[s] = root1
+        # splice the two circular lists together
+        next_stone = self.next_stone
+        next_stone[root1], next_stone[root2] = next_stone[root2], next_stone[root1]
+        self.num_stones[root1] += self.num_stones[root2]
+        self.liberties[root1] |= self.liberties[root2]
+        return root1
+
+    def _capture_group(self, group_root):
+        board = self.board
+        root = self.root
+        liberties = self.liberties
+        captured_stones = list(self.group_stones(group_root))
+        for s in captured_stones:
+            board[s] = EMPTY
+            root[s] = MISSING_GROUP_ID
+        for s in captured_stones:
+            bit = 1 << s
+            for offset in self.geometry.flat_neighbor_offsets:
+                neighbor_root = root[s + offset]
+                if neighbor_root != MISSING_GROUP_ID:
+                    self._save_group(neighbor_root)
+                    liberties[neighbor_root] |= bit
+        return captured_stones
+
+class BitboardLibertyTracker():
+    '''
+    A LibertyTracker that keeps no groups at all: the board is just two
+    bitboards (see BitMasks), one for each color's stones.
+
+    Groups are found when they are needed, by flood filling through the
+    stones of one color, and a group's liberties are the empty points next to
+    it. Each flood fill step is a few shifts and ands of a N*N bit integer,
+    so this is cheap for the handful of groups next to a move. Undoing a move
+    is just restoring the two ints.
+
+    group ids are the bit index of the group's first stone.
+    '''
+    @staticmethod
+    def from_board(board):
+        geometry = board_geometry(board)
+        black = sum(1 << int(i) for i in np.flatnonzero(board == BLACK))
+        white = sum(1 << int(i) for i in np.flatnonzero(board == WHITE))
+        return BitboardLibertyTracker(black, white, geometry=geometry)
+
+    def __init__(self, black=0, white=0, geometry=None):
+        # black, white: bitboards of each color's stones
+        # geometry: the BoardGeometry of the board; defaults to the default board size
+        self.geometry = geometry or default_geometry()
+        self.black = black
+        self.white = white
+
+    def __deepcopy__(self, memodict={}):
+        return BitboardLibertyTracker(self.black, self.white, geometry=self.geometry)
+
+    def stones(self, color):
+        return self.black if color == BLACK else self.white
+
+    def empty(self):
+        return self.geometry.bit_masks.full & ~(self.black | self.white)
+
+    def group_at(self, i):
+        'The bitboard of the group with a stone at bit index i.'
+        bit = 1 << i
+        return self.geometry.bit_masks.flood_fill(bit, self.black if self.black & bit else self.white)
+
+    def group_liberties(self, group):
+        return self.geometry.bit_masks.spread(group) & self.empty()
+
+    def _coords(self, bits):
+        all_coords = self.geometry.all_coords
+        return {all_coords[i] for i in iter_bits(bits)}
+
+    def _all_groups(self):
+        'Yields the bitboard of every group on the board.'
+        remaining = self.black | self.white
+        while remaining:
+            group = self.group_at((remaining & -remaining).bit_length() - 1)
+            remaining &= ~group
+            yield group
+
+    @property
+    def groups(self):
+        groups = {}
+        for group in self._all_groups():
+            group_id = (group & -group).bit_length() - 1
+            groups[group_id] = Group(group_id, self._coords(group), self._coords(self.group_liberties(group)),
+                                     BLACK if group & self.black else WHITE)
+        return groups
+
+    @property
+    def group_index(self):
+        n = self.geometry.n
+        group_index = np.full([n * n], MISSING_GROUP_ID, dtype=np.int16)
+        for group in self._all_groups():
+            group_index[list(iter_bits(group))] = (group & -group).bit_length() - 1
+        return group_index.reshape(n, n)
+
+    @property
+    def liberty_cache(self):
+        n = self.geometry.n
+        liberty_cache = np.zeros([n * n], dtype=np.uint8)
+        for group in self._all_groups():
+            liberty_cache[list(iter_bits(group))] = popcount(self.group_liberties(group))
+        return liberty_cache.reshape(n, n)
+
+    def groups_in_atari(self, color):
+        'The groups of color with exactly one liberty.'
+        masks = self.geometry.bit_masks
+        stones = self.stones(color)
+        empty = self.empty()
+        groups = []
+        for group in self._groups_next_to(masks.full, stones):
+            liberties = masks.spread(group) & empty
+            if liberties and liberties & (liberties - 1) == 0:
+                groups.append(Group((group & -group).bit_length() - 1, self._coords(group), self._coords(liberties), color))
+        return groups
+
+    def _groups_next_to(self, neighbors, stones):
+        'Yields each group of stones touching any of neighbors, once.'
+        masks = self.geometry.bit_masks
+        touching = neighbors & stones
+        while touching:
+            group = masks.flood_fill(touching & -touching, stones)
+            touching &= ~group
+            yield group
+
+    def is_move_suicidal(self, color, c):
+        masks = self.geometry.bit_masks
+        i = c[0] * masks.n + c[1]
+        bit = 1 << i
+        neighbors = masks.neighbors[i]
+        empty = self.empty()
+        if neighbors & empty:
+            return False
+        # capturing an opponent group in atari
+        for group in self._groups_next_to(neighbors, self.stones(-color)):
+            if masks.spread(group) & empty == bit:
+                return False
+        # connecting to a group with some other liberty
+        own_group = masks.flood_fill(bit, self.stones(color) | bit)
+        return not (masks.spread(own_group) & empty & ~bit)
+
+    def liberties_at(self, c):
+        return self._coords(self.group_liberties(self.group_at(c[0] * self.geometry.n + c[1])))
+
+    def stones_at(self, c):
+        return self._coords(self.group_at(c[0] * self.geometry.n + c[1]))
+
+    def would_capture(self, color, c):
+        masks = self.geometry.bit_masks
+        i = c[0] * masks.n + c[1]
+        bit = 1 << i
+        empty = self.empty()
+        captured = 0
+        for group in self._groups_next_to(masks.neighbors[i], self.stones(-color)):
+            if masks.spread(group) & empty == bit:
+                captured |= group
+        return self._coords(captured)
+
+    def add_stone(self, color, c):
+        masks = self.geometry.bit_masks
+        i = c[0] * masks.n + c[1]
+        bit = 1 << i
+        assert not (self.black | self.white) & bit
+        own = self.stones(color) | bit
+        opponent = self.stones(-color)
+        empty = masks.full & ~(own | opponent)
+        captured = 0
+        for group in self._groups_next_to(masks.neighbors[i], opponent):
+            if not masks.spread(group) & empty:
+                captured |= group
+        opponent &= ~captured
+        empty |= captured
+
+        # suicide is illegal
+        if not masks.spread(masks.flood_fill(bit, own)) & empty:
+            raise IllegalMove
+
+        if color == BLACK:
+            self.black, self.white = own, opponent
+        else:
+            self.black, self.white = opponent, own
+        return self._coords(captured)
+
+    def push_stone(self, color, c):
+        'See LibertyTracker.push_stone.'
+        undo = (self.black, self.white)
+        return self.add_stone(color, c), undo
+
+    def pop_stone(self, undo):
+        self.black, self.white = undo
+
+    def is_eyeish(self, c):
+        'Like is_eyeish(board, c), looking only at the stones around c.'
+        n = self.geometry.n
+        i = c[0] * n + c[1]
+        if ((self.black | self.white) >> i) & 1:
+            return None
+        neighbors = self.geometry.bit_masks.neighbors[i]
+        if not neighbors & ~self.black:
+            color = BLACK
+        elif not neighbors & ~self.white:
+            color = WHITE
+        else:
+            return None
+        opponent = self.stones(-color)
+        diagonals = self.geometry.diagonals[c]
+        diagonal_faults = len(diagonals) < 4
+        for r, col in diagonals:
+            diagonal_faults += (opponent >> (r * n + col)) & 1
+        return color if diagonal_faults <= 1 else None
+
+    def eyeish_points(self, color):
+        'The bitboard of every point that is_eyeish for color.'
+        masks = self.geometry.bit_masks
+        # empty points whose neighbors are all color's stones
+        koish = self.empty() & ~masks.spread(masks.full & ~self.stones(color))
+        # is_eyeish allows one opponent stone on a diagonal, or none on the edge.
+        d1, d2, d3, d4 = masks.diagonal_shifts(self.stones(-color))
+        any_fault = d1 | d2 | d3 | d4
+        two_faults = (d1 & (d2 | d3 | d4)) | (d2 & (d3 | d4)) | (d3 & d4)
+        return koish & ~two_faults & ~(masks.edge & any_fault)
+
+# Engines that can back a Position; see set_engine.
+ENGINES = {
+    'tuple': LibertyTracker,
+    'flat': FlatLibertyTracker,
+    'array': ArrayLibertyTracker,
+    'bitboard': BitboardLibertyTracker,
+}
+# The LibertyTracker class used by Positions created without one.
+Tracker = LibertyTracker
+
+def set_engine(name):
+    '''
+    Selects the board engine for newly created Positions. Like set_board_size,
+    this is meant to be called once at startup rather than mixed within a game.
+    '''
+    global Tracker
+    Tracker = ENGINES[name]
+
+class MoveUndo(namedtuple('MoveUndo', ['move', 'color', 'state', 'captured_stones', 'tracker_undo'])):
+    '''
+    Everything needed to revert a move played with Position.push_move.
+    state: the (n, caps, ko, recent, to_play, zobrist_hash, seen_hashes) before the move
+    captured_stones: the opponent stones removed by the move
+    tracker_undo: the undo record returned by the LibertyTracker's push_stone
+    '''
+    pass
+
+class MoveMasks():
+    '''
+    Per-point move facts for both colors, kept up to date incrementally.
+
+    non_suicidal[color]: empty points where color could play without suicide
+    captures[color]: empty points where color would capture something
+    eye_colors: the color whose eye (see is_eyeish) each point is, or EMPTY
+
+    Ko and superko depend on whose turn it is and on the game history, so
+    Position applies them on top of these masks.
+
+    Moves only mark the points they changed; the masks are refreshed on the
+    next request, and only around those points. Playing or removing a stone
+    can change these facts at its neighbors and diagonals, and at the
+    liberties of any group next to it, since those groups gained or lost a
+    liberty. (A group elsewhere can't have changed liberties without a stone
+    changing next to it.)
+    '''
+    def __init__(self, geometry):
+        n = geometry.n
+        self.geometry = geometry
+        self.non_suicidal = {BLACK: np.zeros([n, n], dtype=bool), WHITE: np.zeros([n, n], dtype=bool)}
+        self.captures = {BLACK: np.zeros([n, n], dtype=bool), WHITE: np.zeros([n, n], dtype=bool)}
+        self.eye_colors = np.zeros([n, n], dtype=np.int8)
+        # points changed since the last refresh, or None if everything is stale.
+        self.changed_points = None
+
+    def __deepcopy__(self, memodict={}):
+        new_masks = MoveMasks.__new__(MoveMasks)
+        new_masks.geometry = self.geometry
+        new_masks.non_suicidal = {color: np.copy(mask) for color, mask in self.non_suicidal.items()}
+        new_masks.captures = {color: np.copy(mask) for color, mask in self.captures.items()}
+        new_masks.eye_colors = np.copy(self.eye_colors)
+        new_masks.changed_points = set(self.changed_points) if self.changed_points is not None else None
+        return new_masks
+
+    def mark_changed(self, points):
+        if self.changed_points is not None:
+            self.changed_points.update(points)
+
+    def refresh(self, board, lib_tracker):
+        neighbors = self.geometry.neighbors
+        diagonals = self.geometry.diagonals
+        if self.changed_points is None:
+            stale_points = self.geometry.all_coords
+        elif not self.changed_points:
+            return self
+        else:
+            stale_points = set()
+            for c in self.changed_points:
+                stale_points.add(c)
+                stale_points.update(neighbors[c])
+                stale_points.update(diagonals[c])
+                for n in neighbors[c]:
+                    if board[n] != EMPTY:
+                        stale_points |= lib_tracker.liberties_at(n)
+        self.changed_points = set()
+        # The bitboard engine finds every eye in a few big-int ops, which is
+        # cheaper than checking even just the stale points one at a time.
+        eyeish_points = getattr(lib_tracker, 'eyeish_points', None)
+
+        for c in stale_points:
+            if board[c] != EMPTY:
+                for color in (BLACK, WHITE):
+                    self.non_suicidal[color][c] = False
+                    self.captures[color][c] = False
+                self.eye_colors[c] = EMPTY
+                continue
+            neighbor_colors = {board[n] for n in neighbors[c]}
+            for color in (BLACK, WHITE):
+                self.non_suicidal[color][c] = EMPTY in neighbor_colors or not lib_tracker.is_move_suicidal(color, c)
+                self.captures[color][c] = -color in neighbor_colors and bool(lib_tracker.would_capture(color, c))
+            if eyeish_points is None:
+                eye_color = is_eyeish(board, c) if len(neighbor_colors) == 1 else None
+                self.eye_colors[c] = EMPTY if eye_color is None else eye_color
+        if eyeish_points is not None:
+            bit_masks = self.geometry.bit_masks
+            self.eye_colors[:] = EMPTY
+            self.eye_colors[bit_masks.to_mask(eyeish_points(BLACK))] = BLACK
+            self.eye_colors[bit_masks.to_mask(eyeish_points(WHITE))] = WHITE
+        return self
+
+# Position.to_bytes layout: a POSITION_HEADER, then the black and white
+# stones as two NxN bit planes, packed 8 points to a byte.
+# Header: board size, to_play, ko, black caps, white caps, komi, move number,
+# the number of recent moves kept, and RECENT_MOVES (color, move) pairs, oldest
+# first. Points are stored as row * N + column, and NO_MOVE stands for a pass
+# or no ko; unused recent move slots are (EMPTY, NO_MOVE).
+RECENT_MOVES = 8
+NO_MOVE = 0xFFFF
+POSITION_HEADER = struct.Struct('<BbHHHdIB' + 'bH' * RECENT_MOVES)
+
 class Position():
-    def __init__(self, board=None, n=0, komi=7.5, caps=(0, 0), lib_tracker=None, ko=None, recent=tuple(), to_play=BLACK):
+    def __init__(self, board=None, n=0, komi=7.5, caps=(0, 0), lib_tracker=None, ko=None, recent=tuple(), to_play=BLACK,
+                 zobrist_hash=None, seen_hashes=None, geometry=None):
         '''
         board: a numpy array
         n: an int representing moves played so far
         komi: a float, representing points given to the second player.
         caps: a (int, int) tuple of captures for B, W.
-        lib_tracker: a LibertyTracker object
+        lib_tracker: a LibertyTracker object. If not given, one is built from
+            the board the first time it's needed.
         ko: a Move
-        recent: a tuple of PlayerMoves, such that recent[-1] is the last move.
+        recent: a MoveHistory (or a tuple) of PlayerMoves, such that recent[-1] is the last move.
         to_play: BLACK or WHITE
+        zobrist_hash: the Zobrist hash of (board, to_play)
+        seen_hashes: a HashHistory (or a set) of the board hashes seen so far
+            this game, for superko. The current board is always added.
+        geometry: the BoardGeometry of the board. Defaults to the board's size,
+            or the default board size if no board is given.
         '''
-        self.board = board if board is not None else np.copy(EMPTY_BOARD)
+        if geometry is None:
+            geometry = board_geometry(board) if board is not None else default_geometry()
+        self.geometry = geometry
+        self.board = board if board is not None else np.copy(geometry.empty_board)
         self.n = n
         self.komi = komi
         self.caps = caps
-        self.lib_tracker = lib_tracker or LibertyTracker.from_board(self.board)
+        self._lib_tracker = lib_tracker
         self.ko = ko
-        self.recent = recent
+        self.recent = recent if isinstance(recent, MoveHistory) else MoveHistory.from_moves(recent)
         self.to_play = to_play
+        self.zobrist_hash = zobrist_hash if zobrist_hash is not None else compute_zobrist_hash(self.board, to_play)
+        if not isinstance(seen_hashes, HashHistory):
+            seen_hashes = HashHistory.from_hashes(seen_hashes or ())
+        self.seen_hashes = seen_hashes.add(self.board_hash())
+        # MoveUndo records for the moves made with push_move.
+        self._undo_stack = []
+        # Built on the first request for a move mask; see legal_move_mask.
+        self._move_masks = None
+        # A features.IncrementalFeatures, if one was attached with
+        # features.start_incremental_features; told about every move's changes.
+        self.incremental_features = None
+
+    @property
+    def lib_tracker(self):
+        if self._lib_tracker is None:
+            self._lib_tracker = Tracker.from_board(self.board)
+        return self._lib_tracker
 
     def __deepcopy__(self, memodict={}):
         new_board = np.copy(self.board)
-        new_lib_tracker = copy.deepcopy(self.lib_tracker)
-        return Position(new_board, self.n, self.komi, self.caps, new_lib_tracker, self.ko, self.recent, self.to_play)
+        new_lib_tracker = copy.deepcopy(self._lib_tracker) if self._lib_tracker is not None else None
+        new_position = Position(new_board, self.n, self.komi, self.caps, new_lib_tracker, self.ko, self.recent, self.to_play,
+                                zobrist_hash=self.zobrist_hash, seen_hashes=self.seen_hashes, geometry=self.geometry)
+        if self._move_masks is not None:
+            new_position._move_masks = copy.deepcopy(self._move_masks)
+        if self.incremental_features is not None:
+            new_position.incremental_features = copy.deepcopy(self.incremental_features)
+        return new_position
+
+    def to_bytes(self):
+        '''
+        Packs the position into a fixed layout buffer; see POSITION_HEADER.
+        Only the last RECENT_MOVES moves are kept, and the superko history
+        is dropped, so this is meant for shipping positions to other
+        processes or caches, not for saving a game.
+        '''
+        n = self.geometry.n
+        recent_moves = []
+        for color, move in self.recent[-RECENT_MOVES:]:
+            recent_moves.extend([color, NO_MOVE if move is None else move[0] * n + move[1]])
+        recent_moves.extend([EMPTY, NO_MOVE] * (RECENT_MOVES - len(recent_moves) // 2))
+        header = POSITION_HEADER.pack(
+            n, self.to_play, NO_MOVE if self.ko is None else self.ko[0] * n + self.ko[1],
+            self.caps[0], self.caps[1], self.komi, self.n,
+            min(len(self.recent), RECENT_MOVES), *recent_moves)
+        stones = np.packbits(np.stack([self.board == BLACK, self.board == WHITE]))
+        return header + stones.tobytes()
+
+    @staticmethod
+    def from_bytes(data):
+        'The inverse of to_bytes. The LibertyTracker is rebuilt when first needed.'
+        fields = POSITION_HEADER.unpack_from(data)
+        n, to_play, ko, black_caps, white_caps, komi, move_number, num_recent = fields[:8]
+        geometry = get_geometry(n)
+        stones = np.unpackbits(np.frombuffer(data, dtype=np.uint8, offset=POSITION_HEADER.size))
+        black, white = stones[:2 * n * n].reshape(2, n, n).astype(bool)
+        board = np.zeros([n, n], dtype=np.int8)
+        board[black] = BLACK
+        board[white] = WHITE
+        recent_fields = fields[8:]
+        recent = tuple(
+            PlayerMove(color, None if move == NO_MOVE else divmod(move, n))
+            for color, move in zip(recent_fields[0:2 * num_recent:2], recent_fields[1:2 * num_recent:2]))
+        return Position(board, move_number, komi, (black_caps, white_caps),
+                        ko=None if ko == NO_MOVE else divmod(ko, n), recent=recent, to_play=to_play,
+                        geometry=geometry)
+
+    def board_hash(self):
+        'The Zobrist hash of the stones on the board, ignoring whose turn it is.'
+        return self.zobrist_hash ^ (self.geometry.zobrist_white_to_play if self.to_play == WHITE else 0)
 
     def __str__(self):
         pretty_print_map = {
@@ -272,41 +1657,39 @@ class Position():
         captures = self.caps
         if self.ko is not None:
             place_stones(board, KO, [self.ko])
+        n = self.geometry.n
         raw_board_contents = []
-        for i in range(N):
+        for i in range(n):
             row = []
-            for j in range(N):
+            for j in range(n):
                 appended = '<' if (self.recent and (i, j) == self.recent[-1].move) else ' '
                 row.append(pretty_print_map[board[i,j]] + appended)
             raw_board_contents.append(''.join(row))
 
-        row_labels = ['%2d ' % i for i in range(N, 0, -1)]
+        row_labels = ['%2d ' % i for i in range(n, 0, -1)]
         annotated_board_contents = [''.join(r) for r in zip(row_labels, raw_board_contents, row_labels)]
-        header_footer_rows = ['   ' + ' '.join('ABCDEFGHJKLMNOPQRST'[:N]) + '   ']
+        header_footer_rows = ['   ' + ' '.join('ABCDEFGHJKLMNOPQRST'[:n]) + '   ']
         annotated_board = '\n'.join(itertools.chain(header_footer_rows, annotated_board_contents, header_footer_rows))
         details = "\nMove: {}. Captures X: {} O: {}\n".format(self.n, *captures)
         return annotated_board + details
 
     def is_move_suicidal(self, move):
-        potential_libs = set()
-        for n in NEIGHBORS[move]:
-            neighbor_group_id = self.lib_tracker.group_index[n]
-            if neighbor_group_id == MISSING_GROUP_ID:
-                # at least one liberty after playing here, so not a suicide
-                return False
-            neighbor_group = self.lib_tracker.groups[neighbor_group_id]
-            if neighbor_group.color == self.to_play:
-                potential_libs |= neighbor_group.liberties
-            elif len(neighbor_group.liberties) == 1:
-                # would capture an opponent group if they only had one lib.
-                return False
-        # it's possible to suicide by connecting several friendly groups
-        # each of which had one liberty.
-        potential_libs -= set([move])
-        return not potential_libs
+        return self.lib_tracker.is_move_suicidal(self.to_play, move)
 
-    def is_move_legal(self, move):
-        'Checks that a move is on an empty space, not on ko, and not suicide'
+    def is_move_superko(self, move):
+        'Checks whether a move would recreate a board seen earlier in the game.'
+        color = self.to_play
+        zobrist_keys = self.geometry.zobrist_keys
+        new_hash = self.board_hash() ^ zobrist_keys[color].item(move)
+        for s in self.lib_tracker.would_capture(color, move):
+            new_hash ^= zobrist_keys[-color].item(s)
+        return new_hash in self.seen_hashes
+
+    def is_move_legal(self, move, superko=True):
+        '''
+        Checks that a move is on an empty space, not on ko, not suicide, and
+        (unless superko is False) not a superko violation.
+        '''
         if move is None:
             return True
         if self.board[move] != EMPTY:
@@ -315,84 +1698,198 @@ class Position():
             return False
         if self.is_move_suicidal(move):
             return False
+        if superko and self.is_move_superko(move):
+            return False
 
         return True
 
+    def legal_move_mask(self):
+        '''
+        Returns an NxN boolean array marking the legal moves for the player to
+        play; the same moves as is_move_legal, except that passing is always
+        legal and isn't part of the mask.
+        '''
+        masks = self._refresh_move_masks()
+        color = self.to_play
+        legal = np.copy(masks.non_suicidal[color])
+        if self.ko is not None:
+            legal[self.ko] = False
+        # A move that captures nothing just adds its own key to the board
+        # hash, so its new board hash can be looked up directly.
+        quiet_moves = np.argwhere(legal & ~masks.captures[color])
+        new_hashes = np.uint64(self.board_hash()) ^ self.geometry.zobrist_keys[color][quiet_moves[:, 0], quiet_moves[:, 1]]
+        moves_by_hash = dict(zip(new_hashes.tolist(), map(tuple, quiet_moves.tolist())))
+        for seen_hash in self.seen_hashes.intersection(moves_by_hash):
+            legal[moves_by_hash[seen_hash]] = False
+        for move in np.argwhere(legal & masks.captures[color]).tolist():
+            if self.is_move_superko(tuple(move)):
+                legal[tuple(move)] = False
+        return legal
+
+    def own_eye_mask(self):
+        'Returns an NxN boolean array marking the eyes of the player to play.'
+        eyeish_points = getattr(self.lib_tracker, 'eyeish_points', None)
+        if eyeish_points is not None:
+            return self.geometry.bit_masks.to_mask(eyeish_points(self.to_play))
+        return self._refresh_move_masks().eye_colors == self.to_play
+
+    def is_eyeish(self, c):
+        'Like is_eyeish(self.board, c), but asks the liberty tracker if it knows how.'
+        if hasattr(self.lib_tracker, 'is_eyeish'):
+            return self.lib_tracker.is_eyeish(c)
+        return is_eyeish(self.board, c)
+
+    def start_move_masks(self):
+        '''
+        Builds the move masks now, rather than on the first request for one.
+        Positions played from this one with play_move or push_move then keep
+        them up to date incrementally, which is much cheaper than building
+        them for every position of a game that's being replayed.
+        '''
+        self._refresh_move_masks()
+        return self
+
+    def _refresh_move_masks(self):
+        if self._move_masks is None:
+            self._move_masks = MoveMasks(self.geometry)
+        return self._move_masks.refresh(self.board, self.lib_tracker)
+
+    def sensible_move_mask(self):
+        'Legal moves that don\'t fill one of our own eyes.'
+        return self.legal_move_mask() & ~self.own_eye_mask()
+
     def pass_move(self, mutate=False):
         pos = self if mutate else copy.deepcopy(self)
         pos.n += 1
-        pos.recent += (PlayerMove(pos.to_play, None),)
+        pos.recent = pos.recent.append(PlayerMove(pos.to_play, None))
         pos.to_play *= -1
         pos.ko = None
+        pos.zobrist_hash ^= pos.geometry.zobrist_white_to_play
         return pos
 
     def flip_playerturn(self, mutate=False):
         pos = self if mutate else copy.deepcopy(self)
         pos.ko = None
         pos.to_play *= -1
+        pos.zobrist_hash ^= pos.geometry.zobrist_white_to_play
         return pos
 
     def get_liberties(self):
         return self.lib_tracker.liberty_cache
 
-    def play_move(self, c, color=None, mutate=False):
+    def play_move(self, c, color=None, mutate=False, superko=True):
         # Obeys CGOS Rules of Play. In short:
         # No suicides
         # Chinese/area scoring
-        # Positional superko (this is very crudely approximate at the moment.)
+        # Positional superko, unless superko is False. Game records played
+        # under other rules (e.g. Japanese) can legally repeat a board.
+        if not mutate and self._move_masks is not None:
+            # so the copy only has this move's changes to catch up on
+            self._refresh_move_masks()
+        if not mutate and self.incremental_features is not None:
+            self.incremental_features.update(self)
+        pos = self if mutate else copy.deepcopy(self)
+        pos._apply_move(c, color, superko=superko)
+        return pos
+
+    def push_move(self, c, color=None):
+        '''
+        Plays a move in place, recording an undo record so that pop_move can
+        revert it. This lets search and replay walk a single Position instead
+        of copying it for every ply.
+        '''
+        self._undo_stack.append(self._apply_move(c, color, record=True))
+        return self
+
+    def pop_move(self):
+        'Reverts the last move made with push_move.'
+        undo = self._undo_stack.pop()
+        if undo.move is not None:
+            self.lib_tracker.pop_stone(undo.tracker_undo)
+            place_stones(self.board, EMPTY, [undo.move])
+            place_stones(self.board, -undo.color, undo.captured_stones)
+            self._mark_changed([undo.move])
+            self._mark_changed(undo.captured_stones)
+        self.n, self.caps, self.ko, self.recent, self.to_play, self.zobrist_hash, self.seen_hashes = undo.state
+        return self
+
+    def _mark_changed(self, points):
+        'Tells the move masks and incremental features which points changed.'
+        if self._move_masks is not None:
+            self._move_masks.mark_changed(points)
+        if self.incremental_features is not None:
+            self.incremental_features.mark_changed(points)
+
+    def _apply_move(self, c, color=None, record=False, superko=True):
+        '''
+        Plays a move on this Position in place. If record is True, returns a
+        MoveUndo for pop_move.
+        '''
         if color is None:
             color = self.to_play
-
-        pos = self if mutate else copy.deepcopy(self)
+        state = (self.n, self.caps, self.ko, self.recent, self.to_play, self.zobrist_hash, self.seen_hashes) if record else None
 
         if c is None:
-            pos = pos.pass_move(mutate=mutate)
-            return pos
+            self.pass_move(mutate=True)
+            return MoveUndo(c, color, state, None, None) if record else None
 
-        if not self.is_move_legal(c):
+        if not self.is_move_legal(c, superko=superko):
             raise IllegalMove()
 
-        place_stones(pos.board, color, [c])
-        captured_stones = pos.lib_tracker.add_stone(color, c)
-        place_stones(pos.board, EMPTY, captured_stones)
+        # check for a ko shape before placing the stone
+        potential_ko = is_koish(self.board, c)
+
+        place_stones(self.board, color, [c])
+        if record:
+            captured_stones, tracker_undo = self.lib_tracker.push_stone(color, c)
+        else:
+            captured_stones = self.lib_tracker.add_stone(color, c)
+        place_stones(self.board, EMPTY, captured_stones)
+        self._mark_changed([c])
+        self._mark_changed(captured_stones)
 
         opp_color = color * -1
 
-        if len(captured_stones) == 1 and is_koish(self.board, c) == opp_color:
+        if len(captured_stones) == 1 and potential_ko == opp_color:
             new_ko = list(captured_stones)[0]
         else:
             new_ko = None
 
-        if pos.to_play == BLACK:
-            new_caps = (pos.caps[0] + len(captured_stones), pos.caps[1])
+        if self.to_play == BLACK:
+            new_caps = (self.caps[0] + len(captured_stones), self.caps[1])
         else:
-            new_caps = (pos.caps[0], pos.caps[1] + len(captured_stones))
+            new_caps = (self.caps[0], self.caps[1] + len(captured_stones))
 
-        pos.n += 1
-        pos.caps = new_caps
-        pos.ko = new_ko
-        pos.recent += (PlayerMove(color, c),)
-        pos.to_play *= -1
-        return pos
+        zobrist_keys = self.geometry.zobrist_keys
+        new_hash = self.zobrist_hash ^ zobrist_keys[color].item(c) ^ self.geometry.zobrist_white_to_play
+        for s in captured_stones:
+            new_hash ^= zobrist_keys[opp_color].item(s)
 
-    def score(self):
-        working_board = np.copy(self.board)
-        while EMPTY in working_board:
-            unassigned_spaces = np.where(working_board == EMPTY)
-            c = unassigned_spaces[0][0], unassigned_spaces[1][0]
-            territory, borders = find_reached(working_board, c)
-            border_colors = set(working_board[b] for b in borders)
-            X_border = BLACK in border_colors
-            O_border = WHITE in border_colors
-            if X_border and not O_border:
-                territory_color = BLACK
-            elif O_border and not X_border:
-                territory_color = WHITE
-            else:
-                territory_color = UNKNOWN # dame, or seki
-            place_stones(working_board, territory_color, territory)
+        self.n += 1
+        self.caps = new_caps
+        self.ko = new_ko
+        self.recent = self.recent.append(PlayerMove(color, c))
+        self.to_play *= -1
+        self.zobrist_hash = new_hash
+        self.seen_hashes = self.seen_hashes.add(self.board_hash())
+        if record:
+            return MoveUndo(c, color, state, captured_stones, tracker_undo)
 
-        return np.count_nonzero(working_board == BLACK) - np.count_nonzero(working_board == WHITE) - self.komi
+    def score(self):
+        # Area scoring: a point counts for a color if it's that color's stone,
+        # or if it's empty and its empty region borders only that color.
+        # Regions bordering both colors are dame, or seki. On bitboards, a
+        # color's territory candidates are just the empty points flooded from
+        # the empty points next to its stones, a few big-int ops per step.
+        masks = self.geometry.bit_masks
+        black = masks.from_mask(self.board == BLACK)
+        white = masks.from_mask(self.board == WHITE)
+        empty = masks.full & ~(black | white)
+        black_reach = masks.flood_fill(masks.spread(black) & empty, empty)
+        white_reach = masks.flood_fill(masks.spread(white) & empty, empty)
+        return (popcount(black) + popcount(black_reach & ~white_reach)
+                - popcount(white) - popcount(white_reach & ~black_reach)
+                - self.komi)
 
     def result(self):
         score = self.score()
@@ -0,0 +1,194 @@
+'''
+Ladder reading, for the ladder capture and ladder escape features.
+
+A ladder is read by playing it out on the position itself with push_move and
+pop_move, so reading never copies a Position. The group being chased is
+identified by one of its stones, which stays put for the whole ladder.
+
+The escaping side tries extending from its last liberty, and capturing any
+chasing stones that are in atari. The chasing side tries both liberties of a
+group left with two. A group with three or more liberties has escaped, and
+so has any group still alive after max_depth moves, which keeps the reading
+bounded on long or strange ladders.
+
+Most candidate moves fail at once: the chased group extends to three or more
+liberties. That case is recognized by counting liberties around the
+extension, without playing anything.
+
+Results are cached by (position hash, ko, stone), so the ladders of one
+position are mostly found in the cache when reading the next position of
+the same game. Results that depended on running into max_depth aren't
+cached: the same position reached from later in the game has more depth
+left to read it properly.
+'''
+import go
+from go import EMPTY
+
+# Ladders that run for more moves than this are assumed to escape. A ladder
+# running corner to corner across a 19x19 board is about 70 moves.
+MAX_LADDER_DEPTH = 80
+# The cache is cleared when it grows past this many entries.
+MAX_CACHE_SIZE = 100000
+
+class LadderReader():
+    def __init__(self, max_depth=MAX_LADDER_DEPTH, max_cache_size=MAX_CACHE_SIZE):
+        self.max_depth = max_depth
+        self.max_cache_size = max_cache_size
+        self.cache = {}
+        # how many times reading has been cut off by max_depth
+        self.cutoffs = 0
+
+    def _cache_key(self, position, stone):
+        return (position.zobrist_hash, position.ko, stone)
+
+    def _remember(self, key, result, cutoffs):
+        'Caches result, unless reading it was cut off since self.cutoffs was cutoffs.'
+        if self.cutoffs != cutoffs:
+            return result
+        if len(self.cache) >= self.max_cache_size:
+            self.cache.clear()
+        self.cache[key] = result
+        return result
+
+    def extension_escapes(self, position, extension, filled=None):
+        '''
+        Whether extending the group next to extension, with the point filled
+        also taken by the opponent, surely gets it three or more liberties.
+        This ignores stones that the move at filled might capture, which
+        could only add liberties.
+        '''
+        board = position.board
+        color = position.to_play if filled is None else -position.to_play
+        liberties = set()
+        for n in position.geometry.neighbors[extension]:
+            if board[n] == EMPTY:
+                liberties.add(n)
+            elif board[n] == color:
+                liberties |= position.lib_tracker.liberties_at(n)
+        liberties.discard(extension)
+        liberties.discard(filled)
+        return len(liberties) >= 3 and extension != position.ko
+
+    def escape_moves(self, position, stone):
+        '''
+        The moves that might save the group at stone, which is in atari: its
+        last liberty, and the last liberties of chasing groups in atari.
+        '''
+        chain, reached = go.find_reached(position.board, stone)
+        moves = list(position.lib_tracker.liberties_at(stone))
+        color = position.board[stone]
+        for r in reached:
+            if position.board[r] == -color:
+                liberties = position.lib_tracker.liberties_at(r)
+                if len(liberties) == 1:
+                    moves.extend(m for m in liberties if m not in moves)
+        return moves
+
+    def is_captured(self, position, stone, depth=0):
+        '''
+        The group at stone is in atari, and it's its owner's turn. Returns
+        whether the group is captured in a ladder, whatever it tries.
+        '''
+        key = self._cache_key(position, stone)
+        if key in self.cache:
+            return self.cache[key]
+        cutoffs = self.cutoffs
+        captured = True
+        extension = next(iter(position.lib_tracker.liberties_at(stone)))
+        for move in self.escape_moves(position, stone):
+            if move == extension and self.extension_escapes(position, move):
+                captured = False
+                break
+            try:
+                position.push_move(move)
+            except go.IllegalMove:
+                continue
+            try:
+                escaped = self.has_escaped(position, stone, depth + 1)
+            finally:
+                position.pop_move()
+            if escaped:
+                captured = False
+                break
+        return self._remember(key, captured, cutoffs)
+
+    def has_escaped(self, position, stone, depth=0):
+        '''
+        The owner of the group at stone has just moved, and it's the chasing
+        side's turn. Returns whether the group gets away.
+        '''
+        # a copy, since the tracker's sets change as moves are pushed
+        liberties = list(position.lib_tracker.liberties_at(stone))
+        if len(liberties) >= 3:
+            return True
+        if len(liberties) == 1:
+            return False
+        if depth >= self.max_depth:
+            self.cutoffs += 1
+            return True
+        key = self._cache_key(position, stone)
+        if key in self.cache:
+            return self.cache[key]
+        cutoffs = self.cutoffs
+        escaped = True
+        for move, other_liberty in (liberties, liberties[::-1]):
+            if self.extension_escapes(position, other_liberty, filled=move):
+                continue
+            try:
+                position.push_move(move)
+            except go.IllegalMove:
+                continue
+            try:
+                captured = self.is_captured(position, stone, depth + 1)
+            finally:
+                position.pop_move()
+            if captured:
+                escaped = False
+                break
+        return self._remember(key, escaped, cutoffs)
+
+    def ladder_captures(self, position):
+        'The moves for the player to play that capture an opponent group in a ladder.'
+        # Read the groups before playing anything, since the tracker's groups
+        # change as moves are pushed.
+        targets = [(next(iter(group.stones)), list(group.liberties))
+                   for group in position.lib_tracker.groups.values()
+                   if group.color == -position.to_play and len(group.liberties) == 2]
+        captures = set()
+        for stone, liberties in targets:
+            for move, other_liberty in (liberties, liberties[::-1]):
+                if move in captures or self.extension_escapes(position, other_liberty, filled=move):
+                    continue
+                try:
+                    position.push_move(move)
+                except go.IllegalMove:
+                    continue
+                try:
+                    if self.is_captured(position, stone):
+                        captures.add(move)
+                finally:
+                    position.pop_move()
+        return captures
+
+    def ladder_escapes(self, position):
+        'The moves for the player to play that save one of their groups in atari from a ladder.'
+        targets = [next(iter(group.stones)) for group in position.lib_tracker.groups_in_atari(position.to_play)]
+        escapes = set()
+        for stone in targets:
+            for move in self.escape_moves(position, stone):
+                if move in escapes:
+                    continue
+                try:
+                    position.push_move(move)
+                except go.IllegalMove:
+                    continue
+                try:
+                    if self.has_escaped(position, stone):
+                        escapes.add(move)
+                finally:
+                    position.pop_move()
+        return escapes
+
+# Shared by the ladder features, so that consecutive positions of a game
+# reuse each other's reading.
+default_reader = LadderReader()
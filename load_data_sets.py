@@ -1,19 +1,48 @@
 import itertools
 import gzip
+import hashlib
+import multiprocessing
 import numpy as np
 import os
+import queue
 import struct
 import sys
+import threading
+import time
 
-from features import bulk_extract_features
+from features import DEFAULT_FEATURES, bulk_extract_packed_features, extract_features, needed_intermediates, pack_features, unpack_features
 import go
 from sgf_wrapper import replay_sgf
 import utils
 
 # Number of data points to store in a chunk on disk
 CHUNK_SIZE = 4096
-CHUNK_HEADER_FORMAT = "iii?"
-CHUNK_HEADER_SIZE = struct.calcsize(CHUNK_HEADER_FORMAT)
+# Compressed chunks (.chunk.gz): CHUNK_HEADER, then the packed feature rows,
+# then the one-hot next moves, bit-packed.
+# Header: magic, format version, number of positions, board size, input
+# planes, is_test.
+CHUNK_MAGIC = b'MGZ'
+CHUNK_VERSION = 1
+CHUNK_HEADER = struct.Struct('<3sBiii?')
+# Chunks from before the magic and version start with just this header.
+# Their first bytes are the number of positions, which can't look like the
+# magic for any chunk smaller than about 6 million positions.
+LEGACY_CHUNK_HEADER_FORMAT = "iii?"
+LEGACY_CHUNK_HEADER_SIZE = struct.calcsize(LEGACY_CHUNK_HEADER_FORMAT)
+# Uncompressed chunks (.chunk rather than .chunk.gz) can be memory-mapped:
+# UNCOMPRESSED_HEADER, padded to UNCOMPRESSED_HEADER_SIZE bytes, then the
+# packed feature rows, then each position's next move as an int16 flat index.
+# Header: magic, number of positions, board size, input planes, is_test.
+UNCOMPRESSED_MAGIC = b'MGC1'
+UNCOMPRESSED_HEADER = struct.Struct('<4siii?')
+UNCOMPRESSED_HEADER_SIZE = 64
+# Number of positions that ShuffleBuffer mixes together
+SHUFFLE_BUFFER_ROWS = 16 * CHUNK_SIZE
+# The fraction of games to set aside as the test set
+TEST_FRACTION = 0.05
+# How often extract_in_workers checks that its workers are still alive
+# while waiting for a result
+WORKER_CHECK_SECONDS = 1
 
 def take_n(n, iterable):
     return list(itertools.islice(iterable, n))
@@ -27,11 +56,12 @@ def iter_chunks(chunk_size, iterator):
         else:
             break
 
-def make_onehot(coords):
+def make_onehot(coords, board_size=None):
+    board_size = board_size or go.N
     num_positions = len(coords)
-    output = np.zeros([num_positions, go.N ** 2], dtype=np.uint8)
+    output = np.zeros([num_positions, board_size ** 2], dtype=np.uint8)
     for i, coord in enumerate(coords):
-        output[i, utils.flatten_coords(coord)] = 1
+        output[i, utils.flatten_coords(coord, board_size)] = 1
     return output
 
 def find_sgf_files(*dataset_dirs):
@@ -42,45 +72,49 @@ def find_sgf_files(*dataset_dirs):
             if os.path.isfile(f) and f.endswith(".sgf"):
                 yield f
 
-def get_positions_from_sgf(file):
+def get_positions_from_sgf(file, move_masks=False, mutate=False, features=None):
+    'See replay_sgf for the options. Only usable positions are yielded.'
     with open(file) as f:
-        for position_w_context in replay_sgf(f.read()):
+        for position_w_context in replay_sgf(f.read(), mutate=mutate, move_masks=move_masks, features=features):
             if position_w_context.is_usable():
                 yield position_w_context
 
-def split_test_training(positions_w_context, est_num_positions):
-    desired_test_size = 10**5
-    if est_num_positions < 2 * desired_test_size:
-        print("Not enough data to have a full test set. Splitting 67:33")
-        positions_w_context = list(tqdm.tqdm(positions_w_context))
-        test_size = len(positions_w_context) // 3
-        return positions_w_context[:test_size], [positions_w_context[test_size:]]
-    else:
-        print("Estimated number of chunks: %s" % (
-            (est_num_positions - desired_test_size) // CHUNK_SIZE), file=sys.stderr)
-        test_chunk = take_n(desired_test_size, positions_w_context)
-        training_chunks = iter_chunks(CHUNK_SIZE, positions_w_context)
-        return test_chunk, training_chunks
-
 
 class DataSet(object):
-    def __init__(self, pos_features, next_moves, results, is_test=False):
-        self.pos_features = pos_features
+    '''
+    Positions' features are held as packed rows (see features.pack_features),
+    1/8th the size of the unpacked features; get_batch unpacks just the
+    minibatch it returns. pos_features: either the unpacked (B, N, N, planes)
+    features, or packed rows with feature_shape = (N, N, planes).
+
+    Shuffling only shuffles the order that get_batch goes through the rows
+    in, so the rows can live in a read-only memory-mapped file.
+    '''
+    def __init__(self, pos_features, next_moves, results, is_test=False, feature_shape=None, shuffle=True):
+        if feature_shape is None:
+            feature_shape = pos_features.shape[1:]
+            pos_features = pack_features(pos_features)
+        self.packed_features = pos_features
+        self.feature_shape = tuple(feature_shape)
         self.next_moves = next_moves
         self.results = results
         self.is_test = is_test
         assert pos_features.shape[0] == next_moves.shape[0], "Didn't pass in same number of pos_features and next_moves."
         self.data_size = pos_features.shape[0]
-        self.board_size = pos_features.shape[1]
-        self.input_planes = pos_features.shape[-1]
+        self.board_size = self.feature_shape[0]
+        self.input_planes = self.feature_shape[-1]
+        self._order = np.arange(self.data_size)
         self._index_within_epoch = 0
-        self.shuffle()
+        if shuffle:
+            self.shuffle()
+
+    @property
+    def pos_features(self):
+        'All the features, unpacked.'
+        return unpack_features(self.packed_features, self.feature_shape)
 
     def shuffle(self):
-        perm = np.arange(self.data_size)
-        np.random.shuffle(perm)
-        self.pos_features = self.pos_features[perm]
-        self.next_moves = self.next_moves[perm]
+        np.random.shuffle(self._order)
         self._index_within_epoch = 0
 
     def get_batch(self, batch_size):
@@ -90,20 +124,33 @@ class DataSet(object):
         start = self._index_within_epoch
         end = start + batch_size
         self._index_within_epoch += batch_size
-        return self.pos_features[start:end], self.next_moves[start:end]
+        # in file order, which is kinder to memory-mapped rows
+        rows = np.sort(self._order[start:end])
+        return unpack_features(self.packed_features[rows], self.feature_shape), self.next_moves[rows]
 
     @staticmethod
-    def from_positions_w_context(positions_w_context, is_test=False):
+    def from_positions_w_context(positions_w_context, is_test=False, features=DEFAULT_FEATURES, shuffle=True):
         positions, next_moves, results = zip(*positions_w_context)
-        extracted_features = bulk_extract_features(positions)
-        encoded_moves = make_onehot(next_moves)
-        return DataSet(extracted_features, encoded_moves, results, is_test=is_test)
+        n = positions[0].geometry.n
+        packed_features = bulk_extract_packed_features(positions, features)
+        encoded_moves = make_onehot(next_moves, n)
+        feature_shape = (n, n, sum(f.planes for f in features))
+        return DataSet(packed_features, encoded_moves, results, is_test=is_test, feature_shape=feature_shape, shuffle=shuffle)
+
+    @staticmethod
+    def concatenate(datasets):
+        'One DataSet of all the positions in datasets.'
+        return DataSet(np.concatenate([dataset.packed_features for dataset in datasets]),
+                       np.concatenate([dataset.next_moves for dataset in datasets]),
+                       [result for dataset in datasets for result in dataset.results],
+                       is_test=datasets[0].is_test, feature_shape=datasets[0].feature_shape)
 
     def write(self, filename):
-        header_bytes = struct.pack(CHUNK_HEADER_FORMAT, self.data_size, self.board_size, self.input_planes, self.is_test)
-        position_bytes = np.packbits(self.pos_features).tostring()
+        header_bytes = CHUNK_HEADER.pack(CHUNK_MAGIC, CHUNK_VERSION, self.data_size, self.board_size, self.input_planes, self.is_test)
+        position_bytes = self.packed_features.tostring()
         next_move_bytes = np.packbits(self.next_moves).tostring()
-        with gzip.open(filename, "wb", compresslevel=6) as f:
+        # mtime=0, so that the same data always makes the same file
+        with gzip.GzipFile(filename, "wb", compresslevel=6, mtime=0) as f:
             f.write(header_bytes)
             f.write(position_bytes)
             f.write(next_move_bytes)
@@ -111,33 +158,416 @@ class DataSet(object):
     @staticmethod
     def read(filename):
         with gzip.open(filename, "rb") as f:
-            header_bytes = f.read(CHUNK_HEADER_SIZE)
-            data_size, board_size, input_planes, is_test = struct.unpack(CHUNK_HEADER_FORMAT, header_bytes)
+            header_bytes = f.read(CHUNK_HEADER.size)
+            if header_bytes.startswith(CHUNK_MAGIC):
+                _, version, data_size, board_size, input_planes, is_test = CHUNK_HEADER.unpack(header_bytes)
+                if version != CHUNK_VERSION:
+                    raise ValueError("%s is chunk format version %s, not %s" % (filename, version, CHUNK_VERSION))
+                body = f.read()
+            else:
+                version = None
+                data_size, board_size, input_planes, is_test = struct.unpack(
+                    LEGACY_CHUNK_HEADER_FORMAT, header_bytes[:LEGACY_CHUNK_HEADER_SIZE])
+                body = header_bytes[LEGACY_CHUNK_HEADER_SIZE:] + f.read()
+            feature_shape = (board_size, board_size, input_planes)
 
             position_dims = data_size * board_size * board_size * input_planes
             next_move_dims = data_size * board_size * board_size
+            row_bytes = (board_size * board_size * input_planes + 7) // 8
 
             # the +7 // 8 compensates for numpy's bitpacking padding
-            packed_position_bytes = f.read((position_dims + 7) // 8)
-            packed_next_move_bytes = f.read((next_move_dims + 7) // 8)
-            # should have cleanly finished reading all bytes from file!
-            assert len(f.read()) == 0
+            next_move_bytes = (next_move_dims + 7) // 8
+            packed_position_bytes = body[:-next_move_bytes]
+            packed_next_move_bytes = body[-next_move_bytes:]
 
-            flat_position = np.unpackbits(np.fromstring(packed_position_bytes, dtype=np.uint8))[:position_dims]
+            packed_positions = np.fromstring(packed_position_bytes, dtype=np.uint8)
+            if version is not None or len(packed_positions) == data_size * row_bytes:
+                assert len(packed_positions) == data_size * row_bytes, "Chunk has the wrong size"
+                packed_features = packed_positions.reshape(data_size, row_bytes)
+            else:
+                # Unversioned chunks may pack the whole array at once, rather
+                # than row by row. Only their size tells them apart, which is
+                # ambiguous for chunks of fewer than 8 positions.
+                assert len(packed_positions) == (position_dims + 7) // 8, "Chunk has the wrong size"
+                flat_position = np.unpackbits(packed_positions)[:position_dims]
+                packed_features = pack_features(flat_position.reshape((data_size,) + feature_shape))
             flat_nextmoves = np.unpackbits(np.fromstring(packed_next_move_bytes, dtype=np.uint8))[:next_move_dims]
-
-            pos_features = flat_position.reshape(data_size, board_size, board_size, input_planes)
             next_moves = flat_nextmoves.reshape(data_size, board_size * board_size)
 
-        return DataSet(pos_features, next_moves, [], is_test=is_test)
+        return DataSet(packed_features, next_moves, [], is_test=is_test, feature_shape=feature_shape)
+
+    def write_uncompressed(self, filename):
+        header = UNCOMPRESSED_HEADER.pack(UNCOMPRESSED_MAGIC, self.data_size, self.board_size, self.input_planes, self.is_test)
+        with open(filename, "wb") as f:
+            f.write(header.ljust(UNCOMPRESSED_HEADER_SIZE, b'\0'))
+            f.write(np.ascontiguousarray(self.packed_features).tostring())
+            f.write(np.argmax(self.next_moves, axis=1).astype('<i2').tostring())
+
+    @staticmethod
+    def read_uncompressed(filename):
+        '''
+        Reads a chunk written by write_uncompressed. The feature rows are
+        memory-mapped, so only the rows of each minibatch are ever read.
+        '''
+        with open(filename, "rb") as f:
+            header = f.read(UNCOMPRESSED_HEADER.size)
+        magic, data_size, board_size, input_planes, is_test = UNCOMPRESSED_HEADER.unpack(header)
+        assert magic == UNCOMPRESSED_MAGIC, "%s is not an uncompressed chunk" % filename
+        row_bytes = (board_size * board_size * input_planes + 7) // 8
+        packed_features = np.memmap(filename, dtype=np.uint8, mode='r', offset=UNCOMPRESSED_HEADER_SIZE,
+                                    shape=(data_size, row_bytes))
+        move_indices = np.memmap(filename, dtype='<i2', mode='r', shape=(data_size,),
+                                 offset=UNCOMPRESSED_HEADER_SIZE + data_size * row_bytes)
+        next_moves = np.zeros([data_size, board_size * board_size], dtype=np.uint8)
+        next_moves[np.arange(data_size), move_indices] = 1
+        return DataSet(packed_features, next_moves, [], is_test=is_test,
+                       feature_shape=(board_size, board_size, input_planes))
+
+    @staticmethod
+    def load(filename):
+        'Reads a chunk in either format.'
+        if filename.endswith(".gz"):
+            return DataSet.read(filename)
+        return DataSet.read_uncompressed(filename)
+
+def convert_chunk(filename):
+    'Writes an uncompressed copy of a .chunk.gz file, next to it. Returns its name.'
+    assert filename.endswith(".gz")
+    uncompressed_filename = filename[:-len(".gz")]
+    DataSet.read(filename).write_uncompressed(uncompressed_filename)
+    return uncompressed_filename
+
+class ChunkPrefetcher(object):
+    '''
+    Iterates over (filename, DataSet.load(filename)) for each of filenames,
+    loading up to depth chunks ahead on a background thread, so that chunks
+    decompress while the previous one trains. Loading also pauses once the
+    chunks waiting to be used hold max_bytes, so at most max_bytes plus one
+    chunk are waiting at any time.
+
+    wait_seconds is the total time spent waiting for a chunk to load, and
+    last_wait_seconds the wait for the most recent one. When these are
+    large, training is input-bound.
+    '''
+    def __init__(self, filenames, depth=2, max_bytes=2 ** 30, load=DataSet.load):
+        self.filenames = list(filenames)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.load = load
+        self.wait_seconds = 0
+        self.last_wait_seconds = 0
+        self._ready = []
+        self._ready_bytes = 0
+        self._finished = False
+        self._error = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._load_all, daemon=True)
+        self._thread.start()
+
+    def _has_room(self):
+        if not self._ready:
+            return True
+        return len(self._ready) < self.depth and self._ready_bytes < self.max_bytes
+
+    def _load_all(self):
+        try:
+            for filename in self.filenames:
+                with self._condition:
+                    while not (self._closed or self._has_room()):
+                        self._condition.wait()
+                    if self._closed:
+                        return
+                dataset = self.load(filename)
+                nbytes = dataset.packed_features.nbytes + dataset.next_moves.nbytes
+                with self._condition:
+                    self._ready.append((filename, dataset, nbytes))
+                    self._ready_bytes += nbytes
+                    self._condition.notify_all()
+        except Exception as e:
+            with self._condition:
+                self._error = e
+        finally:
+            with self._condition:
+                self._finished = True
+                self._condition.notify_all()
+
+    def __iter__(self):
+        while True:
+            tick = time.time()
+            with self._condition:
+                while not (self._ready or self._finished):
+                    self._condition.wait()
+                self.last_wait_seconds = time.time() - tick
+                self.wait_seconds += self.last_wait_seconds
+                if not self._ready:
+                    if self._error is not None:
+                        raise self._error
+                    return
+                filename, dataset, nbytes = self._ready.pop(0)
+                self._ready_bytes -= nbytes
+                self._condition.notify_all()
+            yield filename, dataset
+
+    def close(self):
+        'Stops loading more chunks.'
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
 
-def parse_data_sets(*data_sets):
-    print("Searching the following directories {} for SGFS".format('\n'.join(
-        data_sets)))
-    sgf_files = list(find_sgf_files(*data_sets))
-    print("%s sgfs found." % len(sgf_files), file=sys.stderr)
-    est_num_positions = len(sgf_files) * 200 # about 200 moves per game
-    positions_w_context = itertools.chain(*map(get_positions_from_sgf, sgf_files))
+class ShuffleBuffer(object):
+    '''
+    Mixes the positions of a stream of DataSets, and iterates over DataSets
+    of rows_per_dataset positions drawn at random from the last max_rows
+    positions read. Chunks hold consecutive positions of a few games, so
+    training on them one at a time gives highly correlated minibatches;
+    these DataSets can be handed to PolicyNetwork.train instead.
+
+    Only max_rows positions are held at once, as packed features and move
+    indices; every position read is handed out exactly once.
+    '''
+    def __init__(self, datasets, max_rows=SHUFFLE_BUFFER_ROWS, rows_per_dataset=CHUNK_SIZE):
+        self.datasets = datasets
+        self.max_rows = max(max_rows, rows_per_dataset)
+        self.rows_per_dataset = rows_per_dataset
+
+    def _take(self, rows):
+        '''
+        Removes rows from the buffer, and returns them as a DataSet. The
+        rows at the end of the buffer move into the gaps.
+        '''
+        dataset = DataSet(self.packed_features[rows], self._next_moves(self.move_indices[rows]), [],
+                          feature_shape=self.feature_shape)
+        new_size = self.size - len(rows)
+        taken = np.zeros(self.size, dtype=bool)
+        taken[rows] = True
+        gaps = rows[rows < new_size]
+        movers = np.arange(new_size, self.size)[~taken[new_size:]]
+        self.packed_features[gaps] = self.packed_features[movers]
+        self.move_indices[gaps] = self.move_indices[movers]
+        self.size = new_size
+        return dataset
+
+    def _next_moves(self, move_indices):
+        next_moves = np.zeros([len(move_indices), self.feature_shape[0] ** 2], dtype=np.uint8)
+        next_moves[np.arange(len(move_indices)), move_indices] = 1
+        return next_moves
+
+    def __iter__(self):
+        self.size = 0
+        for dataset in self.datasets:
+            if self.size == 0:
+                # (re)allocate, in case the feature shape changed
+                self.feature_shape = dataset.feature_shape
+                self.packed_features = np.zeros([self.max_rows, dataset.packed_features.shape[1]], dtype=np.uint8)
+                self.move_indices = np.zeros([self.max_rows], dtype=np.int16)
+            assert dataset.feature_shape == self.feature_shape, "Can't mix datasets with different features"
+            start = 0
+            while start < dataset.data_size:
+                if self.size == self.max_rows:
+                    rows = np.random.choice(self.size, self.rows_per_dataset, replace=False)
+                    yield self._take(rows)
+                count = min(self.max_rows - self.size, dataset.data_size - start)
+                self.packed_features[self.size:self.size + count] = dataset.packed_features[start:start + count]
+                self.move_indices[self.size:self.size + count] = np.argmax(dataset.next_moves[start:start + count], axis=1)
+                self.size += count
+                start += count
+        # what's left, in random order
+        while self.size > 0:
+            rows = np.random.choice(self.size, min(self.size, self.rows_per_dataset), replace=False)
+            yield self._take(rows)
+
+def extract_sgf_file(filename, features=DEFAULT_FEATURES):
+    '''
+    The preprocessing of one SGF file: returns its positions' packed
+    features, one-hot next moves and metadata, and the seconds spent parsing
+    and extracting features. A game with an illegal move in it is skipped,
+    with a warning, rather than stopping the whole preprocessing run.
+
+    The game is replayed on a single Position carrying incremental features
+    (see replay_sgf), so each position's features are an update of the last
+    one's, taken before the next move is played.
+    '''
+    tick = time.time()
+    extract_seconds = 0
+    # the legal_moves intermediate is much cheaper with the masks carried along
+    move_masks = 'legal_moves' in needed_intermediates(features)
+    extracted, next_moves, results = [], [], []
+    try:
+        for position, next_move, metadata in get_positions_from_sgf(
+                filename, move_masks=move_masks, mutate=True, features=features):
+            extract_tick = time.time()
+            extracted.append(extract_features(position, features))
+            extract_seconds += time.time() - extract_tick
+            next_moves.append(next_move)
+            results.append(metadata)
+    except go.IllegalMove:
+        print("Skipping %s: it has an illegal move" % filename, file=sys.stderr)
+        extracted, next_moves, results = [], [], []
+    parse_seconds = time.time() - tick - extract_seconds
+    tick = time.time()
+    n = go.N
+    num_planes = sum(f.planes for f in features)
+    if extracted:
+        n = extracted[0].shape[0]
+        packed_features = pack_features(np.stack(extracted))
+        encoded_moves = make_onehot(next_moves, n)
+    else:
+        packed_features = np.zeros([0, (n * n * num_planes + 7) // 8], dtype=np.uint8)
+        encoded_moves = np.zeros([0, n * n], dtype=np.uint8)
+    return packed_features, encoded_moves, results, parse_seconds, extract_seconds + time.time() - tick
+
+def _preprocess_worker(engine, tasks, results):
+    go.set_engine(engine)
+    for index, filename in iter(tasks.get, None):
+        try:
+            results.put((index, extract_sgf_file(filename)))
+        except Exception as e:
+            results.put((index, e))
+
+class PositionBuffer(object):
+    'Preprocessed positions waiting to be written, in order.'
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def add(self, packed_features, next_moves, results):
+        if not results:
+            return
+        self.parts.append((packed_features, next_moves, results))
+        self.size += len(results)
+
+    def take(self, count):
+        'Removes and returns the first count positions, as (packed features, next moves, results).'
+        packed_features = np.concatenate([part[0] for part in self.parts])
+        next_moves = np.concatenate([part[1] for part in self.parts])
+        results = [r for part in self.parts for r in part[2]]
+        self.parts = [(packed_features[count:], next_moves[count:], results[count:])]
+        self.size -= min(count, len(results))
+        return packed_features[:count], next_moves[:count], results[:count]
+
+def extract_in_workers(sgf_files, workers, engine='tuple'):
+    '''
+    Yields extract_sgf_file(f) for each of sgf_files, in order, computed by
+    workers processes. At most 2 * workers files are in flight at once, so
+    fast workers can't get far ahead of the consumer. If a worker dies, say
+    killed for running out of memory, this raises a RuntimeError rather
+    than waiting forever for its result.
+    '''
+    max_in_flight = 2 * workers
+    tasks = multiprocessing.Queue(maxsize=max_in_flight)
+    results = multiprocessing.Queue(maxsize=max_in_flight)
+    processes = [multiprocessing.Process(target=_preprocess_worker, args=(engine, tasks, results), daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        next_to_send = 0
+        finished = {}
+        for index in range(len(sgf_files)):
+            while next_to_send < min(len(sgf_files), index + max_in_flight):
+                tasks.put((next_to_send, sgf_files[next_to_send]))
+                next_to_send += 1
+            while index not in finished:
+                try:
+                    i, result = results.get(timeout=WORKER_CHECK_SECONDS)
+                except queue.Empty:
+                    # workers only exit once they're told to, after this loop
+                    for process in processes:
+                        if not process.is_alive():
+                            raise RuntimeError("Preprocessing worker died with exit code %s" % process.exitcode)
+                    continue
+                if isinstance(result, Exception):
+                    raise result
+                finished[i] = result
+            yield finished.pop(index)
+        for process in processes:
+            tasks.put(None)
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+def is_test_file(filename, test_fraction=TEST_FRACTION):
+    '''
+    Whether a game goes in the test set, by a hash of its file name. Whole
+    games go to one side, so the test set never shares a game with the
+    training set, and a file always lands on the same side.
+    '''
+    digest = hashlib.md5(os.path.basename(filename).encode('utf-8')).digest()
+    return struct.unpack('<I', digest[:4])[0] < test_fraction * 2 ** 32
+
+class ChunkWriter(object):
+    '''
+    Writes preprocessed positions to testN.chunk.gz and trainN.chunk.gz as
+    chunk_size of them come in, so that at most one chunk per split is held
+    in memory.
+    '''
+    def __init__(self, processed_dir, chunk_size=CHUNK_SIZE):
+        self.processed_dir = processed_dir
+        self.chunk_size = chunk_size
+        self.buffers = {True: PositionBuffer(), False: PositionBuffer()}
+        self.num_chunks = {True: 0, False: 0}
+        self.write_seconds = 0
+
+    def add(self, is_test, packed_features, next_moves, results):
+        buffer = self.buffers[is_test]
+        buffer.add(packed_features, next_moves, results)
+        while buffer.size >= self.chunk_size:
+            self._write(is_test, buffer.take(self.chunk_size))
+
+    def flush(self):
+        for is_test, buffer in self.buffers.items():
+            if buffer.size > 0:
+                self._write(is_test, buffer.take(buffer.size))
+
+    def _write(self, is_test, chunk):
+        tick = time.time()
+        packed_features, next_moves, results = chunk
+        n = int(round(np.sqrt(next_moves.shape[1])))
+        # rows are padded by less than a byte, so this recovers the planes
+        num_planes = packed_features.shape[1] * 8 // (n * n)
+        dataset = DataSet(packed_features, next_moves, results, is_test=is_test,
+                          feature_shape=(n, n, num_planes), shuffle=False)
+        filename = "%s%s.chunk.gz" % ("test" if is_test else "train", self.num_chunks[is_test])
+        dataset.write(os.path.join(self.processed_dir, filename))
+        self.num_chunks[is_test] += 1
+        self.write_seconds += time.time() - tick
+
+def preprocess_files(sgf_files, processed_dir, workers=1, engine='tuple', chunk_size=CHUNK_SIZE, test_fraction=TEST_FRACTION):
+    '''
+    Preprocesses sgf_files into chunks in processed_dir, one file at a time,
+    splitting them into test and training games with is_test_file. If no
+    file hashes into the test set, the first one goes there anyway, so that
+    there's always something to evaluate on. With more than one worker, SGFs are parsed and their features extracted in
+    worker processes; the chunks are written in file order either way, so
+    the output doesn't depend on the number of workers.
+    Returns the number of (test, training) chunks written.
+    '''
+    if workers > 1:
+        extracted = extract_in_workers(sgf_files, workers, engine=engine)
+    else:
+        extracted = map(extract_sgf_file, sgf_files)
+    test_files = [is_test_file(filename, test_fraction) for filename in sgf_files]
+    if len(sgf_files) > 1 and not any(test_files):
+        test_files[0] = True
+    writer = ChunkWriter(processed_dir, chunk_size)
+    parse_seconds = extract_seconds = 0
+    num_positions = 0
+    start = time.time()
+    for is_test, (packed_features, next_moves, results, parse_time, extract_time) in zip(test_files, extracted):
+        parse_seconds += parse_time
+        extract_seconds += extract_time
+        num_positions += len(results)
+        writer.add(is_test, packed_features, next_moves, results)
+    writer.flush()
+    elapsed = time.time() - start
 
-    test_chunk, training_chunks = split_test_training(positions_w_context, est_num_positions)
-    return test_chunk, training_chunks
+    # parse and extract seconds are summed over the workers
+    for stage, seconds in (('parse', parse_seconds), ('extract', extract_seconds)):
+        print("%-8s %8.0f positions/sec per worker" % (stage, num_positions / max(seconds, 1e-9)), file=sys.stderr)
+    print("%-8s %8.0f positions/sec" % ('write', num_positions / max(writer.write_seconds, 1e-9)), file=sys.stderr)
+    print("overall  %8.0f positions/sec with %d workers" % (num_positions / max(elapsed, 1e-9), workers), file=sys.stderr)
+    return writer.num_chunks[True], writer.num_chunks[False]
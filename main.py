@@ -8,13 +8,23 @@ import time
 
 import argh
 import gtp as gtp_lib
-import tqdm
 
+import go
 from policy import PolicyNetwork
 from strategies import RandomPlayer, PolicyNetworkBestMovePlayer, PolicyNetworkRandomMovePlayer, MCTS
-from load_data_sets import DataSet, parse_data_sets
+from load_data_sets import ChunkPrefetcher, DataSet, ShuffleBuffer, SHUFFLE_BUFFER_ROWS, convert_chunk, find_sgf_files, preprocess_files
 
-TRAINING_CHUNK_RE = re.compile(r"train\d+\.chunk.gz")
+TRAINING_CHUNK_RE = re.compile(r"train\d+\.chunk(\.gz)?$")
+TEST_CHUNK_RE = re.compile(r"test\d*\.chunk(\.gz)?$")
+
+def find_chunks(processed_dir, chunk_re):
+    '''
+    The chunk files in processed_dir matching chunk_re. Where a chunk has
+    been converted (see convert), only the uncompressed copy is used.
+    '''
+    fnames = set(fname for fname in os.listdir(processed_dir) if chunk_re.match(fname))
+    return [os.path.join(processed_dir, fname) for fname in sorted(fnames)
+            if not (fname.endswith(".gz") and fname[:-len(".gz")] in fnames)]
 
 @contextmanager
 def timer(message):
@@ -24,7 +34,8 @@ def timer(message):
     print("%s: %.3f" % (message, (tock - tick)))
 
 
-def gtp(strategy, read_file=None):
+def gtp(strategy, read_file=None, engine='tuple'):
+    go.set_engine(engine)
     n = PolicyNetwork(use_cpu=True)
     if strategy == 'random':
         instance = RandomPlayer()
@@ -53,31 +64,27 @@ def gtp(strategy, read_file=None):
             sys.stdout.write(engine_reply)
             sys.stdout.flush()
 
-def preprocess(*data_sets, processed_dir="processed_data"):
+def preprocess(*data_sets, processed_dir="processed_data", engine='tuple', workers=1):
+    go.set_engine(engine)
     processed_dir = os.path.join(os.getcwd(), processed_dir)
     if not os.path.isdir(processed_dir):
         os.mkdir(processed_dir)
 
-    test_chunk, training_chunks = parse_data_sets(*data_sets)
-    print("Allocating %s positions as test; remainder as training" % len(test_chunk), file=sys.stderr)
-
-    print("Writing test chunk")
-    test_dataset = DataSet.from_positions_w_context(test_chunk, is_test=True)
-    test_filename = os.path.join(processed_dir, "test.chunk.gz")
-    test_dataset.write(test_filename)
-
-    print("Writing training chunks")
-    training_datasets = map(DataSet.from_positions_w_context, training_chunks)
-    for i, train_dataset in tqdm.tqdm(enumerate(training_datasets)):
-        train_filename = os.path.join(processed_dir, "train%s.chunk.gz" % i)
-        train_dataset.write(train_filename)
-    print("%s chunks written" % (i+1))
+    print("Searching the following directories for SGFs:\n%s" % '\n'.join(data_sets))
+    sgf_files = list(find_sgf_files(*data_sets))
+    print("%s sgfs found." % len(sgf_files), file=sys.stderr)
+    num_test_chunks, num_training_chunks = preprocess_files(sgf_files, processed_dir, workers=workers, engine=engine)
+    print("%s test chunks and %s training chunks written" % (num_test_chunks, num_training_chunks))
 
-def train(processed_dir, read_file=None, save_file=None, epochs=10, logdir=None, checkpoint_freq=10000):
-    test_dataset = DataSet.read(os.path.join(processed_dir, "test.chunk.gz"))
-    train_chunk_files = [os.path.join(processed_dir, fname) 
-        for fname in os.listdir(processed_dir)
-        if TRAINING_CHUNK_RE.match(fname)]
+def train(processed_dir, read_file=None, save_file=None, epochs=10, logdir=None, checkpoint_freq=10000,
+          prefetch_depth=2, prefetch_mb=1024, shuffle_rows=SHUFFLE_BUFFER_ROWS):
+    test_chunk_files = find_chunks(processed_dir, TEST_CHUNK_RE)
+    if test_chunk_files:
+        test_dataset = DataSet.concatenate([DataSet.load(file) for file in test_chunk_files])
+    else:
+        print("No test chunks in %s; skipping test set evaluation" % processed_dir)
+        test_dataset = None
+    train_chunk_files = find_chunks(processed_dir, TRAINING_CHUNK_RE)
     if read_file is not None:
         read_file = os.path.join(os.getcwd(), save_file)
     n = PolicyNetwork()
@@ -87,23 +94,38 @@ def train(processed_dir, read_file=None, save_file=None, epochs=10, logdir=None,
     last_save_checkpoint = 0
     for i in range(epochs):
         random.shuffle(train_chunk_files)
-        for file in train_chunk_files:
-            print("Using %s" % file)
-            with timer("load dataset"):
-                train_dataset = DataSet.read(file)
+        # The next chunks load in the background while this one trains.
+        chunks = ChunkPrefetcher(train_chunk_files, depth=prefetch_depth, max_bytes=prefetch_mb * 2 ** 20)
+        # Positions from up to shuffle_rows / CHUNK_SIZE chunks are mixed
+        # together, so that minibatches aren't all from the same few games.
+        train_datasets = ShuffleBuffer((dataset for file, dataset in chunks), max_rows=shuffle_rows)
+        last_wait_seconds = 0
+        for train_dataset in train_datasets:
+            print("Training on %s mixed positions" % train_dataset.data_size)
+            print("load wait: %.3f" % (chunks.wait_seconds - last_wait_seconds))
+            last_wait_seconds = chunks.wait_seconds
             with timer("training"):
                 n.train(train_dataset)
             with timer("save model"):
                 n.save_variables(save_file)
-            if n.get_global_step() > last_save_checkpoint + checkpoint_freq:
+            if test_dataset is not None and n.get_global_step() > last_save_checkpoint + checkpoint_freq:
                 with timer("test set evaluation"):
                     n.check_accuracy(test_dataset)
                 last_save_checkpoint = n.get_global_step()
+        print("Epoch %d: %.3fs waiting for chunks to load" % (i, chunks.wait_seconds))
+
 
+def convert(processed_dir="processed_data"):
+    'Writes an uncompressed, memory-mappable copy of each chunk, which train then uses instead.'
+    for fname in sorted(os.listdir(processed_dir)):
+        if TRAINING_CHUNK_RE.match(fname) or TEST_CHUNK_RE.match(fname):
+            if fname.endswith(".gz"):
+                print("Converting %s" % fname)
+                convert_chunk(os.path.join(processed_dir, fname))
 
 
 parser = argparse.ArgumentParser()
-argh.add_commands(parser, [gtp, preprocess, train])
+argh.add_commands(parser, [gtp, preprocess, train, convert])
 
 if __name__ == '__main__':
     argh.dispatch(parser)
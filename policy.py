@@ -30,9 +30,13 @@ import go
 import utils
 
 EPSILON = 1e-35
+# Memory budget for each of the feature and output caches used by run().
+CACHE_BYTES = 2 ** 27
 
 class PolicyNetwork(object):
-    def __init__(self, features=features.DEFAULT_FEATURES, k=32, num_int_conv_layers=3, use_cpu=False):
+    def __init__(self, features=features.DEFAULT_FEATURES, k=32, num_int_conv_layers=3, use_cpu=False, board_size=None,
+                 cache_bytes=CACHE_BYTES):
+        self.board_size = board_size or go.N
         self.num_input_planes = sum(f.planes for f in features)
         self.features = features
         self.k = k
@@ -41,6 +45,9 @@ class PolicyNetwork(object):
         self.training_summary_writer = None
         self.test_stats = StatisticsCollector()
         self.training_stats = StatisticsCollector()
+        # MCTS and GTP undo revisit the same positions over and over.
+        self.feature_cache = utils.LRUCache(cache_bytes)
+        self.output_cache = utils.LRUCache(cache_bytes)
         self.session = tf.Session()
         if use_cpu:
             with tf.device("/cpu:0"):
@@ -51,8 +58,8 @@ class PolicyNetwork(object):
     def set_up_network(self):
         # a global_step variable allows epoch counts to persist through multiple training sessions
         global_step = tf.Variable(0, name="global_step", trainable=False)
-        x = tf.placeholder(tf.float32, [None, go.N, go.N, self.num_input_planes])
-        y = tf.placeholder(tf.float32, shape=[None, go.N ** 2])
+        x = tf.placeholder(tf.float32, [None, self.board_size, self.board_size, self.num_input_planes])
+        y = tf.placeholder(tf.float32, shape=[None, self.board_size ** 2])
 
         #convenience functions for initializing weights and biases
         def _weight_variable(shape, name):
@@ -81,10 +88,10 @@ class PolicyNetwork(object):
                 _current_h_conv = h_conv_intermediate[-1]
 
         W_conv_final = _weight_variable([1, 1, self.k, 1], name="W_conv_final")
-        b_conv_final = tf.Variable(tf.constant(0, shape=[go.N ** 2], dtype=tf.float32), name="b_conv_final")
+        b_conv_final = tf.Variable(tf.constant(0, shape=[self.board_size ** 2], dtype=tf.float32), name="b_conv_final")
         h_conv_final = _conv2d(h_conv_intermediate[-1], W_conv_final)
 
-        logits = tf.reshape(h_conv_final, [-1, go.N ** 2]) + b_conv_final
+        logits = tf.reshape(h_conv_final, [-1, self.board_size ** 2]) + b_conv_final
         output = tf.nn.softmax(logits)
 
         log_likelihood_cost = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits=logits, labels=y))
@@ -118,6 +125,8 @@ class PolicyNetwork(object):
         self.session.run(tf.global_variables_initializer())
         if save_file is not None:
             self.saver.restore(self.session, save_file)
+        # the weights changed, so the old outputs are stale
+        self.output_cache.clear()
 
     def get_global_step(self):
         return self.session.run(self.global_step)
@@ -135,6 +144,7 @@ class PolicyNetwork(object):
                 [self.train_step, self.accuracy, self.log_likelihood_cost],
                 feed_dict={self.x: batch_x, self.y: batch_y})
             self.training_stats.report(accuracy, cost)
+        self.output_cache.clear()
 
         avg_accuracy, avg_cost, accuracy_summaries = self.training_stats.collect()
         global_step = self.get_global_step()
@@ -149,9 +159,13 @@ class PolicyNetwork(object):
 
     def run(self, position):
         'Return a sorted list of (probability, move) tuples'
-        processed_position = features.extract_features(position, features=self.features)
+        key = features.cache_key(position, self.features)
+        probabilities = self.output_cache.get(key)
+        if probabilities is not None:
+            return probabilities
+        processed_position = features.extract_features(position, features=self.features, cache=self.feature_cache)
         probabilities = self.session.run(self.output, feed_dict={self.x: processed_position[None, :]})[0]
-        return probabilities.reshape([go.N, go.N])
+        return self.output_cache.put(key, probabilities.reshape([self.board_size, self.board_size]))
 
     def check_accuracy(self, test_data, batch_size=128):
         num_minibatches = test_data.data_size // batch_size
@@ -10,6 +10,7 @@ Most of the complexity here is dealing with two features of SGF:
 from collections import namedtuple
 import numpy as np
 
+from features import start_incremental_features
 import go
 from go import Position
 from utils import parse_sgf_coords as pc
@@ -46,8 +47,12 @@ def sgf_prop(value_list):
 def sgf_prop_get(props, key, default):
     return sgf_prop(props.get(key, default))
 
-def handle_node(pos, node):
-    'A node can either add B+W stones, play as B, or play as W.'
+def handle_node(pos, node, mutate=False):
+    '''
+    A node can either add B+W stones, play as B, or play as W. Moves are
+    played without the superko check: the record is what happened, and
+    games played under e.g. Japanese rules can legally repeat a board.
+    '''
     props = node.properties
     black_stones_added = [pc(coords) for coords in props.get('AB', [])]
     white_stones_added = [pc(coords) for coords in props.get('AW', [])]
@@ -56,10 +61,10 @@ def handle_node(pos, node):
     # If B/W props are not present, then there is no move. But if it is present and equal to the empty string, then the move was a pass.
     elif 'B' in props:
         black_move = pc(props.get('B', [''])[0])
-        return pos.play_move(black_move, color=go.BLACK)
+        return pos.play_move(black_move, color=go.BLACK, mutate=mutate, superko=False)
     elif 'W' in props:
         white_move = pc(props.get('W', [''])[0])
-        return pos.play_move(white_move, color=go.WHITE)
+        return pos.play_move(white_move, color=go.WHITE, mutate=mutate, superko=False)
     else:
         return pos
 
@@ -67,7 +72,12 @@ def add_stones(pos, black_stones_added, white_stones_added):
     working_board = np.copy(pos.board)
     go.place_stones(working_board, go.BLACK, black_stones_added)
     go.place_stones(working_board, go.WHITE, white_stones_added)
-    new_position = Position(board=working_board, n=pos.n, komi=pos.komi, caps=pos.caps, ko=pos.ko, recent=pos.recent, to_play=pos.to_play)
+    zobrist_keys = pos.geometry.zobrist_keys
+    zobrist_hash = pos.zobrist_hash
+    for c in zip(*np.nonzero(working_board != pos.board)):
+        zobrist_hash ^= zobrist_keys[pos.board[c]].item(c) ^ zobrist_keys[working_board[c]].item(c)
+    new_position = Position(board=working_board, n=pos.n, komi=pos.komi, caps=pos.caps, ko=pos.ko, recent=pos.recent, to_play=pos.to_play,
+                            zobrist_hash=zobrist_hash, seen_hashes=pos.seen_hashes)
     return new_position
 
 def get_next_move(node):
@@ -86,12 +96,25 @@ def maybe_correct_next(pos, next_node):
         ('W' in next_node.properties and not pos.to_play == go.WHITE)):
         pos.flip_playerturn(mutate=True)
 
-def replay_sgf(sgf_contents):
+def replay_sgf(sgf_contents, mutate=False, move_masks=False, features=None):
     '''
     Wrapper for sgf files, exposing contents as position_w_context instances
     with open(filename) as f:
         for position_w_context in replay_sgf(f.read()):
             print(position_w_context.position)
+
+    With mutate=True, moves are played on a single Position in place instead
+    of copying it every move, so each yielded position is only valid until the
+    next one is requested. Use this when each position is consumed immediately.
+
+    With move_masks=True, the positions' move masks (see
+    Position.legal_move_mask) are kept up to date move by move, for callers
+    that ask every position for its legal moves.
+
+    With features, a list of features, the positions carry a
+    features.IncrementalFeatures for them, so that extract_features only has
+    to update the planes where each move changed something. With mutate=True
+    as well, that replaces building every position's features from scratch.
     '''
     collection = sgf.parse(sgf_contents)
     game = collection.children[0]
@@ -105,12 +128,15 @@ def replay_sgf(sgf_contents):
         result=sgf_prop(props.get('RE')),
         handicap=int(sgf_prop(props.get('HA', [0]))),
         board_size=int(sgf_prop(props.get('SZ'))))
-    go.set_board_size(metadata.board_size)
 
-    pos = Position(komi=komi)
+    pos = Position(komi=komi, geometry=go.get_geometry(metadata.board_size))
     current_node = game.root
     while pos is not None and current_node is not None:
-        pos = handle_node(pos, current_node)
+        pos = handle_node(pos, current_node, mutate=mutate)
+        if move_masks:
+            pos.start_move_masks()
+        if features is not None:
+            start_incremental_features(pos, features)
         maybe_correct_next(pos, current_node.next)
         next_move = get_next_move(current_node)
         yield PositionWithContext(pos, next_move, metadata)
@@ -128,11 +154,10 @@ def replay_position(position):
     metadata = GameMetadata(
         result=position.result(),
         handicap=0,
-        board_size=position.board.shape[0]
+        board_size=position.geometry.n
     )
-    go.set_board_size(metadata.board_size)
 
-    pos = Position(komi=position.komi)
+    pos = Position(komi=position.komi, geometry=position.geometry)
     for player_move in position.recent:
         color, next_move = player_move
         yield PositionWithContext(pos, next_move, metadata)
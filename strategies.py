@@ -1,4 +1,3 @@
-import copy
 import math
 import random
 import sys
@@ -6,13 +5,10 @@ import time
 import numpy as np
 import gtp
 
+import features
 import go
 import utils
 
-def sorted_moves(probability_array):
-    coords = [(a, b) for a in range(go.N) for b in range(go.N)]
-    return sorted(coords, key=lambda c: probability_array[c], reverse=True)
-
 def translate_gtp_colors(gtp_color):
     if gtp_color == gtp.BLACK:
         return go.BLACK
@@ -22,42 +18,38 @@ def translate_gtp_colors(gtp_color):
         return go.EMPTY
 
 def is_move_reasonable(position, move):
-    return position.is_move_legal(move) and go.is_eyeish(position.board, move) != position.to_play
+    return position.is_move_legal(move) and position.is_eyeish(move) != position.to_play
 
 def select_most_likely(position, move_probabilities):
-    for move in sorted_moves(move_probabilities):
-        if is_move_reasonable(position, move):
-            return move
-    return None
+    'Returns the most likely reasonable move, or None (pass) if there are none.'
+    reasonable = position.sensible_move_mask()
+    if not reasonable.any():
+        return None
+    masked_probabilities = np.where(reasonable, move_probabilities, -1)
+    return divmod(int(np.argmax(masked_probabilities)), reasonable.shape[1])
 
 def select_weighted_random(position, move_probabilities):
-    selection = random.random()
-    selected_move = None
-    current_probability = 0
-    # technically, don't have to sort in order to correctly simulate a random
-    # draw, but it cuts down on how many additions we do.
-    for move, move_prob in np.ndenumerate(move_probabilities):
-        current_probability += move_prob
-        if current_probability > selection:
-            selected_move = move
-            break
-    if is_move_reasonable(position, selected_move):
-        return selected_move
-    else:
-        # fallback in case the selected move was illegal
+    'Samples a reasonable move in proportion to its probability.'
+    reasonable = position.sensible_move_mask()
+    cumulative_probabilities = np.cumsum(np.where(reasonable, move_probabilities, 0))
+    if not cumulative_probabilities[-1] > 0:
+        # nothing reasonable has any probability
         return select_most_likely(position, move_probabilities)
+    selection = random.random() * cumulative_probabilities[-1]
+    selected_index = np.searchsorted(cumulative_probabilities, selection, side='right')
+    return divmod(int(selected_index), reasonable.shape[1])
 
 
 class GtpInterface(object):
-    def __init__(self):
-        self.size = 9
+    def __init__(self, size=None):
+        # until a boardsize command says otherwise
+        self.size = size or go.N
         self.position = None
         self.komi = 6.5
         self.clear()
 
     def set_size(self, n):
         self.size = n
-        go.set_board_size(n)
         self.clear()
 
     def set_komi(self, komi):
@@ -65,14 +57,14 @@ class GtpInterface(object):
         self.position.komi = komi
 
     def clear(self):
-        self.position = go.Position(komi=self.komi)
+        self.position = go.Position(komi=self.komi, geometry=go.get_geometry(self.size))
 
     def accomodate_out_of_turn(self, color):
         if not translate_gtp_colors(color) == self.position.to_play:
             self.position.flip_playerturn(mutate=True)
 
     def make_move(self, color, vertex):
-        coords = utils.parse_pygtp_coords(vertex)
+        coords = utils.parse_pygtp_coords(vertex, self.size)
         self.accomodate_out_of_turn(color)
         self.position = self.position.play_move(coords, color=translate_gtp_colors(color))
         return self.position is not None
@@ -80,25 +72,23 @@ class GtpInterface(object):
     def get_move(self, color):
         self.accomodate_out_of_turn(color)
         move = self.suggest_move(self.position)
-        return utils.unparse_pygtp_coords(move)
+        return utils.unparse_pygtp_coords(move, self.size)
 
     def suggest_move(self, position):
         raise NotImplementedError
 
 class RandomPlayer(GtpInterface):
     def suggest_move(self, position):
-        possible_moves = go.ALL_COORDS[:]
-        random.shuffle(possible_moves)
-        for move in possible_moves:
-            if is_move_reasonable(position, move):
-                return move
-        return None
+        possible_moves = np.argwhere(position.sensible_move_mask())
+        if not len(possible_moves):
+            return None
+        return tuple(random.choice(possible_moves).tolist())
 
 class PolicyNetworkBestMovePlayer(GtpInterface):
     def __init__(self, policy_network, read_file):
         self.policy_network = policy_network
         self.read_file = read_file
-        super().__init__()
+        super().__init__(size=policy_network.board_size)
 
     def clear(self):
         super().clear()
@@ -120,7 +110,7 @@ class PolicyNetworkRandomMovePlayer(GtpInterface):
     def __init__(self, policy_network, read_file):
         self.policy_network = policy_network
         self.read_file = read_file
-        super().__init__()
+        super().__init__(size=policy_network.board_size)
 
     def clear(self):
         super().clear()
@@ -146,9 +136,11 @@ class MCTSNode():
     A MCTSNode has two states: plain, and expanded.
     An plain MCTSNode merely knows its Q + U values, so that a decision
     can be made about which MCTS node to expand during the selection phase.
-    When expanded, a MCTSNode also knows the actual position at that node,
-    as well as followup moves/probabilities via the policy network.
-    Each of these followup moves is instantiated as a plain MCTSNode.
+    When expanded, a MCTSNode also knows followup moves/probabilities via the
+    policy network. Each of these followup moves is instantiated as a plain
+    MCTSNode.
+    Only the root node holds a position; the position at any other node is
+    reached by pushing the moves on the path from the root onto it.
     '''
     @staticmethod
     def root_node(position, move_probabilities):
@@ -161,7 +153,7 @@ class MCTSNode():
         self.parent = parent # pointer to another MCTSNode
         self.move = move # the move that led to this node
         self.prior = prior
-        self.position = None # lazily computed upon expansion
+        self.position = None # only set for the root node
         self.children = {} # map of moves to resulting MCTSNode
         self.Q = self.parent.Q if self.parent is not None else 0 # average of all outcomes involving this node
         self.U = prior # monte carlo exploration bonus
@@ -178,11 +170,16 @@ class MCTSNode():
         return self.Q + self.U
 
     def is_expanded(self):
-        return self.position is not None
+        return bool(self.children)
 
-    def compute_position(self):
-        self.position = self.parent.position.play_move(self.move)
-        return self.position
+    def path_from_root(self):
+        'Returns the nodes leading from the root (exclusive) to this node (inclusive).'
+        path = []
+        current = self
+        while current.parent is not None:
+            path.append(current)
+            current = current.parent
+        return path[::-1]
 
     def expand(self, move_probabilities):
         self.children = {move: MCTSNode(self, move, prob)
@@ -214,9 +211,8 @@ class MCTS(GtpInterface):
     def __init__(self, policy_network, read_file, seconds_per_move=5):
         self.policy_network = policy_network
         self.seconds_per_move = seconds_per_move
-        self.max_rollout_depth = go.N * go.N * 3
         self.read_file = read_file
-        super().__init__()
+        super().__init__(size=policy_network.board_size)
 
     def clear(self):
         super().clear()
@@ -231,58 +227,70 @@ class MCTS(GtpInterface):
         if position.caps[0] + 50 < position.caps[1]:
             return gtp.RESIGN
         start = time.time()
+        # The search pushes and pops moves on position, and each policy run
+        # only has to update the features around the stones that changed.
+        features.start_incremental_features(position, self.policy_network.features)
         move_probs = self.policy_network.run(position)
         root = MCTSNode.root_node(position, move_probs)
         while time.time() - start < self.seconds_per_move:
             self.tree_search(root)
+        print("policy output cache: %s" % self.policy_network.output_cache, file=sys.stderr)
         # there's a theoretical bug here: if you refuse to pass, this AI will
         # eventually start filling in its own eyes.
         return max(root.children.keys(), key=lambda move, root=root: root.children[move].N)
 
     def tree_search(self, root):
         print("tree search", file=sys.stderr)
-        # selection
-        chosen_leaf = root.select_leaf()
-        # expansion
-        position = chosen_leaf.compute_position()
-        if position is None:
-            print("illegal move!", file=sys.stderr)
-            # See go.Position.play_move for notes on detecting legality
-            del chosen_leaf.parent.children[chosen_leaf.move]
-            return
-        print("Investigating following position:\n%s" % (chosen_leaf.position,), file=sys.stderr)
-        move_probs = self.policy_network.run(position)
-        chosen_leaf.expand(move_probs)
-        # evaluation
-        value = self.estimate_value(root, chosen_leaf)
-        # backup
-        print("value: %s" % value, file=sys.stderr)
-        chosen_leaf.backup_value(value)
-
-    def estimate_value(self, root, chosen_leaf):
+        # The root position is walked in place with push_move, and restored
+        # with pop_move before returning.
+        position = root.position
+        root_to_play = position.to_play
+        depth = 0
+        try:
+            # selection
+            chosen_leaf = root.select_leaf()
+            # expansion
+            try:
+                for node in chosen_leaf.path_from_root():
+                    position.push_move(node.move)
+                    depth += 1
+            except go.IllegalMove:
+                print("illegal move!", file=sys.stderr)
+                # See go.Position.play_move for notes on detecting legality
+                del chosen_leaf.parent.children[chosen_leaf.move]
+                return
+            print("Investigating following position:\n%s" % (position,), file=sys.stderr)
+            move_probs = self.policy_network.run(position)
+            chosen_leaf.expand(move_probs)
+            # evaluation
+            perspective = 1 if position.to_play == root_to_play else -1
+            value = self.estimate_value(position) * perspective
+            # backup
+            print("value: %s" % value, file=sys.stderr)
+            chosen_leaf.backup_value(value)
+        finally:
+            for _ in range(depth):
+                position.pop_move()
+
+    def estimate_value(self, position):
         # Estimate value of position using rollout only (for now).
         # (TODO: Value network; average the value estimations from rollout + value network)
-        leaf_position = chosen_leaf.position
-        current = copy.deepcopy(leaf_position)
-        while current.n < self.max_rollout_depth:
-            move_probs = self.policy_network.run(current)
-            current = self.play_valid_move(current, move_probs)
-            if len(current.recent) > 2 and current.recent[-1].move == current.recent[-2].move == None:
-                break
-        else:
-            print("max rollout depth exceeded!", file=sys.stderr)
-
-        perspective = 1 if leaf_position.to_play == root.position.to_play else -1
-        return current.score() * perspective
+        # The rollout is played on position in place, and undone afterwards.
+        max_rollout_depth = position.geometry.n ** 2 * 3
+        depth = 0
+        try:
+            while position.n < max_rollout_depth:
+                move_probs = self.policy_network.run(position)
+                self.play_valid_move(position, move_probs)
+                depth += 1
+                if len(position.recent) > 2 and position.recent[-1].move == position.recent[-2].move == None:
+                    break
+            else:
+                print("max rollout depth exceeded!", file=sys.stderr)
+            return position.score()
+        finally:
+            for _ in range(depth):
+                position.pop_move()
 
     def play_valid_move(self, position, move_probs):
-        for move in sorted_moves(move_probs):
-            if go.is_eyeish(position.board, move):
-                continue
-            try:
-                candidate_pos = position.play_move(move, mutate=True)
-            except go.IllegalMove:
-                continue
-            else:
-                return candidate_pos
-        return position.pass_move(mutate=True)
+        return position.push_move(select_most_likely(position, move_probs))
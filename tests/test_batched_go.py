@@ -0,0 +1,93 @@
+import random
+import numpy as np
+import go
+from batched_go import BatchedGame, PASS
+from test_utils import GoPositionTestCase
+from utils import parse_kgs_coords as pc, flatten_coords
+
+def play_random_games(test, num_games, num_steps, seed):
+    '''
+    Plays random games with a BatchedGame and with one Position per game, and
+    checks that they agree on every step.
+    '''
+    rng = random.Random(seed)
+    game = BatchedGame(num_games)
+    positions = [go.Position() for _ in range(num_games)]
+    for step in range(num_steps):
+        legal_moves = game.legal_moves()
+        moves = []
+        for k, position in enumerate(positions):
+            test.assertEqualNPArray(legal_moves[k], position.legal_move_mask())
+            candidates = np.flatnonzero(legal_moves[k]).tolist()
+            roll = rng.random()
+            if roll < 0.05 or not candidates:
+                moves.append(PASS)
+            elif roll < 0.15:
+                # sometimes try an illegal move, or the ko point.
+                illegal = np.flatnonzero(~legal_moves[k]).tolist()
+                moves.append(rng.choice(illegal) if illegal else PASS)
+            else:
+                moves.append(rng.choice(candidates))
+
+        was_finished = game.finished.copy()
+        result = game.step(moves)
+        for k, position in enumerate(positions):
+            if was_finished[k]:
+                continue
+            move = None if moves[k] == PASS else divmod(moves[k], go.N)
+            try:
+                new_position = position.play_move(move)
+            except go.IllegalMove:
+                test.assertFalse(result.legal[k])
+                continue
+            test.assertTrue(result.legal[k])
+            test.assertEqual(result.passed[k], move is None)
+            captured = set(zip(*np.nonzero(result.captures[k])))
+            test.assertEqual(captured, set(zip(*np.nonzero((position.board != go.EMPTY) & (new_position.board == go.EMPTY)))))
+            positions[k] = new_position
+
+        for k, position in enumerate(positions):
+            test.assertEqualNPArray(game.boards[k], position.board)
+            test.assertEqual(game.to_play[k], position.to_play)
+            test.assertEqual(tuple(game.caps[k]), position.caps)
+            test.assertEqual(game.n[k], position.n)
+            test.assertEqual(None if game.ko[k] == PASS else divmod(int(game.ko[k]), go.N), position.ko)
+            test.assertEqual(int(game.board_hashes[k]), position.board_hash())
+    return game, positions
+
+class TestBatchedGame(GoPositionTestCase):
+    def test_random_games_match_position(self):
+        game, positions = play_random_games(self, num_games=6, num_steps=150, seed=1)
+        self.assertEqual(game.score().tolist(), [position.score() for position in positions])
+
+    def test_many_games_share_seen_hashes(self):
+        # Enough games that the same boards come up in several of them, and
+        # enough steps for superko to matter.
+        game, positions = play_random_games(self, num_games=16, num_steps=200, seed=2)
+        self.assertTrue((game._seen_hashes[1:] >= game._seen_hashes[:-1]).all())
+
+    def test_capture_and_ko(self):
+        game = BatchedGame(1)
+        for move in 'C5 E6 D6 E4 D4 F5 A9 D5'.split():
+            self.assertTrue(game.step([flatten_coords(pc(move))]).legal.all())
+        result = game.step([flatten_coords(pc('E5'))])
+        self.assertEqual(set(zip(*np.nonzero(result.captures[0]))), {pc('D5')})
+        self.assertEqual(game.ko[0], flatten_coords(pc('D5')))
+        self.assertEqual(tuple(game.caps[0]), (1, 0))
+        self.assertFalse(game.legal_moves()[0][pc('D5')])
+        boards = game.boards.copy()
+        result = game.step([flatten_coords(pc('D5'))])
+        self.assertFalse(result.legal[0])
+        self.assertEqualNPArray(game.boards, boards)
+        self.assertEqual(game.to_play[0], go.WHITE)
+
+    def test_finished(self):
+        game = BatchedGame(3)
+        game.step([PASS, PASS, flatten_coords(pc('E5'))])
+        game.step([PASS, flatten_coords(pc('E5')), PASS])
+        result = game.step([flatten_coords(pc('A1')), PASS, PASS])
+        self.assertEqual(result.finished.tolist(), [True, False, True])
+        self.assertEqual(result.passed.tolist(), [False, True, True])
+        # moves for finished games are ignored.
+        self.assertEqual(game.boards[0].tolist(), go.EMPTY_BOARD.tolist())
+        self.assertEqual(game.score().tolist(), [-7.5, -88.5, 73.5])
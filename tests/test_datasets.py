@@ -1,6 +1,17 @@
+import contextlib
+import gzip
+import io
+import multiprocessing
 import numpy as np
 import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+from unittest import mock
 from test_utils import GoPositionTestCase
+import features
 import go
 import load_data_sets
 
@@ -29,6 +40,223 @@ class TestDataSets(GoPositionTestCase):
         self.assertEqualNPArray(dataset.next_moves, recovered.next_moves)
         self.assertEqualNPArray(dataset.pos_features, recovered.pos_features)
 
+    def test_packed_features(self):
+        sgf_files = list(load_data_sets.find_sgf_files(TEST_DIR))
+        positions_w_context = list(load_data_sets.get_positions_from_sgf(sgf_files[0]))[:50]
+        positions = [position for position, _, _ in positions_w_context]
+        extracted = features.bulk_extract_features(positions)
+        packed = features.bulk_extract_packed_features(positions, batch_size=16)
+        self.assertEqualNPArray(packed, features.pack_features(extracted))
+        self.assertEqualNPArray(features.unpack_features(packed, extracted.shape[1:]), extracted)
+
+        dataset = load_data_sets.DataSet.from_positions_w_context(positions_w_context)
+        self.assertEqual(dataset.packed_features.shape, (50, (19 * 19 * dataset.input_planes + 7) // 8))
+        batch_x, batch_y = dataset.get_batch(10)
+        self.assertEqual(batch_x.shape, (10, 19, 19, dataset.input_planes))
+        # each unpacked row is the features of the position that goes with the move
+        expected = {bytes(np.packbits(x)) + bytes(y) for x, y in zip(extracted, load_data_sets.make_onehot(
+            [move for _, move, _ in positions_w_context], 19))}
+        for x, y in zip(batch_x, batch_y):
+            self.assertIn(bytes(np.packbits(x)) + bytes(y), expected)
+
+    def test_read_whole_array_packed_chunk(self):
+        # chunks written before features were packed row by row
+        pos_features = np.random.randint(2, size=[3, 9, 9, 5]).astype(np.uint8)
+        next_moves = np.eye(81, dtype=np.uint8)[[4, 5, 6]]
+        with gzip.open(TEMP_FILE_NAME, "wb") as f:
+            f.write(struct.pack(load_data_sets.LEGACY_CHUNK_HEADER_FORMAT, 3, 9, 5, False))
+            f.write(np.packbits(pos_features).tostring())
+            f.write(np.packbits(next_moves).tostring())
+        recovered = load_data_sets.DataSet.read(TEMP_FILE_NAME)
+        order = np.argmax(recovered.next_moves, axis=1) - 4
+        self.assertEqualNPArray(recovered.pos_features, pos_features[order])
+
+    def test_chunk_format_version(self):
+        # two 9x9x5 rows take as many bytes packed together as packed one by
+        # one, so only the version says how they're laid out
+        pos_features = np.random.randint(2, size=[2, 9, 9, 5]).astype(np.uint8)
+        next_moves = np.eye(81, dtype=np.uint8)[[4, 5]]
+        dataset = load_data_sets.DataSet(pos_features, next_moves, [], shuffle=False)
+        dataset.write(TEMP_FILE_NAME)
+        with gzip.open(TEMP_FILE_NAME, "rb") as f:
+            self.assertEqual(f.read(4), load_data_sets.CHUNK_MAGIC + bytes([load_data_sets.CHUNK_VERSION]))
+        recovered = load_data_sets.DataSet.read(TEMP_FILE_NAME)
+        order = np.argmax(recovered.next_moves, axis=1) - 4
+        self.assertEqualNPArray(recovered.pos_features, pos_features[order])
+
+        with gzip.open(TEMP_FILE_NAME, "wb") as f:
+            f.write(load_data_sets.CHUNK_HEADER.pack(load_data_sets.CHUNK_MAGIC, 99, 2, 9, 5, False))
+        with self.assertRaises(ValueError):
+            load_data_sets.DataSet.read(TEMP_FILE_NAME)
+
+    def test_preprocess_files(self):
+        sgf_file = list(load_data_sets.find_sgf_files(TEST_DIR))[0]
+        positions_w_context = list(load_data_sets.get_positions_from_sgf(sgf_file))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sgf_files = []
+            for i in range(6):
+                sgf_files.append(os.path.join(tmp_dir, "game%s.sgf" % i))
+                shutil.copy(sgf_file, sgf_files[-1])
+            is_test = [load_data_sets.is_test_file(f, test_fraction=0.5) for f in sgf_files]
+            # the split depends only on the file name
+            self.assertEqual(is_test, [load_data_sets.is_test_file("other/dir/game%s.sgf" % i, 0.5) for i in range(6)])
+            self.assertIn(True, is_test)
+            self.assertIn(False, is_test)
+
+            outputs = []
+            for workers in (1, 3):
+                processed_dir = os.path.join(tmp_dir, "processed%s" % workers)
+                os.mkdir(processed_dir)
+                num_chunks = load_data_sets.preprocess_files(
+                    sgf_files, processed_dir, workers=workers, chunk_size=100, test_fraction=0.5)
+                output = {}
+                for name in os.listdir(processed_dir):
+                    with open(os.path.join(processed_dir, name), "rb") as f:
+                        output[name] = gzip.decompress(f.read())
+                outputs.append(output)
+            # the same chunks whatever the number of workers
+            self.assertEqual(outputs[0], outputs[1])
+            num_test_positions = is_test.count(True) * len(positions_w_context)
+            num_training_positions = is_test.count(False) * len(positions_w_context)
+            self.assertEqual(num_chunks, ((num_test_positions + 99) // 100, (num_training_positions + 99) // 100))
+            self.assertEqual(len(outputs[0]), sum(num_chunks))
+
+            # the test set is exactly the positions of the test games
+            test_dataset = load_data_sets.DataSet.concatenate([
+                load_data_sets.DataSet.read(os.path.join(processed_dir, "test%s.chunk.gz" % i))
+                for i in range(num_chunks[0])])
+            self.assertTrue(test_dataset.is_test)
+            self.assertEqual(test_dataset.data_size, num_test_positions)
+
+            # and chunks hold the same as preprocessing their positions directly
+            training_positions = positions_w_context * is_test.count(False)
+            expected_file = os.path.join(tmp_dir, "expected.chunk.gz")
+            DataSet = load_data_sets.DataSet
+            DataSet.from_positions_w_context(training_positions[100:200], shuffle=False).write(expected_file)
+            with open(expected_file, "rb") as f:
+                self.assertEqual(gzip.decompress(f.read()), outputs[0]["train1.chunk.gz"])
+
+    def test_skip_illegal_game(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sgf_file = os.path.join(tmp_dir, "illegal.sgf")
+            with open(sgf_file, "w") as f:
+                # white plays on top of black's stone
+                f.write("(;GM[1]FF[4]SZ[9]KM[6.50];B[ee];W[ee])")
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr):
+                packed_features, next_moves, results = load_data_sets.extract_sgf_file(sgf_file)[:3]
+            self.assertIn("Skipping", stderr.getvalue())
+            self.assertEqual(len(packed_features), 0)
+            self.assertEqual(len(next_moves), 0)
+            self.assertEqual(results, [])
+
+    @unittest.skipUnless(multiprocessing.get_start_method() == 'fork', "workers need to see the patched function")
+    def test_worker_dies(self):
+        def crash_on_second_game(filename):
+            if filename == "game1.sgf":
+                os._exit(3)
+            return filename
+        with mock.patch.object(load_data_sets, 'extract_sgf_file', crash_on_second_game):
+            extracted = load_data_sets.extract_in_workers(["game0.sgf", "game1.sgf", "game2.sgf"], workers=2)
+            self.assertEqual(next(extracted), "game0.sgf")
+            with self.assertRaisesRegex(RuntimeError, "exit code 3"):
+                next(extracted)
+
+    def test_preprocess_files_no_test_files(self):
+        sgf_file = list(load_data_sets.find_sgf_files(TEST_DIR))[0]
+        num_positions = len(list(load_data_sets.get_positions_from_sgf(sgf_file)))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sgf_files = []
+            for i in range(3):
+                sgf_files.append(os.path.join(tmp_dir, "game%s.sgf" % i))
+                shutil.copy(sgf_file, sgf_files[-1])
+            processed_dir = os.path.join(tmp_dir, "processed")
+            os.mkdir(processed_dir)
+            # nothing hashes into an empty test set, so the first game goes there
+            num_chunks = load_data_sets.preprocess_files(
+                sgf_files, processed_dir, chunk_size=num_positions, test_fraction=0)
+            self.assertEqual(num_chunks, (1, 2))
+            test_dataset = load_data_sets.DataSet.read(os.path.join(processed_dir, "test0.chunk.gz"))
+            self.assertTrue(test_dataset.is_test)
+            self.assertEqual(test_dataset.data_size, num_positions)
+
+    def test_uncompressed_chunk(self):
+        pos_features = np.random.randint(2, size=[40, 9, 9, 5]).astype(np.uint8)
+        next_moves = np.eye(81, dtype=np.uint8)[np.random.randint(81, size=40)]
+        dataset = load_data_sets.DataSet(pos_features, next_moves, [], is_test=True)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gz_filename = os.path.join(tmp_dir, "test0.chunk.gz")
+            dataset.write(gz_filename)
+            filename = load_data_sets.convert_chunk(gz_filename)
+            self.assertEqual(filename, os.path.join(tmp_dir, "test0.chunk"))
+            recovered = load_data_sets.DataSet.load(filename)
+            self.assertIsInstance(recovered.packed_features, np.memmap)
+            self.assertTrue(recovered.is_test)
+            self.assertEqual(recovered.feature_shape, (9, 9, 5))
+            self.assertEqualNPArray(recovered.pos_features, pos_features)
+            self.assertEqualNPArray(recovered.next_moves, next_moves)
+            # minibatches pair each position with its move
+            expected = {bytes(x) + bytes(y) for x, y in zip(pos_features, next_moves)}
+            for _ in range(5):
+                batch_x, batch_y = recovered.get_batch(16)
+                self.assertEqual(batch_x.shape, (16, 9, 9, 5))
+                for x, y in zip(batch_x, batch_y):
+                    self.assertIn(bytes(x) + bytes(y), expected)
+            del recovered
+
+    def test_chunk_prefetcher(self):
+        datasets = {}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for i in range(5):
+                filename = os.path.join(tmp_dir, "train%s.chunk.gz" % i)
+                pos_features = np.random.randint(2, size=[10, 9, 9, 3]).astype(np.uint8)
+                datasets[filename] = load_data_sets.DataSet(pos_features, np.eye(81, dtype=np.uint8)[:10], [])
+                datasets[filename].write(filename)
+            filenames = sorted(datasets)
+
+            loaded = []
+            def slow_load(filename):
+                loaded.append(filename)
+                return load_data_sets.DataSet.load(filename)
+            for depth, max_bytes, most_ahead in ((2, 2 ** 20, 2), (3, 1, 1)):
+                loaded.clear()
+                chunks = load_data_sets.ChunkPrefetcher(filenames, depth=depth, max_bytes=max_bytes, load=slow_load)
+                for i, (filename, dataset) in enumerate(chunks):
+                    self.assertEqual(filename, filenames[i])
+                    self.assertEqualNPArray(dataset.pos_features, datasets[filename].pos_features)
+                    time.sleep(0.05)
+                    # loading runs ahead, but no further than allowed
+                    self.assertEqual(len(loaded), min(len(filenames), i + 1 + most_ahead))
+                self.assertGreaterEqual(chunks.wait_seconds, 0)
+
+            chunks = load_data_sets.ChunkPrefetcher(filenames + [os.path.join(tmp_dir, "missing.chunk.gz")])
+            with self.assertRaises(IOError):
+                list(chunks)
+
+    def test_shuffle_buffer(self):
+        # 6 chunks of 20 positions, each position with its own next move
+        datasets = []
+        for i in range(6):
+            pos_features = np.zeros([20, 9, 9, 2], dtype=np.uint8)
+            # which chunk a position came from
+            pos_features[:, 0, i, 0] = 1
+            next_moves = np.eye(81, dtype=np.uint8)[np.arange(20) + 20 * (i % 4)]
+            datasets.append(load_data_sets.DataSet(pos_features, next_moves, [], shuffle=False))
+        shuffle_buffer = load_data_sets.ShuffleBuffer(iter(datasets), max_rows=50, rows_per_dataset=15)
+        seen = []
+        for dataset in shuffle_buffer:
+            self.assertLessEqual(dataset.data_size, 15)
+            self.assertLessEqual(shuffle_buffer.packed_features.shape[0], 50)
+            chunk_ids = np.argmax(dataset.pos_features[:, 0, :, 0], axis=1)
+            seen.extend(zip(chunk_ids.tolist(), np.argmax(dataset.next_moves, axis=1).tolist()))
+            if len(seen) == 15:
+                # the first dataset mixes positions from several chunks
+                self.assertGreater(len(set(chunk_ids.tolist())), 1)
+        expected = [(i, j + 20 * (i % 4)) for i in range(6) for j in range(20)]
+        # every position exactly once
+        self.assertEqual(sorted(seen), expected)
+        self.assertNotEqual(seen, expected)
+
 class TestDataSetHelpers(GoPositionTestCase):
     def test_onehot(self):
         go.set_board_size(9)
@@ -1,7 +1,11 @@
+import copy
+import random
+
 import numpy as np
 
 import features
 import go
+import utils
 from test_utils import load_board, GoPositionTestCase
 
 go.set_board_size(9)
@@ -95,3 +99,175 @@ class TestFeatureExtraction(GoPositionTestCase):
         self.assertEqual(f[0, 7, 2], 1)
         self.assertEqual(f[0, 7, 1], 0)
 
+    def test_self_atari_feature(self):
+        position = go.Position(board=load_board('''
+            .XO.O....
+            XO.......
+            .X.......
+        ''' + EMPTY_ROW * 6), to_play=go.WHITE)
+        f = features.self_atari_feature(position)
+        self.assertEqual(f.shape, (9, 9, features.self_atari_feature.planes))
+        # W at (0, 0) captures (0, 1), but is left with just that liberty
+        self.assertEqual(f[0, 0, 0], 1)
+        # W at (2, 0) has one liberty at (3, 0)
+        self.assertEqual(f[2, 0, 0], 1)
+        # W at (0, 3) joins (0, 2) and (0, 4), with plenty of liberties
+        self.assertEqual(f[0, 3].sum(), 0)
+        self.assertEqual(np.count_nonzero(f), 2)
+
+    def test_move_consequences(self):
+        # against actually playing every legal move
+        for position in [TEST_POSITION, TEST_POSITION2] + random_game_positions(200)[::10]:
+            liberties_after, group_sizes = features.move_consequences(position)
+            for move in np.argwhere(position.legal_move_mask()).tolist():
+                move = tuple(move)
+                played = position.play_move(move)
+                self.assertEqual(liberties_after[move], len(played.lib_tracker.liberties_at(move)))
+                self.assertEqual(group_sizes[move], np.count_nonzero(played.lib_tracker.group_index == played.lib_tracker.group_index[move]))
+
+    def test_sensibleness_feature(self):
+        f = features.sensibleness_feature(TEST_POSITION)
+        self.assertEqual(f.shape, (9, 9, 1))
+        # (0, 0) is black's own eye
+        self.assertEqual(f[0, 0, 0], 0)
+        self.assertEqual(f[0, 2, 0], 1)
+        self.assertEqual(f[0, 8, 0], 0)
+
+    def test_extract_features_cache(self):
+        cache = utils.LRUCache(max_bytes=2 ** 20)
+        extracted = features.extract_features(TEST_POSITION, cache=cache)
+        self.assertEqualNPArray(extracted, features.extract_features(TEST_POSITION))
+        # the same position reached another way
+        same_position = go.Position(board=TEST_BOARD, komi=6.5, caps=(1, 2), recent=TEST_POSITION.recent, to_play=go.BLACK)
+        self.assertIs(features.extract_features(same_position, cache=cache), extracted)
+        # a different feature set, or different recent moves, is a different entry
+        self.assertEqual(features.extract_features(TEST_POSITION, [features.ones_feature], cache=cache).shape, (9, 9, 1))
+        features.extract_features(TEST_POSITION.pass_move().pass_move(), cache=cache)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 3, 3))
+
+    def test_intermediates_computed_once(self):
+        calls = []
+        @features.intermediate
+        @features.needs('legal_moves')
+        def legal_move_count(position, legal_moves):
+            calls.append(position)
+            return np.count_nonzero(legal_moves)
+        try:
+            @features.planes(1)
+            @features.needs('legal_move_count')
+            def count_feature(position, legal_move_count):
+                return np.full(position.board.shape + (1,), legal_move_count, dtype=np.uint8)
+            # called on its own, a feature computes what it needs
+            self.assertEqual(count_feature(TEST_POSITION)[0, 0, 0], 68)
+            self.assertEqual(len(calls), 1)
+            timings = {}
+            extracted = features.extract_features(TEST_POSITION, [count_feature, count_feature, features.sensibleness_feature], timings=timings)
+            self.assertEqual(extracted.shape, (9, 9, 3))
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(set(timings), {'count_feature', 'legal_move_count', 'legal_moves', 'sensibleness_feature'})
+        finally:
+            del features.INTERMEDIATES['legal_move_count']
+
+
+def random_game_positions(num_moves, seed=0):
+    'The positions of a random game, with plenty of captures and passes.'
+    rng = np.random.RandomState(seed)
+    position = go.Position()
+    positions = []
+    for i in range(num_moves):
+        positions.append(position)
+        legal_moves = np.argwhere(position.sensible_move_mask())
+        if len(legal_moves) == 0 or rng.rand() < 0.05:
+            position = position.pass_move()
+        else:
+            position = position.play_move(tuple(legal_moves[rng.randint(len(legal_moves))]))
+    return positions
+
+class TestBulkExtractFeatures(GoPositionTestCase):
+    def test_matches_extract_features(self):
+        positions = [TEST_POSITION, TEST_POSITION2] + random_game_positions(200)[::7]
+        # the default planes are the ones chunks and checkpoints were made with
+        self.assertEqual(sum(f.planes for f in features.DEFAULT_FEATURES), 28)
+        for feature_list in (features.DEFAULT_FEATURES, features.EXTENDED_FEATURES):
+            output = features.bulk_extract_features(positions, features=feature_list)
+            self.assertEqual(output.shape, (len(positions), 9, 9, sum(f.planes for f in feature_list)))
+            for i, position in enumerate(positions):
+                self.assertEqualNPArray(output[i], features.extract_features(position, features=feature_list))
+
+    def test_unbatched_features(self):
+        @features.planes(1)
+        def move_number_feature(position):
+            return np.full([9, 9, 1], position.n, dtype=np.uint8)
+        feature_list = [move_number_feature, features.ones_feature]
+        positions = random_game_positions(20)
+        output = features.bulk_extract_features(positions, features=feature_list)
+        for i, position in enumerate(positions):
+            self.assertEqualNPArray(output[i], features.extract_features(position, features=feature_list))
+        self.assertEqual(features.bulk_extract_features([]).shape[0], 0)
+
+def without_incremental_features(position):
+    fresh = copy.deepcopy(position)
+    fresh.incremental_features = None
+    return fresh
+
+class TestIncrementalFeatures(GoPositionTestCase):
+    def test_matches_extract_features(self):
+        # sensibleness has no incremental update, so it's recomputed in full
+        feature_lists = (features.DEFAULT_FEATURES, features.DEFAULT_FEATURES + [features.sensibleness_feature])
+        try:
+            for engine in go.ENGINES:
+                go.set_engine(engine)
+                for feature_list in feature_lists:
+                    rng = random.Random(4)
+                    position = features.start_incremental_features(go.Position(), feature_list)
+                    for i in range(120):
+                        if i % 3 == 0:
+                            extracted = features.extract_features(position, feature_list)
+                            expected = features.extract_features(without_incremental_features(position), feature_list)
+                            self.assertEqual(extracted.tobytes(), expected.tobytes(), (engine, i))
+                        legal_moves = list(map(tuple, np.argwhere(position.sensible_move_mask()).tolist()))
+                        move = rng.choice(legal_moves) if legal_moves and rng.random() > 0.05 else None
+                        roll = rng.random()
+                        if position._undo_stack:
+                            # a search: push and pop moves on one position
+                            if roll < 0.4:
+                                position.pop_move()
+                            else:
+                                position.push_move(move)
+                        elif roll < 0.3:
+                            position.push_move(move)
+                        elif roll < 0.65:
+                            position = position.play_move(move)
+                        else:
+                            position.play_move(move, mutate=True)
+        finally:
+            go.set_engine('tuple')
+
+    def test_start_incremental_features(self):
+        position = features.start_incremental_features(go.Position(board=TEST_BOARD))
+        incremental = position.incremental_features
+        self.assertIs(features.start_incremental_features(position).incremental_features, incremental)
+        # the planes are only used for the features they were made for
+        extracted = features.extract_features(position, [features.ones_feature])
+        self.assertEqual(extracted.shape, (9, 9, 1))
+        self.assertIsNone(incremental.changed_points)
+        self.assertEqual(features.extract_features(position).shape, (9, 9, 28))
+        self.assertEqual(incremental.changed_points, set())
+        # extracted features aren't overwritten by later moves
+        extracted = features.extract_features(position)
+        expected = np.copy(extracted)
+        position.play_move((4, 4), mutate=True)
+        features.extract_features(position)
+        self.assertEqualNPArray(extracted, expected)
+        # positions played from this one carry their own copy
+        next_position = position.play_move((5, 5))
+        self.assertIsNot(next_position.incremental_features, position.incremental_features)
+        features.start_incremental_features(position, [features.ones_feature])
+        self.assertEqual(position.incremental_features.features, [features.ones_feature])
+
+    def test_bulk_extract_features(self):
+        positions = [features.start_incremental_features(p) for p in random_game_positions(30)]
+        positions = [position.play_move(None) for position in positions]
+        output = features.bulk_extract_features(positions)
+        for i, position in enumerate(positions):
+            self.assertEqualNPArray(output[i], features.extract_features(without_incremental_features(position)))
@@ -1,4 +1,6 @@
+import copy
 import numpy as np
+import random
 import unittest
 from go import Position, PlayerMove, LibertyTracker, WHITE, BLACK, EMPTY
 import go
@@ -38,6 +40,82 @@ class TestGoBoard(GoPositionTestCase):
         self.assertEqual(len(side_neighbors), 3)
 
 
+class TestBoardGeometry(GoPositionTestCase):
+    def test_geometry_is_shared(self):
+        geometry = go.get_geometry(9)
+        self.assertIs(geometry, go.get_geometry(9))
+        self.assertIs(Position().geometry, geometry)
+        self.assertIs(Position(board=np.zeros([13, 13], dtype=np.int8)).geometry, go.get_geometry(13))
+        with self.assertRaises(ValueError):
+            geometry.empty_board[0, 0] = BLACK
+
+    def test_mixed_board_sizes(self):
+        small = Position()
+        large = Position(geometry=go.get_geometry(19))
+        for move in [(2, 2), (16, 16), (3, 3)]:
+            small = small.play_move(move) if max(move) < 9 else small
+            large = large.play_move(move)
+        self.assertEqual(go.N, 9)
+        self.assertEqual(small.board.shape, (9, 9))
+        self.assertEqual(large.board.shape, (19, 19))
+        self.assertEqual(large.lib_tracker.group_index.shape, (19, 19))
+        self.assertEqual(len(large.geometry.neighbors[(18, 18)]), 2)
+        self.assertEqual(large.zobrist_hash, go.compute_zobrist_hash(large.board, large.to_play))
+        self.assertEqual(large.score(), 1 - large.komi)
+        self.assertEqual(str(large).splitlines()[0].split(), list('ABCDEFGHJKLMNOPQRST'))
+
+class TestMoveHistory(unittest.TestCase):
+    def test_matches_tuple(self):
+        moves = tuple(PlayerMove(BLACK if i % 2 == 0 else WHITE, (i, 0)) for i in range(9))
+        history = go.MoveHistory.from_moves(moves)
+        self.assertEqual(len(history), 9)
+        self.assertEqual(tuple(history), moves)
+        self.assertEqual(tuple(reversed(history)), moves[::-1])
+        self.assertEqual(history, moves)
+        for i in range(-9, 9):
+            self.assertEqual(history[i], moves[i])
+        for s in [slice(-3, None), slice(None, 4), slice(2, -2), slice(-20, None), slice(5, 2), slice(None, None, 2), slice(None, None, -1)]:
+            self.assertEqual(history[s], moves[s])
+        with self.assertRaises(IndexError):
+            history[9]
+        self.assertFalse(go.MoveHistory())
+
+    def test_positions_share_history(self):
+        position = Position()
+        first = position.play_move(pc('E5'))
+        second = first.play_move(pc('E6'))
+        third = first.pass_move()
+        self.assertIs(second.recent.parent, first.recent)
+        self.assertIs(third.recent.parent, first.recent)
+        self.assertEqual(second.recent[-2:], (PlayerMove(BLACK, pc('E5')), PlayerMove(WHITE, pc('E6'))))
+        self.assertEqual(third.recent[-1], PlayerMove(WHITE, None))
+        self.assertEqual(len(position.recent), 0)
+        self.assertIs(copy.deepcopy(second).recent, second.recent)
+
+class TestHashHistory(unittest.TestCase):
+    def test_matches_set(self):
+        hashes = set()
+        history = go.HashHistory()
+        for h in [5, 17, 2 ** 63 + 1, 5, 99] + list(range(1000, 1100)):
+            older = history
+            history = history.add(h)
+            hashes.add(h)
+            self.assertEqual(history, hashes)
+            self.assertEqual(len(history), len(hashes))
+            self.assertNotIn(h + 1, history)
+        # adding doesn't change the older history
+        self.assertEqual(older, hashes - {1099})
+        # 104 hashes, in sets of distinct power of two sizes
+        self.assertEqual(sorted(len(level) for level in history.levels), [8, 32, 64])
+
+    def test_positions_share_hashes(self):
+        position = Position().play_move(pc('E5'))
+        copied = copy.deepcopy(position)
+        self.assertIs(copied.seen_hashes, position.seen_hashes)
+        next_position = position.play_move(pc('E6'))
+        self.assertEqual(len(next_position.seen_hashes), 3)
+        self.assertEqual(len(position.seen_hashes), 2)
+
 class TestEyeHandling(GoPositionTestCase):
     def test_is_koish(self):
         self.assertEqual(go.is_koish(TEST_BOARD, pc('A9')), BLACK)
@@ -68,10 +146,12 @@ class TestEyeHandling(GoPositionTestCase):
             self.assertEqual(go.is_eyeish(board, ne), None, str(ne))
 
 class TestLibertyTracker(unittest.TestCase):
+    tracker = LibertyTracker
+
     def test_lib_tracker_init(self):
         board = load_board('X........' + EMPTY_ROW * 8)
 
-        lib_tracker = LibertyTracker.from_board(board)
+        lib_tracker = self.tracker.from_board(board)
         self.assertEqual(len(lib_tracker.groups), 1)
         self.assertNotEqual(lib_tracker.group_index[pc('A9')], go.MISSING_GROUP_ID)
         self.assertEqual(lib_tracker.liberty_cache[pc('A9')], 2)
@@ -82,7 +162,7 @@ class TestLibertyTracker(unittest.TestCase):
 
     def test_place_stone(self):
         board = load_board('X........' + EMPTY_ROW * 8)
-        lib_tracker = LibertyTracker.from_board(board)
+        lib_tracker = self.tracker.from_board(board)
         lib_tracker.add_stone(BLACK, pc('B9'))
         self.assertEqual(len(lib_tracker.groups), 1)
         self.assertNotEqual(lib_tracker.group_index[pc('A9')], go.MISSING_GROUP_ID)
@@ -95,7 +175,7 @@ class TestLibertyTracker(unittest.TestCase):
 
     def test_place_stone_opposite_color(self):
         board = load_board('X........' + EMPTY_ROW * 8)
-        lib_tracker = LibertyTracker.from_board(board)
+        lib_tracker = self.tracker.from_board(board)
         lib_tracker.add_stone(WHITE, pc('B9'))
         self.assertEqual(len(lib_tracker.groups), 2)
         self.assertNotEqual(lib_tracker.group_index[pc('A9')], go.MISSING_GROUP_ID)
@@ -117,7 +197,7 @@ class TestLibertyTracker(unittest.TestCase):
             X.X......
             .X.......
         ''' + EMPTY_ROW * 6)
-        lib_tracker = LibertyTracker.from_board(board)
+        lib_tracker = self.tracker.from_board(board)
         lib_tracker.add_stone(BLACK, pc('B8'))
         self.assertEqual(len(lib_tracker.groups), 1)
         self.assertNotEqual(lib_tracker.group_index[pc('B8')], go.MISSING_GROUP_ID)
@@ -136,7 +216,7 @@ class TestLibertyTracker(unittest.TestCase):
             XO.......
             .X.......
         ''' + EMPTY_ROW * 6)
-        lib_tracker = LibertyTracker.from_board(board)
+        lib_tracker = self.tracker.from_board(board)
         captured = lib_tracker.add_stone(BLACK, pc('C8'))
         self.assertEqual(len(lib_tracker.groups), 4)
         self.assertEqual(lib_tracker.group_index[pc('B8')], go.MISSING_GROUP_ID)
@@ -148,7 +228,7 @@ class TestLibertyTracker(unittest.TestCase):
             XOO......
             .XX......
         ''' + EMPTY_ROW * 6)
-        lib_tracker = LibertyTracker.from_board(board)
+        lib_tracker = self.tracker.from_board(board)
         captured = lib_tracker.add_stone(BLACK, pc('D8'))
         self.assertEqual(len(lib_tracker.groups), 4)
         self.assertEqual(lib_tracker.group_index[pc('B8')], go.MISSING_GROUP_ID)
@@ -188,7 +268,7 @@ class TestLibertyTracker(unittest.TestCase):
             OXX......
             XX.......
         ''' + EMPTY_ROW * 6)
-        lib_tracker = LibertyTracker.from_board(board)
+        lib_tracker = self.tracker.from_board(board)
         captured = lib_tracker.add_stone(BLACK, pc('A9'))
         self.assertEqual(len(lib_tracker.groups), 2)
         self.assertEqual(captured, pc_set('B9 A8'))
@@ -214,7 +294,7 @@ class TestLibertyTracker(unittest.TestCase):
             X........
         ''' + EMPTY_ROW * 7)
 
-        lib_tracker = LibertyTracker.from_board(board)
+        lib_tracker = self.tracker.from_board(board)
         captured = lib_tracker.add_stone(BLACK, pc('B8'))
         self.assertEqual(len(lib_tracker.groups), 1)
         sole_group_id = lib_tracker.group_index[pc('A9')]
@@ -229,7 +309,7 @@ class TestLibertyTracker(unittest.TestCase):
             X........
         ''' + EMPTY_ROW * 7)
 
-        lib_tracker = LibertyTracker.from_board(board)
+        lib_tracker = self.tracker.from_board(board)
         captured = lib_tracker.add_stone(WHITE, pc('B8'))
         self.assertEqual(len(lib_tracker.groups), 2)
         black_group = lib_tracker.groups[lib_tracker.group_index[pc('A9')]]
@@ -242,6 +322,122 @@ class TestLibertyTracker(unittest.TestCase):
 
         self.assertEqual(captured, set())
 
+    def test_groups_in_atari(self):
+        board = load_board('''
+            .XO.X.O..
+            XOO.X....
+            .XX..X...
+        ''' + EMPTY_ROW * 6)
+        lib_tracker = self.tracker.from_board(board)
+        atari = lambda color: {frozenset(g.stones): g.liberties for g in lib_tracker.groups_in_atari(color)}
+        self.assertEqual(atari(BLACK), {frozenset(pc_set('B9')): pc_set('A9')})
+        self.assertEqual(atari(WHITE), {})
+        lib_tracker.add_stone(BLACK, pc('D9'))
+        self.assertEqual(atari(WHITE), {frozenset(pc_set('C9 B8 C8')): pc_set('D8')})
+        lib_tracker.add_stone(WHITE, pc('A9'))
+        self.assertEqual(atari(BLACK), {frozenset(pc_set('A8')): pc_set('A7')})
+
+    def test_groups_in_atari_through_a_game(self):
+        rng = random.Random(0)
+        lib_tracker = self.tracker.from_board(np.copy(go.EMPTY_BOARD))
+        undos = []
+        color = BLACK
+        for _ in range(300):
+            board = np.zeros([go.N, go.N], dtype=np.int8)
+            for group in lib_tracker.groups.values():
+                for s in group.stones:
+                    board[s] = group.color
+            if undos and rng.random() < 0.2:
+                lib_tracker.pop_stone(undos.pop())
+                continue
+            candidates = [c for c in go.ALL_COORDS if board[c] == EMPTY and not lib_tracker.is_move_suicidal(color, c)]
+            if not candidates:
+                color = -color
+                continue
+            undos.append(lib_tracker.push_stone(color, rng.choice(candidates))[1])
+            color = -color
+            for atari_color in (BLACK, WHITE):
+                expected = {frozenset(g.stones) for g in lib_tracker.groups.values()
+                            if g.color == atari_color and len(g.liberties) == 1}
+                self.assertEqual({frozenset(g.stones) for g in lib_tracker.groups_in_atari(atari_color)}, expected)
+
+class TestGroupLabeling(GoPositionTestCase):
+    def test_find_groups(self):
+        board = load_board('''
+            .XOXXOO..
+            XO.OXOX..
+            XXO..X...
+        ''' + EMPTY_ROW * 6)
+        geometry = go.get_geometry(9)
+        labels, roots, group_stones, group_liberties = go.find_groups(geometry.to_flat_board(board), geometry)
+        coords = lambda flat_indices: {geometry.flat_coords[f] for f in flat_indices}
+        groups = {frozenset(coords(stones)): coords(libs) for stones, libs in zip(group_stones, group_liberties)}
+        self.assertEqual(len(groups), 10)
+        self.assertEqual(groups[frozenset(pc_set('B9'))], pc_set('A9'))
+        self.assertEqual(groups[frozenset(pc_set('A8 A7 B7'))], pc_set('A9 A6 B6'))
+        self.assertEqual(groups[frozenset(pc_set('D9 E9 E8'))], pc_set('E7'))
+        self.assertEqual(groups[frozenset(pc_set('F9 G9 F8'))], pc_set('H9'))
+        self.assertEqual(groups[frozenset(pc_set('C9'))], pc_set('C8'))
+        # empty regions are labeled too
+        flat_labels = geometry.unpad(labels)
+        self.assertEqual(flat_labels[pc('A9')], geometry.flat_index[pc('A9')])
+        self.assertEqual(flat_labels[pc('J1')], flat_labels[pc('H9')])
+        self.assertNotEqual(flat_labels[pc('C8')], flat_labels[pc('J1')])
+
+class TestFlatLibertyTracker(TestLibertyTracker):
+    tracker = go.FlatLibertyTracker
+
+    def test_flat_board_border(self):
+        board = load_board('X........' + EMPTY_ROW * 8)
+        lib_tracker = self.tracker.from_board(board)
+        flat_board = np.array(lib_tracker.board)
+        self.assertEqual(flat_board.shape, ((go.N + 2) ** 2,))
+        self.assertEqual(np.count_nonzero(flat_board == go.BORDER), 4 * go.N + 4)
+        self.assertTrue(np.all(lib_tracker.geometry.unpad(flat_board) == board))
+
+class TestArrayLibertyTracker(TestLibertyTracker):
+    tracker = go.ArrayLibertyTracker
+
+    def test_liberty_bitsets(self):
+        board = load_board('''
+            .X.......
+            X.X......
+            .X.......
+        ''' + EMPTY_ROW * 6)
+        lib_tracker = self.tracker.from_board(board)
+        lib_tracker.add_stone(BLACK, pc('B8'))
+        flat_coords = lib_tracker.geometry.flat_coords
+        group_root = lib_tracker.root[lib_tracker.geometry.flat_index[pc('B8')]]
+        self.assertEqual(lib_tracker.num_stones[group_root], 5)
+        self.assertEqual(go.popcount(lib_tracker.liberties[group_root]), 6)
+        self.assertEqual({flat_coords[f] for f in go.iter_bits(lib_tracker.liberties[group_root])},
+                         pc_set('A9 C9 D8 A7 C7 B6'))
+        self.assertEqual({flat_coords[s] for s in lib_tracker.group_stones(group_root)},
+                         pc_set('B9 A8 B8 C8 B7'))
+
+class TestBitboardLibertyTracker(TestLibertyTracker):
+    tracker = go.BitboardLibertyTracker
+
+    def test_shift_masks(self):
+        masks = go.get_geometry(9).bit_masks
+        bits = lambda coords: sum(1 << (r * 9 + c) for r, c in coords)
+        self.assertEqual(masks.spread(bits([pc('A9')])), bits(pc_set('B9 A8')))
+        self.assertEqual(masks.spread(bits([pc('J5')])), bits(pc_set('J6 J4 H5')))
+        self.assertEqual(masks.flood_fill(bits([pc('A1')]), masks.full & ~bits(pc_set('B1 B2 A2'))), bits([pc('A1')]))
+        self.assertEqual(go.popcount(masks.edge), 32)
+        mask = np.zeros([9, 9], dtype=bool)
+        mask[pc('A9')] = mask[pc('J1')] = mask[pc('C4')] = True
+        self.assertEqual(masks.from_mask(mask), bits(pc_set('A9 J1 C4')))
+        self.assertEqual(masks.to_mask(bits(pc_set('A9 J1 C4'))).tolist(), mask.tolist())
+
+    def test_eyeish_points(self):
+        rng = np.random.RandomState(0)
+        for _ in range(20):
+            board = rng.choice([BLACK, WHITE, EMPTY, EMPTY], size=[9, 9]).astype(np.int8)
+            lib_tracker = self.tracker.from_board(board)
+            for c in go.get_geometry(9).all_coords:
+                self.assertEqual(lib_tracker.is_eyeish(c), go.is_eyeish(board, c), str(c))
+
 class TestPosition(GoPositionTestCase):
     def test_passing(self):
         start_position = Position(
@@ -465,23 +661,218 @@ class TestPosition(GoPositionTestCase):
         # Check that retaking ko is illegal until two intervening moves
         with self.assertRaises(go.IllegalMove):
             actual_position.play_move(pc('B9'))
+        # Passing twice doesn't help: retaking would recreate the start
+        # position, which is forbidden by positional superko.
         pass_twice = actual_position.pass_move().pass_move()
-        ko_delayed_retake = pass_twice.play_move(pc('B9'))
+        with self.assertRaises(go.IllegalMove):
+            pass_twice.play_move(pc('B9'))
+        # A ko threat and its answer elsewhere changes the board.
+        threat_and_answer = actual_position.play_move(pc('E5')).play_move(pc('E4'))
+        ko_delayed_retake = threat_and_answer.play_move(pc('B9'))
+        expected_board = load_board('''
+            .OX......
+            OX.......
+        ''' + EMPTY_ROW * 2 + '''
+            ....O....
+            ....X....
+        ''' + EMPTY_ROW * 3)
         expected_position = Position(
-            board=start_board,
+            board=expected_board,
             n=4,
             komi=6.5,
             caps=(2, 3),
             ko=pc('A9'),
             recent=(
                 PlayerMove(BLACK, pc('A9')),
-                PlayerMove(WHITE, None),
-                PlayerMove(BLACK, None),
+                PlayerMove(WHITE, pc('E5')),
+                PlayerMove(BLACK, pc('E4')),
                 PlayerMove(WHITE, pc('B9'))),
             to_play=BLACK,
         )
         self.assertEqualPositions(ko_delayed_retake, expected_position)
 
+    def test_push_pop_move(self):
+        start_board = load_board(EMPTY_ROW * 5 + '''
+            XXXX.....
+            XOOX.....
+            O.OX.....
+            OOXX.....
+        ''')
+        position = Position(board=start_board, n=0, komi=6.5, caps=(1, 2), to_play=BLACK)
+        original = copy.deepcopy(position)
+        position.push_move(pc('B2'))
+        self.assertEqual(position.caps, (7, 2))
+        after_capture = copy.deepcopy(position)
+        position.push_move(None)
+        position.push_move(pc('A2'))
+        position.push_move(pc('B3'))
+        with self.assertRaises(go.IllegalMove):
+            position.push_move(pc('B3'))
+        position.pop_move().pop_move().pop_move()
+        self.assertEqualPositions(position, after_capture)
+        self.assertEqual(position.seen_hashes, after_capture.seen_hashes)
+        position.pop_move()
+        self.assertEqualPositions(position, original)
+        self.assertEqual(position.seen_hashes, original.seen_hashes)
+
+    def test_push_pop_random_game(self):
+        rng = random.Random(1)
+        position = Position()
+        snapshots = []
+        for i in range(150):
+            legal_moves = [c for c in go.ALL_COORDS if position.is_move_legal(c)]
+            move = rng.choice(legal_moves) if legal_moves else None
+            snapshots.append(copy.deepcopy(position))
+            position.push_move(move)
+            self.assertEqualPositions(position, snapshots[-1].play_move(move))
+        while snapshots:
+            position.pop_move()
+            self.assertEqualPositions(position, snapshots.pop())
+
+    def test_from_board_matches_incremental(self):
+        rng = random.Random(2)
+        position = Position()
+        for i in range(120):
+            legal_moves = [c for c in go.ALL_COORDS if position.is_move_legal(c)]
+            position.play_move(rng.choice(legal_moves) if legal_moves else None, mutate=True)
+            if i % 10 == 0:
+                self.assertEqualLibTracker(go.Tracker.from_board(position.board), position.lib_tracker)
+
+    def test_move_masks_match_point_checks(self):
+        rng = random.Random(3)
+        position = Position()
+        for i in range(150):
+            if i % 5 == 0:
+                legal_mask = position.legal_move_mask()
+                eye_mask = position.own_eye_mask()
+                eye_colors = position._refresh_move_masks().eye_colors
+                for c in go.ALL_COORDS:
+                    eye_color = go.is_eyeish(position.board, c)
+                    self.assertEqual(legal_mask[c], position.is_move_legal(c), (i, c))
+                    self.assertEqual(eye_mask[c], eye_color == position.to_play, (i, c))
+                    self.assertEqual(eye_colors[c], EMPTY if eye_color is None else eye_color, (i, c))
+                    self.assertEqual(position.is_eyeish(c), eye_color, (i, c))
+            if i % 7 == 0 and position._undo_stack:
+                position.pop_move()
+                continue
+            legal_moves = [c for c in go.ALL_COORDS if position.is_move_legal(c)]
+            move = rng.choice(legal_moves) if legal_moves and rng.random() > 0.05 else None
+            if i % 3 == 0:
+                position = position.play_move(move)
+            else:
+                position.push_move(move)
+
+    def test_superko(self):
+        start_board = load_board('''
+            .OX......
+            OX.......
+        ''' + EMPTY_ROW * 7)
+        position = Position(board=start_board, to_play=BLACK)
+        black_takes = position.play_move(pc('A9'))
+        self.assertIn(position.board_hash(), black_takes.seen_hashes)
+        pass_twice = black_takes.pass_move().pass_move()
+        self.assertEqual(pass_twice.ko, None)
+        self.assertTrue(pass_twice.is_move_superko(pc('B9')))
+        self.assertFalse(pass_twice.is_move_legal(pc('B9')))
+        self.assertFalse(pass_twice.is_move_superko(pc('E5')))
+        legal_mask = pass_twice.legal_move_mask()
+        self.assertFalse(legal_mask[pc('B9')])
+        self.assertTrue(legal_mask[pc('E5')])
+
+    def test_superko_without_capture(self):
+        # a board with one more black stone than this one was seen before
+        repeated_board = np.copy(TEST_BOARD)
+        repeated_board[pc('E5')] = BLACK
+        seen_hashes = {go.compute_zobrist_hash(repeated_board, BLACK)}
+        position = Position(board=TEST_BOARD, to_play=BLACK, seen_hashes=seen_hashes)
+        self.assertFalse(position.is_move_legal(pc('E5')))
+        legal_mask = position.legal_move_mask()
+        self.assertFalse(legal_mask[pc('E5')])
+        self.assertEqual(np.count_nonzero(legal_mask), np.count_nonzero(TEST_BOARD == EMPTY) - 1)
+
+    def test_zobrist_hash(self):
+        position = Position(board=TEST_BOARD, to_play=BLACK)
+        self.assertEqual(position.zobrist_hash, go.compute_zobrist_hash(TEST_BOARD, BLACK))
+        self.assertNotEqual(position.zobrist_hash, go.compute_zobrist_hash(TEST_BOARD, WHITE))
+        self.assertEqual(position.board_hash(), position.flip_playerturn().board_hash())
+        self.assertNotEqual(position.zobrist_hash, position.pass_move().zobrist_hash)
+        self.assertEqual(position.zobrist_hash, position.pass_move().pass_move().zobrist_hash)
+        moved = position.play_move(pc('C9'))
+        self.assertEqual(moved.zobrist_hash, go.compute_zobrist_hash(moved.board, moved.to_play))
+
+    def test_ko_move_mutating(self):
+        start_board = load_board('''
+            .OX......
+            OX.......
+        ''' + EMPTY_ROW * 7)
+        position = Position(board=start_board, to_play=BLACK)
+        position.play_move(pc('A9'), mutate=True)
+        self.assertEqual(position.ko, pc('B9'))
+        with self.assertRaises(go.IllegalMove):
+            position.play_move(pc('B9'), mutate=True)
+
+    def test_to_bytes(self):
+        start_board = load_board('''
+            .OX......
+            OX.......
+        ''' + EMPTY_ROW * 7)
+        position = Position(board=start_board, n=3, komi=6.5, caps=(1, 300), to_play=WHITE)
+        data = position.to_bytes()
+        self.assertEqual(len(data), go.POSITION_HEADER.size + 21)
+        self.assertEqualPositions(Position.from_bytes(data), position)
+        for move in ['E5', None, 'A9', 'J1', 'H1', 'J2', None, 'J3', 'H2', 'D4']:
+            position = position.play_move(pc(move) if move else None)
+            restored = Position.from_bytes(position.to_bytes())
+            self.assertIsNone(restored._lib_tracker)
+            self.assertEqualPositions(restored, position)
+            self.assertEqual(restored.komi, 6.5)
+            self.assertEqual(len(restored.recent), min(len(position.recent), go.RECENT_MOVES))
+        ko_position = Position(board=start_board).play_move(pc('A9'))
+        self.assertEqual(Position.from_bytes(ko_position.to_bytes()).ko, pc('B9'))
+        self.assertEqual(len(position.to_bytes()), len(data))
+
+        large = Position(geometry=go.get_geometry(19)).play_move((18, 18))
+        self.assertEqualPositions(Position.from_bytes(large.to_bytes()), large)
+
+class TestFlatPosition(TestPosition):
+    def setUp(self):
+        super().setUp()
+        go.set_engine('flat')
+
+    def tearDown(self):
+        go.set_engine('tuple')
+
+    def test_engine_in_use(self):
+        position = Position(board=TEST_BOARD)
+        self.assertIsInstance(position.lib_tracker, go.FlatLibertyTracker)
+        self.assertIsInstance(position.play_move(pc('C9')).lib_tracker, go.FlatLibertyTracker)
+
+class TestArrayPosition(TestPosition):
+    def setUp(self):
+        super().setUp()
+        go.set_engine('array')
+
+    def tearDown(self):
+        go.set_engine('tuple')
+
+    def test_engine_in_use(self):
+        position = Position(board=TEST_BOARD)
+        self.assertIsInstance(position.lib_tracker, go.ArrayLibertyTracker)
+        self.assertIsInstance(position.play_move(pc('C9')).lib_tracker, go.ArrayLibertyTracker)
+
+class TestBitboardPosition(TestPosition):
+    def setUp(self):
+        super().setUp()
+        go.set_engine('bitboard')
+
+    def tearDown(self):
+        go.set_engine('tuple')
+
+    def test_engine_in_use(self):
+        position = Position(board=TEST_BOARD)
+        self.assertIsInstance(position.lib_tracker, go.BitboardLibertyTracker)
+        self.assertIsInstance(position.play_move(pc('C9')).lib_tracker, go.BitboardLibertyTracker)
+
 class TestScoring(unittest.TestCase):
     def test_scoring(self):
             board = load_board('''
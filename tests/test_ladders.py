@@ -0,0 +1,98 @@
+import numpy as np
+
+import features
+import go
+import ladders
+from test_utils import load_board, GoPositionTestCase
+
+go.set_board_size(9)
+
+# White's stone in the middle can be chased down to the bottom edge.
+LADDER_BOARD = load_board('''
+    .........
+    .........
+    .........
+    .........
+    .....X...
+    ....XO...
+    ....X....
+    .........
+    .........
+''')
+
+# The same, with a white stone on the ladder's path.
+BROKEN_LADDER_BOARD = load_board('''
+    .........
+    .........
+    .........
+    .........
+    .....X...
+    ....XO...
+    ....X....
+    .......O.
+    .........
+''')
+
+class TestLadders(GoPositionTestCase):
+    def test_ladder_capture(self):
+        reader = ladders.LadderReader()
+        position = go.Position(board=LADDER_BOARD, to_play=go.BLACK)
+        before = go.Position(board=np.copy(LADDER_BOARD), to_play=go.BLACK)
+        self.assertEqual(reader.ladder_captures(position), {(5, 6)})
+        # reading leaves the position as it was
+        self.assertEqualPositions(position, before)
+
+        broken = go.Position(board=BROKEN_LADDER_BOARD, to_play=go.BLACK)
+        self.assertEqual(reader.ladder_captures(broken), set())
+
+    def test_ladder_escape(self):
+        reader = ladders.LadderReader()
+        position = go.Position(board=LADDER_BOARD, to_play=go.BLACK).play_move((5, 6))
+        self.assertEqual(reader.ladder_escapes(position), set())
+        self.assertTrue(reader.is_captured(position, (5, 5)))
+
+        broken = go.Position(board=BROKEN_LADDER_BOARD, to_play=go.BLACK).play_move((5, 6))
+        self.assertEqual(reader.ladder_escapes(broken), {(6, 5)})
+        self.assertFalse(reader.is_captured(broken, (5, 5)))
+
+    def test_depth_limit(self):
+        # too shallow to see the ladder reach the edge
+        reader = ladders.LadderReader(max_depth=4)
+        position = go.Position(board=LADDER_BOARD, to_play=go.BLACK)
+        self.assertEqual(reader.ladder_captures(position), set())
+
+    def test_depth_limited_results_arent_cached(self):
+        # Reading from the start of the ladder runs into the depth limit a
+        # few moves in, but the position one move later has enough depth
+        # left to read it out.
+        reader = ladders.LadderReader(max_depth=7)
+        position = go.Position(board=LADDER_BOARD, to_play=go.BLACK)
+        self.assertEqual(reader.ladder_captures(position), set())
+        next_position = position.play_move((5, 6))
+        self.assertEqual(reader.ladder_escapes(next_position),
+                         ladders.LadderReader(max_depth=7).ladder_escapes(next_position))
+
+    def test_cache_is_reused(self):
+        reader = ladders.LadderReader()
+        position = go.Position(board=LADDER_BOARD, to_play=go.BLACK)
+        reader.ladder_captures(position)
+        cache_size = len(reader.cache)
+        # the ladder's first moves were read from this position
+        next_position = position.play_move((5, 6)).play_move((6, 5))
+        reader.ladder_escapes(next_position)
+        reader.ladder_captures(next_position)
+        self.assertEqual(len(reader.cache), cache_size)
+
+    def test_features(self):
+        position = go.Position(board=LADDER_BOARD, to_play=go.BLACK)
+        capture_plane = features.ladder_capture_feature(position)
+        self.assertEqual(capture_plane.shape, (9, 9, 1))
+        self.assertEqual(list(zip(*np.nonzero(capture_plane[:, :, 0]))), [(5, 6)])
+        escape_plane = features.ladder_escape_feature(position.play_move((5, 6)))
+        self.assertEqual(escape_plane.sum(), 0)
+
+        # they're last in EXTENDED_FEATURES, and not in DEFAULT_FEATURES
+        self.assertNotIn(features.ladder_capture_feature, features.DEFAULT_FEATURES)
+        extended = features.extract_features(position, features.EXTENDED_FEATURES)
+        self.assertEqual(extended.shape, (9, 9, sum(f.planes for f in features.EXTENDED_FEATURES)))
+        self.assertEqualNPArray(extended[:, :, -2:-1], capture_plane)
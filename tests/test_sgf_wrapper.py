@@ -1,3 +1,5 @@
+import copy
+import features
 import go
 from sgf_wrapper import replay_sgf, replay_position
 import unittest
@@ -9,6 +11,10 @@ JAPANESE_HANDICAP_SGF = "(;GM[1]FF[4]CA[UTF-8]AP[CGoban:3]ST[2]RU[Japanese]SZ[9]
 
 CHINESE_HANDICAP_SGF = "(;GM[1]FF[4]CA[UTF-8]AP[CGoban:3]ST[2]RU[Chinese]SZ[9]HA[2]KM[5.50]PW[test_white]PB[test_black]RE[B+39.50];B[gc];B[cg];W[ee];B[gg];W[eg];B[ge];W[ce];B[ec];W[cc];B[dd];W[de];B[cd];W[bd];B[bc];W[bb];B[be];W[ac];B[bf];W[dh];B[ch];W[ci];B[bi];W[di];B[ah];W[gh];B[hh];W[fh];B[hg];W[gi];B[fg];W[dg];B[ei];W[cf];B[ef];W[ff];B[fe];W[bg];B[bh];W[af];B[ag];W[ae];B[ad];W[ae];B[ed];W[db];B[df];W[eb];B[fb];W[ea];B[fa])"
 
+# Black takes a ko, both sides pass, and white takes it back, which repeats
+# the board: legal under Japanese rules, but not under positional superko.
+REPEATED_BOARD_SGF = "(;GM[1]FF[4]RU[Japanese]SZ[9]KM[6.50]AB[ba][ab][bc]AW[ca][bb][cc][db];B[cb];W[];B[];W[bb])"
+
 NO_HANDICAP_SGF = "(;CA[UTF-8]SZ[9]PB[Murakawa Daisuke]PW[Iyama Yuta]KM[6.5]HA[0]RE[W+1.5]GM[1];B[fd];W[cf];B[eg];W[dd];B[dc];W[cc];B[de];W[cd];B[ed];W[he];B[ce];W[be];B[df];W[bf];B[hd];W[ge];B[gd];W[gg];B[db];W[cb];B[cg];W[bg];B[gh];W[fh];B[hh];W[fg];B[eh];W[ei];B[di];W[fi];B[hg];W[dh];B[ch];W[ci];B[bh];W[ff];B[fe];W[hf];B[id];W[bi];B[ah];W[ef];B[dg];W[ee];B[di];W[ig];B[ai];W[ih];B[fb];W[hi];B[ag];W[ab];B[bd];W[bc];B[ae];W[ad];B[af];W[bd];B[ca];W[ba];B[da];W[ie])"
 
 
@@ -113,6 +119,50 @@ class TestSgfWrapper(GoPositionTestCase):
         self.assertFalse(positions_w_context[-1].is_usable())
         self.assertTrue(positions_w_context[-2].is_usable())
 
+    def test_replay_repeated_board(self):
+        positions = [p.position for p in replay_sgf(REPEATED_BOARD_SGF)]
+        self.assertEqual(len(positions), 5)
+        self.assertEqualNPArray(positions[-1].board, positions[0].board)
+        # the same move isn't legal in play
+        with self.assertRaises(go.IllegalMove):
+            positions[-2].play_move(pc('B8'))
+
+    def test_replay_with_move_masks(self):
+        for p in replay_sgf(NO_HANDICAP_SGF, move_masks=True):
+            position = p.position
+            # already up to date, so asking for the legal moves is cheap
+            self.assertEqual(position._move_masks.changed_points, set())
+            legal_mask = position.legal_move_mask()
+            for c in go.ALL_COORDS:
+                self.assertEqual(legal_mask[c], position.is_move_legal(c), c)
+
+    def test_mutating_replay(self):
+        copied = [(copy.deepcopy(p.position), p.next_move) for p in replay_sgf(CHINESE_HANDICAP_SGF)]
+        mutated = [(copy.deepcopy(p.position), p.next_move) for p in replay_sgf(CHINESE_HANDICAP_SGF, mutate=True)]
+        self.assertEqual(len(copied), len(mutated))
+        for (copied_pos, copied_next), (mutated_pos, mutated_next) in zip(copied, mutated):
+            self.assertEqualPositions(copied_pos, mutated_pos)
+            self.assertEqual(copied_next, mutated_next)
+
+    def test_replay_with_features(self):
+        for sgf_contents in (CHINESE_HANDICAP_SGF, NO_HANDICAP_SGF):
+            for mutate in (False, True):
+                for p in replay_sgf(sgf_contents, mutate=mutate, features=features.DEFAULT_FEATURES):
+                    fresh = copy.deepcopy(p.position)
+                    fresh.incremental_features = None
+                    self.assertEqual(features.extract_features(p.position).tobytes(),
+                                     features.extract_features(fresh).tobytes())
+
+    def test_replay_leaves_default_board_size(self):
+        go.set_board_size(19)
+        try:
+            final = list(replay_sgf(NO_HANDICAP_SGF))[-1].position
+            self.assertEqual(go.N, 19)
+        finally:
+            go.set_board_size(9)
+        self.assertEqual(final.geometry.n, 9)
+        self.assertEqual(final.board.shape, (9, 9))
+
 class TestPositionReplay(GoPositionTestCase):
     def test_replay_position(self):
         sgf_positions = list(replay_sgf(NO_HANDICAP_SGF))
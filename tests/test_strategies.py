@@ -1,12 +1,49 @@
+import contextlib
+import copy
+import io
+import numpy as np
 import unittest
+import gtp
+import features
+import go
 from go import Position, BLACK
-from strategies import is_move_reasonable
-from test_utils import load_board
+from strategies import is_move_reasonable, select_most_likely, select_weighted_random, MCTS, MCTSNode
+from strategies import RandomPlayer, PolicyNetworkBestMovePlayer
+from test_utils import load_board, GoPositionTestCase
 from utils import parse_kgs_coords as pc
 
 def pc_set(string):
     return set(map(pc, string.split()))
 
+class UniformPolicy(object):
+    'Stands in for a PolicyNetwork; every move is equally likely.'
+    def initialize_variables(self, save_file=None):
+        pass
+
+    @property
+    def board_size(self):
+        return go.N
+
+    def run(self, position):
+        return np.ones([go.N, go.N]) / go.N ** 2
+
+class FeaturePolicy(UniformPolicy):
+    'A UniformPolicy that extracts features, and checks them against features from scratch.'
+    def __init__(self, test):
+        self.test = test
+        self.features = features.DEFAULT_FEATURES
+        self.output_cache = None
+        self.num_runs = 0
+
+    def run(self, position):
+        self.test.assertIsNotNone(position.incremental_features)
+        fresh = copy.deepcopy(position)
+        fresh.incremental_features = None
+        self.test.assertEqual(features.extract_features(position, self.features).tobytes(),
+                              features.extract_features(fresh, self.features).tobytes())
+        self.num_runs += 1
+        return super().run(position)
+
 class TestHelperFunctions(unittest.TestCase):
     def test_is_move_reasonable(self):
         board = load_board('''
@@ -31,3 +68,61 @@ class TestHelperFunctions(unittest.TestCase):
         for move in unreasonable_moves:
             self.assertFalse(is_move_reasonable(position, move), str(move))
 
+        sensible_mask = position.sensible_move_mask()
+        for move in go.ALL_COORDS:
+            self.assertEqual(sensible_mask[move], is_move_reasonable(position, move), str(move))
+
+    def test_select_move(self):
+        position = Position(board=load_board('''
+            .X.......
+            X........
+        ''' + '.........' * 7), to_play=BLACK)
+        move_probabilities = np.zeros([go.N, go.N])
+        # A9 is black's own eye; B8 is the best reasonable move.
+        move_probabilities[pc('A9')] = 0.7
+        move_probabilities[pc('B8')] = 0.2
+        move_probabilities[pc('C7')] = 0.1
+        self.assertEqual(select_most_likely(position, move_probabilities), pc('B8'))
+        for _ in range(20):
+            self.assertIn(select_weighted_random(position, move_probabilities), pc_set('B8 C7'))
+        self.assertIn(select_weighted_random(position, np.zeros([go.N, go.N])), go.ALL_COORDS)
+
+class TestGtp(unittest.TestCase):
+    def test_genmove_without_boardsize(self):
+        go.set_board_size(19)
+        try:
+            for player in (RandomPlayer(), PolicyNetworkBestMovePlayer(UniformPolicy(), read_file=None)):
+                engine = gtp.Engine(player)
+                # a 19x19 point, which wouldn't parse on a 9x9 board
+                self.assertEqual(engine.send("play w Q16"), "=\n\n")
+                response = engine.send("genmove b")
+                self.assertTrue(response.startswith("= "), response)
+                self.assertEqual(player.position.geometry.n, 19)
+                self.assertEqual(player.position.n, 2)
+        finally:
+            go.set_board_size(9)
+
+class TestMCTS(GoPositionTestCase):
+    def test_tree_search_restores_position(self):
+        policy = UniformPolicy()
+        mcts = MCTS(policy, read_file=None)
+        position = Position().play_move(pc('E5'))
+        original = copy.deepcopy(position)
+        root = MCTSNode.root_node(position, policy.run(position))
+        with contextlib.redirect_stderr(io.StringIO()):
+            for _ in range(3):
+                mcts.tree_search(root)
+        self.assertEqualPositions(position, original)
+        self.assertEqual(position.seen_hashes, original.seen_hashes)
+        # searches that run into an illegal move prune it without a backup.
+        self.assertGreater(root.N, 0)
+        self.assertEqual(sum(child.N for child in root.children.values()), root.N)
+
+    def test_search_uses_incremental_features(self):
+        policy = FeaturePolicy(self)
+        mcts = MCTS(policy, read_file=None, seconds_per_move=0.5)
+        position = Position().play_move(pc('E5'))
+        with contextlib.redirect_stderr(io.StringIO()):
+            mcts.suggest_move(position)
+        # the root, and every leaf and rollout position after it
+        self.assertGreater(policy.num_runs, 1)
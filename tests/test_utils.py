@@ -49,6 +49,30 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(utils.unflatten_coords(80), (8, 8))
         self.assertEqual(utils.flatten_coords(utils.unflatten_coords(10)), 10)
         self.assertEqual(utils.unflatten_coords(utils.flatten_coords((5, 4))), (5, 4))
+        self.assertEqual(utils.flatten_coords((3, 0), 19), 57)
+        self.assertEqual(utils.unflatten_coords(57, 19), (3, 0))
+        self.assertEqual(utils.parse_kgs_coords('A1', 19), (18, 0))
+
+    def test_lru_cache(self):
+        cache = utils.LRUCache(max_bytes=300)
+        for i in range(3):
+            cache.put(i, np.zeros([100], dtype=np.uint8))
+        self.assertEqual(cache.nbytes, 300)
+        self.assertIsNotNone(cache.get(0))
+        # 1 is now the least recently used, and goes first
+        cache.put(3, np.zeros([100], dtype=np.uint8))
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(sorted(cache.entries), [0, 2, 3])
+        # a big entry pushes out several
+        cache.put(4, np.zeros([250], dtype=np.uint8))
+        self.assertEqual(list(cache.entries), [4])
+        self.assertEqual(cache.nbytes, 250)
+        # too big to store at all
+        cache.put(5, np.zeros([400], dtype=np.uint8))
+        self.assertEqual(list(cache.entries), [4])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        with self.assertRaises(ValueError):
+            cache.get(4)[0] = 1
 
 
 class GoPositionTestCase(unittest.TestCase):
@@ -105,3 +129,4 @@ class GoPositionTestCase(unittest.TestCase):
         if r_len > 0: # if a position has no history, then don't bother testing
             self.assertEqual(pos1.recent[-r_len:], pos2.recent[-r_len:])
         self.assertEqual(pos1.to_play, pos2.to_play)
+        self.assertEqual(pos1.zobrist_hash, pos2.zobrist_hash)
@@ -1,4 +1,4 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import time
 import functools, operator
 import gtp
@@ -7,14 +7,16 @@ import go
 KGS_COLUMNS = 'ABCDEFGHJKLMNOPQRST'
 SGF_COLUMNS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
 
-def parse_sgf_to_flat(sgf):
-    return flatten_coords(parse_sgf_coords(sgf))
+# The board_size arguments below default to go.N, the default board size.
 
-def flatten_coords(c):
-    return go.N * c[0] + c[1]
+def parse_sgf_to_flat(sgf, board_size=None):
+    return flatten_coords(parse_sgf_coords(sgf), board_size)
 
-def unflatten_coords(f):
-    return divmod(f, go.N)
+def flatten_coords(c, board_size=None):
+    return (board_size or go.N) * c[0] + c[1]
+
+def unflatten_coords(f, board_size=None):
+    return divmod(f, board_size or go.N)
 
 def parse_sgf_coords(s):
     'Interprets coords. aa is top left corner; sa is top right corner'
@@ -22,27 +24,27 @@ def parse_sgf_coords(s):
         return None
     return SGF_COLUMNS.index(s[1]), SGF_COLUMNS.index(s[0])
 
-def parse_kgs_coords(s):
+def parse_kgs_coords(s, board_size=None):
     'Interprets coords. A1 is bottom left; A9 is top left.'
     if s == 'pass':
         return None
     s = s.upper()
     col = KGS_COLUMNS.index(s[0])
     row_from_bottom = int(s[1:]) - 1
-    return go.N - row_from_bottom - 1, col
+    return (board_size or go.N) - row_from_bottom - 1, col
 
-def parse_pygtp_coords(vertex):
+def parse_pygtp_coords(vertex, board_size=None):
     'Interprets coords. (1, 1) is bottom left; (1, 9) is top left.'
     if vertex in (gtp.PASS, gtp.RESIGN):
         return None
-    return go.N - vertex[1], vertex[0] - 1
+    return (board_size or go.N) - vertex[1], vertex[0] - 1
 
-def unparse_pygtp_coords(c):
+def unparse_pygtp_coords(c, board_size=None):
     if c == gtp.RESIGN:
         return gtp.RESIGN
     if c is None:
         return gtp.PASS
-    return c[1] + 1, go.N - c[0]
+    return c[1] + 1, (board_size or go.N) - c[0]
 
 def product(numbers):
     return functools.reduce(operator.mul, numbers)
@@ -61,3 +63,53 @@ class timer(object):
     def print_times(cls):
         for k, v in cls.all_times.items():
             print("%s: %.3f" % (k, v))
+
+
+class LRUCache(object):
+    '''
+    A dict of numpy arrays that holds at most max_bytes worth of arrays,
+    evicting the least recently used ones first. Arrays are stored
+    read-only, since the same array is handed out on every hit.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        'Returns the array stored under key, or None.'
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if value.nbytes > self.max_bytes:
+            return value
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).nbytes
+        value.flags.writeable = False
+        self.entries[key] = value
+        self.nbytes += value.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        return "%d entries, %.1f MB; %d hits / %d lookups (%.1f%%)" % (
+            len(self.entries), self.nbytes / 2 ** 20, self.hits, lookups,
+            100 * self.hits / lookups if lookups else 0)